@@ -1,10 +1,24 @@
 import streamlit as st
-import pandas as pd
-from datetime import datetime, time, timedelta, timezone
-import calendar
-from streamlit_gsheets import GSheetsConnection
+from datetime import datetime, timedelta
+import functools
+import io
 import extra_streamlit_components as stx
 import time as time_lib
+import core
+
+# 页面只是核心模块外面的一层：先用 st.secrets 配置核心，再取配置值和业务函数
+core.configure(st.secrets)
+from core import (
+    AUTO_SWITCH_HOUR, DEFAULT_SITE, SITE_CONFIGS, site_config, resolve_site, use_site, bind_site,
+    CACHE_MAX_STALENESS, CHEF_REFRESH_SEC, DEBUG_MODE, METRICS_WINDOW,
+    DataSnapshot, get_metrics, get_backend, get_thai_time, standardize_phone, on_data_changed, order_partition,
+    get_change_feed, start_order_compactor,
+    admin_clean_database, migrate_canonical_phones, migrate_order_partitions, seal_order_month,
+    get_user_by_phone, register_new_user, update_user_status, batch_update_user_status, delete_user_logic,
+    update_order, get_status, get_user_status_on, get_rules_calendar, bulk_update_orders, bulk_order_actions, MEAL_TYPES,
+    resolve_meal_status, get_daily_rollup, copy_daily_rollup, get_monthly_stats, build_admin_master,
+    export_months, export_report, EXPORT_KINDS, EXPORT_FORMATS,
+)
 
 # ==========================================
 # 1. 全局配置与样式
@@ -61,23 +75,8 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # ==========================================
-# 2. 业务配置
+# 2. 界面文案 (业务配置、数据层与业务规则在 core.py)
 # ==========================================
-try:
-    ADMIN_PIN = st.secrets["ADMIN_PIN"]
-except:
-    ADMIN_PIN = "8888"
-
-THAILAND_OFFSET = timedelta(hours=7)
-
-LUNCH_DEADLINE = time(10, 0)
-DINNER_DEADLINE = time(15, 0)
-AUTO_SWITCH_HOUR = 18
-
-# 新增：留饭时间选项 (分别配置午餐和晚餐)
-LUNCH_LATE_OPTIONS = ["12:30", "13:00"]
-DINNER_LATE_OPTIONS = ["19:00", "20:00", "21:00"]
-
 TRANS = {
     "app_title": "🍱 每日报餐 / နေ့စဉ်ထမင်းစာရင်း",
     "welcome": "你好 / မင်္ဂလာပါ",
@@ -93,6 +92,7 @@ TRANS = {
     "sun_head": "📅 周日 (Sunday) / တနင်္ဂနွေနေ့",
     "sun_rule": "⚠️ 规则：要吃请点【我要吃】 / စားလိုလျှင် 'စားမည်' ကိုနှိပ်ပါ",
     "wd_head": "📅 工作日 (Weekday) / အလုပ်ဖွင့်ရက်",
+    "off_head": "📅 休息日 / 放假 (Day Off) / အားလပ်ရက်",
     "wd_rule": "⚠️ 规则：默认吃饭。不吃请点【我不吃】 / ပုံမှန်စားရမည်။ မစားလိုပါက 'မစားပါ' ကိုနှိပ်ပါ",
     "leave_head": "🏝️ 休假中 (On Leave) / ခွင့်ယူထားသည်",
     "leave_rule": "⚠️ 规则：休假期间默认【不吃】。如果要吃请手动点【我要吃】。",
@@ -113,13 +113,43 @@ TRANS = {
     "admin_login": "登录后台 / Login",
     "admin_clean": "🧹 深度修复数据 (合并重复项)",
     "admin_clean_success": "修复完成！",
+    "admin_migrate_phones": "📞 规范化电话号码 (一次性迁移)",
+    "admin_migrate_success": "迁移完成！以后读取不再逐行清洗电话。",
+    "admin_partition_orders": "🗂️ 订单按月分表 (一次性迁移)",
+    "admin_partition_success": "迁移完成！订单已按月拆分。",
+    "admin_seal_month": "🔒 封存该月 (结账后冻结) / Seal Month",
+    "admin_seal_success": "已封存 / Sealed",
+    "admin_sealed_info": "该月已封存，订单只读 / Month sealed (read-only)",
+    "admin_seal_open_month": "只能封存已经结束的月份 / Only closed months can be sealed",
+    "admin_export_title": "💾 工资导出 (多个月) / Payroll Export",
+    "admin_export_from": "从 / From",
+    "admin_export_to": "到 / To",
+    "admin_export_kind": "内容 / Content",
+    "admin_export_people": "每人每月次数 / Per person",
+    "admin_export_daily": "每天人数 / Per day",
+    "admin_export_format": "格式 / Format",
+    "admin_export_download": "下载 / Download",
     "admin_status_mgr": "⚙️ 管理员工状态 / Manage Status",
     "admin_status_active": "✅ 在职/正常 (Active)",
     "admin_status_leave": "🏝️ 休假/停餐 (On Leave)",
     "admin_status_update": "批量更新 / Batch Update", # Updated text
+    "admin_bulk_title": "🗓️ 批量改餐 (停餐 / 加班留饭) / Bulk Meal Override",
+    "admin_bulk_all": "全部员工 / Everyone",
+    "admin_bulk_confirm_all": "确认对全部员工生效 / Confirm: apply to everyone",
+    "admin_bulk_need_confirm": "目标是全部员工，请先勾选确认 / Target is everyone: tick the confirmation first",
+    "admin_bulk_need_users": "请选择员工或勾选全部员工 / Select users or tick Everyone",
+    "admin_bulk_dates": "日期范围 / Date Range",
+    "admin_bulk_meals": "餐别 / Meals",
+    "admin_bulk_action": "设置为 / Set To",
+    "admin_bulk_apply": "应用 / Apply",
+    "admin_bulk_success": "已更新 / Updated",
     "cookie_loading": "🔄 正在检测登录状态...",
     "tab_today": "📅 今日看板 / Daily",
     "tab_month": "📊 月度报表 / Monthly",
+    "tab_perf": "⏱️ 性能 / Performance",
+    "perf_info": "最近调用的耗时分位数 (毫秒)，每个操作保留最近 {window} 次 / Latency percentiles (ms)",
+    "perf_empty": "暂无数据 / No samples yet",
+    "perf_reset": "清零 / Reset",
     "month_sel": "选择月份 / Select Month",
     "date_label": "📅 选择报餐日期 / ရက်စွဲရွေးပါ",
     "switch_tmr_hint": "🌙 已过18点，默认显示明天 / မနက်ဖြန်စာရင်း",
@@ -134,259 +164,116 @@ TRANS = {
     "chef_people": "人 / ယောက်",
     "chef_empty": "暂无留饭 / ထမင်းချန်သူမရှိပါ",
     "user_settings": "休假设置 / Leave Settings", # New
+    "unknown_site": "未知工厂 / Unknown site",
 }
 
-# ==========================================
-# 3. 核心数据层
-# ==========================================
-conn = st.connection("gsheets", type=GSheetsConnection)
-
-def get_thai_time():
-    return datetime.now(timezone.utc) + THAILAND_OFFSET
-
-def standardize_phone(val):
-    if pd.isna(val): return ""
-    s = str(val).strip()
-    if s.endswith(".0"): s = s[:-2]
-    digits = "".join(filter(str.isdigit, s))
-    if len(digits) == 9: digits = '0' + digits
-    return digits
+# --- 厨师看板 (会话内) ---
+# 每个打开看板的会话持有一份当天汇总的副本和变更流游标，定时轮询只应用新的变更；
+# 没有新变更时不读表也不重算。换日期、变更流有缺口或副本太旧 (可能有其他进程写入) 时重建。
+
+class ChefBoard:
+    def __init__(self, date_str, cursor, rollups):
+        self.date_str = date_str
+        self.cursor = cursor
+        self.rollups = rollups  # {"Lunch": DailyRollup, "Dinner": DailyRollup}
+        self.built_at = time_lib.monotonic()
+
+    def poll(self, feed):
+        if time_lib.monotonic() - self.built_at > CACHE_MAX_STALENESS: return False
+        cursor, changes = feed.since(self.cursor)
+        if changes is None: return False
+        for kind, change in changes:
+            for rollup in self.rollups.values():
+                rollup.apply_change(kind, change)
+        self.cursor = cursor
+        return True
 
-def get_db(sheet_name):
-    try:
-        df = conn.read(worksheet=sheet_name, ttl=0)
-        if sheet_name == "users" and df.empty:
-            return pd.DataFrame(columns=["phone", "name", "reg_date", "status"])
-        if sheet_name == "orders" and df.empty:
-            return pd.DataFrame(columns=["date", "phone", "name", "meal_type", "action", "time"])
-        if 'phone' in df.columns:
-            df['phone'] = df['phone'].astype(str).apply(standardize_phone)
-        
-        # 兼容性处理：如果users表没有status列，自动补全默认值
-        if sheet_name == "users" and "status" not in df.columns:
-            df["status"] = "active"
-            
-        return df
-    except:
-        return pd.DataFrame()
-
-def write_db(sheet_name, df):
-    if 'phone' in df.columns:
-        df['phone'] = df['phone'].astype(str).apply(standardize_phone)
-    conn.update(worksheet=sheet_name, data=df)
-    st.cache_data.clear()
-
-def admin_clean_database():
-    users = get_db("users")
-    if not users.empty:
-        users = users.drop_duplicates(subset=['phone'], keep='last')
-        write_db("users", users)
-    orders = get_db("orders")
-    if not orders.empty:
-        orders = orders.drop_duplicates()
-        write_db("orders", orders)
+def get_chef_board(snap, date_str):
+    board = st.session_state.get("chef_board")
+    feed = get_change_feed()
+    if board is not None and board.date_str == date_str and board.poll(feed):
+        return board
+    # 先取游标再读汇总：期间的变更会被重复应用一次，结果不变
+    cursor = feed.head()
+    board = ChefBoard(date_str, cursor, {meal: copy_daily_rollup(snap, date_str, meal) for meal in ["Lunch", "Dinner"]})
+    st.session_state.chef_board = board
+    return board
 
 # ==========================================
-# 4. 业务逻辑
+# 5. 页面渲染
 # ==========================================
 
-def get_user_by_phone(phone):
-    df = get_db("users")
-    if df.empty: return None
-    target = standardize_phone(phone)
-    res = df[df['phone'] == target]
-    return res.iloc[0] if not res.empty else None
-
-def check_name_exist(name):
-    df = get_db("users")
-    if df.empty or 'name' not in df.columns: return False
-    clean_n = str(name).strip().lower()
-    return df['name'].astype(str).str.strip().str.lower().eq(clean_n).any()
-
-def register_new_user(phone, name):
-    df = get_db("users")
-    clean_p = standardize_phone(phone)
-    if not df.empty and clean_p in df['phone'].values: return "PHONE_EXIST"
-    if check_name_exist(name): return "NAME_EXIST"
-    
-    # 默认新用户状态为 active
-    new_user = pd.DataFrame([{
-        "phone": clean_p,
-        "name": str(name).strip(),
-        "reg_date": get_thai_time().strftime("%Y-%m-%d"),
-        "status": "active"
-    }])
-    updated = pd.concat([df, new_user], ignore_index=True)
-    write_db("users", updated)
-    return "SUCCESS"
-
-def update_user_status(phone, new_status):
-    df = get_db("users")
-    target_p = standardize_phone(phone)
-    if not df.empty:
-        # 找到对应行并更新status
-        df.loc[df['phone'] == target_p, 'status'] = new_status
-        write_db("users", df)
-        return True
-    return False
-
-# 新增：批量更新用户状态
-def batch_update_user_status(phone_list, new_status):
-    df = get_db("users")
-    if not df.empty:
-        # 清洗电话号码列表
-        clean_phones = [standardize_phone(p) for p in phone_list]
-        # 批量更新
-        df.loc[df['phone'].isin(clean_phones), 'status'] = new_status
-        write_db("users", df)
-        return True
-    return False
-
-def update_order(phone, name, meal_type, action, target_date_str):
-    df = get_db("orders")
-    target_p = standardize_phone(phone)
-    if not df.empty:
-        mask = (df['date'] == target_date_str) & (df['meal_type'] == meal_type) & (df['phone'] == target_p)
-        df = df[~mask]
-    
-    if action != "DELETE":
-        new_row = pd.DataFrame([{
-            "date": target_date_str, "phone": target_p, "name": name,
-            "meal_type": meal_type, "action": action,
-            "time": get_thai_time().strftime("%H:%M:%S")
-        }])
-        df = pd.concat([df, new_row], ignore_index=True)
-    write_db("orders", df)
-
-def get_status(phone, meal_type, target_date_str):
-    df = get_db("orders")
-    if df.empty: return None
-    target_p = standardize_phone(phone)
-    res = df[(df['date'] == target_date_str) & (df['meal_type'] == meal_type) & (df['phone'] == target_p)]
-    return res.iloc[-1]['action'] if not res.empty else None
-
-def delete_user_logic(phone):
-    df = get_db("users")
-    target = standardize_phone(phone)
-    if not df.empty:
-        updated = df[df['phone'] != target]
-        write_db("users", updated)
-
-# 核心逻辑升级：判断状态
-# 参数 user_status: 'active' 或 'leave'
-def resolve_meal_status(action, is_sun, user_status="active"):
-    # 1. 优先判断是否有手动操作记录
-    if pd.notna(action) and action is not None:
-        s_act = str(action)
-        if s_act == "CANCELED": return "NO"
-        if s_act == "DELETE": 
-            # 如果点击了撤销，回归默认状态
-            # 如果是休假，默认就是不吃；如果是正常，看是否周日
-            if user_status == 'leave': return "NO"
-            return "NO" if is_sun else "NORMAL"
-        if s_act == "BOOKED": return "NORMAL"
-        if s_act.startswith("LATE"): return s_act
-    
-    # 2. 如果没有手动记录，走默认规则
-    
-    # 如果用户在休假，默认就是不吃
-    if user_status == 'leave':
-        return "NO"
-        
-    # 如果用户正常
-    return "NO" if is_sun else "NORMAL"
-
-def calculate_monthly_stats(year, month):
-    users = get_db("users")
-    orders = get_db("orders")
-    if users.empty: return None, None
-    
-    # 填充 status 默认值
-    if 'status' not in users.columns:
-        users['status'] = 'active'
-    users['status'] = users['status'].fillna('active')
+# 片段单独重跑、按钮回调都不经过页面入口，先切换到本会话的工厂再执行
+def on_site(fn):
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        use_site(st.session_state.get("site", DEFAULT_SITE))
+        return fn(*args, **kwargs)
+    return run
+
+# 读数据的片段：整页运行时直接用页面的快照 (每张表一次运行只读一次)；片段单独重跑时页面快照
+# 已经用完 (整页运行结束时标记 done)，换一个新的，调试模式下同样检查它的读取次数
+def with_snapshot(fn):
+    @functools.wraps(fn)
+    def run(page_snap, *args, **kwargs):
+        snap = DataSnapshot() if page_snap.done else page_snap
+        result = fn(snap, *args, **kwargs)
+        if DEBUG_MODE and snap is not page_snap: snap.assert_read_budget()
+        return result
+    return run
+
+# 留饭名单来自每日汇总：休假的人如果没有手动点留饭，状态是 NO，不会出现在这里
+def show_late_groups(rollup):
+    groups = rollup.late_groups()
+    if not groups:
+        st.caption(TRANS["chef_empty"])
+    for time_slot, names in groups.items():
+        with st.container(border=True):
+            st.markdown(f"#### ⏰ {time_slot} {TRANS['chef_pickup']}")
+            st.warning(f"{TRANS['chef_total']} {len(names)} {TRANS['chef_people']}")
+            cols = st.columns(3)
+            for idx, name in enumerate(names):
+                cols[idx % 3].write(f"🏷️ **{name}**")
+
+# 厨师看板单独定时重跑，不触发整页重跑
+@st.fragment(run_every=CHEF_REFRESH_SEC)
+@on_site
+@with_snapshot
+def render_chef_board(snap, date_str):
+    start = time_lib.perf_counter()
+    board = get_chef_board(snap, date_str)
+    # --- 午餐留饭区域 ---
+    st.markdown(f"### {TRANS['chef_lunch_sec']}")
+    show_late_groups(board.rollups["Lunch"])
     
-    start_date = f"{year}-{month:02d}-01"
-    end_day = calendar.monthrange(year, month)[1]
-    end_date = f"{year}-{month:02d}-{end_day}"
+    st.markdown("---")
     
-    if not orders.empty:
-        orders['date'] = pd.to_datetime(orders['date'])
-        mask = (orders['date'] >= start_date) & (orders['date'] <= end_date)
-        month_orders = orders.loc[mask].copy()
-        month_orders['date_str'] = month_orders['date'].dt.strftime('%Y-%m-%d')
+    # --- 晚餐留饭区域 ---
+    st.markdown(f"### {TRANS['chef_dinner_sec']}")
+    show_late_groups(board.rollups["Dinner"])
+    get_metrics().observe("app.chef_board_rerun", time_lib.perf_counter() - start)
+
+# 性能面板：各操作的调用次数与耗时分位数，可导出 JSON / Prometheus 文本
+@st.fragment
+@on_site
+def render_perf_panel():
+    metrics = get_metrics()
+    rows = metrics.summary()
+    st.caption(TRANS["perf_info"].format(window=METRICS_WINDOW))
+    if not rows:
+        st.info(TRANS["perf_empty"])
     else:
-        month_orders = pd.DataFrame()
-
-    daily_stats = []
-    
-    # 为了统计，构建一个 phone -> status 的映射 (简化处理：假设整个月状态不变，或取当前最新状态)
-    user_status_map = dict(zip(users['phone'], users['status']))
-
-    for day in range(1, end_day + 1):
-        d_obj = datetime(year, month, day)
-        d_str = d_obj.strftime("%Y-%m-%d")
-        is_sun = (d_obj.weekday() == 6)
-        
-        if not month_orders.empty:
-            day_data = month_orders[month_orders['date_str'] == d_str]
-        else:
-            day_data = pd.DataFrame()
-            
-        l_eaters = 0
-        d_eaters = 0
-        
-        user_phones = users['phone'].tolist()
-        for u_p in user_phones:
-            curr_status = user_status_map.get(u_p, 'active')
-            
-            # Lunch
-            l_act = None
-            if not day_data.empty:
-                row = day_data[(day_data['meal_type'] == 'Lunch') & (day_data['phone'] == u_p)]
-                if not row.empty: l_act = row.iloc[-1]['action']
-            if resolve_meal_status(l_act, is_sun, curr_status) != "NO":
-                l_eaters += 1
-                
-            # Dinner
-            d_act = None
-            if not day_data.empty:
-                row = day_data[(day_data['meal_type'] == 'Dinner') & (day_data['phone'] == u_p)]
-                if not row.empty: d_act = row.iloc[-1]['action']
-            if resolve_meal_status(d_act, is_sun, curr_status) != "NO":
-                d_eaters += 1
-
-        daily_stats.append({"Date": d_str, "Lunch": l_eaters, "Dinner": d_eaters})
-
-    # 个人统计
-    stats_dict = {row['phone']: {'L': 0, 'D': 0, 'Name': row['name']} for _, row in users.iterrows()}
-    
-    if not month_orders.empty:
-        order_lookup = {}
-        for _, row in month_orders.iterrows():
-            order_lookup[(row['date_str'], row['phone'], row['meal_type'])] = row['action']
-            
-        for day in range(1, end_day + 1):
-            d_obj = datetime(year, month, day)
-            d_str = d_obj.strftime("%Y-%m-%d")
-            is_sun = (d_obj.weekday() == 6)
-            for p in stats_dict:
-                curr_status = user_status_map.get(p, 'active')
-                
-                act_l = order_lookup.get((d_str, p, 'Lunch'))
-                if resolve_meal_status(act_l, is_sun, curr_status) != "NO": stats_dict[p]['L'] += 1
-                
-                act_d = order_lookup.get((d_str, p, 'Dinner'))
-                if resolve_meal_status(act_d, is_sun, curr_status) != "NO": stats_dict[p]['D'] += 1
-    
-    return pd.DataFrame(daily_stats), pd.DataFrame.from_dict(stats_dict, orient='index')
-
-# ==========================================
-# 5. 页面渲染
-# ==========================================
-
-def render_login():
+        ms = ["total", "p50", "p95", "p99", "max"]
+        rows = [{k: round(v * 1000, 2) if k in ms else v for k, v in row.items()} for row in rows]
+        st.dataframe(sorted(rows, key=lambda r: -r["total"]), use_container_width=True, hide_index=True)
+    c1, c2, c3 = st.columns(3)
+    c1.download_button("JSON", metrics.to_json(), file_name="meal_metrics.json", mime="application/json")
+    c2.download_button("Prometheus", metrics.to_prometheus(), file_name="meal_metrics.prom", mime="text/plain")
+    c3.button(TRANS["perf_reset"], on_click=metrics.reset)
+
+def render_login(snap):
     st.title(TRANS["app_title"])
+    if len(SITE_CONFIGS) > 1: st.caption(f"🏭 {site_config().name}")
     with st.container(border=True):
         st.subheader(TRANS["login_title"])
         phone = st.text_input(TRANS["login_ph"], key="login_phone")
@@ -394,7 +281,7 @@ def render_login():
             if phone:
                 clean_p = standardize_phone(phone)
                 with st.spinner("Checking..."):
-                    user = get_user_by_phone(clean_p)
+                    user = get_user_by_phone(snap, clean_p)
                     if user is not None:
                         # 登录时顺便把状态存到 session
                         st.session_state.user_status = user.get('status', 'active') 
@@ -411,7 +298,7 @@ def render_login():
             if st.button(TRANS["reg_btn"], type="primary"):
                 if name:
                     with st.spinner("Registering..."):
-                        res = register_new_user(st.session_state.temp_phone, name)
+                        res = register_new_user(snap, st.session_state.temp_phone, name)
                         if res == "SUCCESS":
                             st.session_state.user_status = 'active'
                             perform_login(st.session_state.temp_phone, name)
@@ -422,14 +309,288 @@ def render_login():
                         else:
                             st.error("Error")
 
-def render_admin_panel():
+# 员工自助设置状态：独立片段。改状态会影响规则提示和两张餐卡，所以改完后整页重跑一次
+@st.fragment
+@on_site
+def render_status_settings():
+    with st.expander("⚙️ " + TRANS["user_settings"]):
+        st.write("设置我的状态 / Set My Status:")
+        
+        # 状态切换回调函数
+        @on_site
+        def on_user_status_change():
+            new_status = st.session_state.user_status_radio
+            update_user_status(DataSnapshot(), st.session_state.phone, new_status)
+            st.session_state.user_status = new_status
+            st.session_state.user_status_changed = True
+            
+        current_s = st.session_state.user_status
+        st.radio(
+            "选择状态",
+            ["active", "leave"],
+            index=0 if current_s == 'active' else 1,
+            format_func=lambda x: TRANS["admin_status_active"] if x == "active" else TRANS["admin_status_leave"],
+            horizontal=True,
+            key="user_status_radio",
+            on_change=on_user_status_change,
+            label_visibility="collapsed"
+        )
+    if st.session_state.pop("user_status_changed", False):
+        st.rerun()
+
+# 餐卡：午餐 / 晚餐各是一个独立片段，点击只重跑这一张卡。
+# 按钮用 on_click 回调写入，片段重跑时直接显示新状态；单独重跑时用自己的快照，只读状态日志 (订单走点查或缓存)
+# 留饭时段按工厂配置 (site_config().late_options)
+MEAL_CARDS = {
+    "Lunch": {"title": "lunch", "key": "l", "late_key": "lunch_late_"},
+    "Dinner": {"title": "dinner", "key": "d", "late_key": "late_"},
+}
+
+@on_site
+def click_order(meal_type, action, date_str):
+    update_order(DataSnapshot(), st.session_state.phone, st.session_state.user_name, meal_type, action, date_str)
+
+@st.fragment
+@on_site
+@with_snapshot
+def render_meal_card(snap, meal_type, date_str):
+    card = MEAL_CARDS[meal_type]
+    # 订单分区不预取：get_status 在缓存失效时 (刚点过) 用索引点查，只在缓存可用时读缓存里的这个月
+    snap.prefetch("user_status_log")
+    now = get_thai_time()
+    selected_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+    # 默认吃不吃、几点截止都来自规则日历 (周日、节假日、调休、分组)
+    is_off, deadline = get_rules_calendar().meal_rule(st.session_state.phone, date_str, meal_type)
+    day_status = get_user_status_on(snap, st.session_state.phone, date_str, st.session_state.user_status)
+    is_on_leave = (day_status == 'leave')
+
+    with st.container(border=True):
+        st.markdown(f"#### {TRANS[card['title']]}")
+        act_raw = get_status(snap, st.session_state.phone, meal_type, date_str)
+        # 传入当前用户的状态
+        current_status = resolve_meal_status(act_raw, is_off, day_status)
+        
+        if current_status == "NORMAL": st.success(TRANS["status_eat"])
+        elif current_status.startswith("LATE"): st.warning(f"{TRANS['status_late']} {current_status.split('_')[1]}")
+        else: st.error(TRANS["status_no"])
+        
+        if selected_date == now.date() and now.time() > deadline:
+            st.caption(TRANS["locked"])
+            return
+
+        key = card["key"]
+        if current_status != "NO":
+            st.button(TRANS["btn_no"], key=f"{key}_n", type="primary",
+                      on_click=click_order, args=(meal_type, "CANCELED", date_str))
+        
+        if current_status != "NORMAL":
+            # 只有在休假状态或者默认不吃的日子，或者已经点了不吃的情况下，才显示“我要吃”
+            if is_off or is_on_leave: 
+                st.button(TRANS["btn_eat"], key=f"{key}_e", type="primary",
+                          on_click=click_order, args=(meal_type, "BOOKED", date_str))
+            else: 
+                st.button(TRANS["btn_undo"], key=f"{key}_u",
+                          on_click=click_order, args=(meal_type, "DELETE", date_str))
+
+        st.markdown("---")
+        st.write(f"**{TRANS['lbl_late_title']}**")
+        late_options = site_config().late_options(meal_type)
+        cols = st.columns(len(late_options))
+        for idx, t_opt in enumerate(late_options):
+            is_active = (current_status == f"LATE_{t_opt}")
+            cols[idx].button(t_opt, key=f"{card['late_key']}{t_opt}", disabled=is_active,
+                             on_click=click_order, args=(meal_type, f"LATE_{t_opt}", date_str))
+
+# 管理员各标签页是独立片段：筛选、生成报表等操作只重跑所在的标签页，单独重跑时各自用自己的快照只读需要的表
+@st.fragment
+@on_site
+@with_snapshot
+def render_admin_today(snap, view_date_str):
+    snap.prefetch("users", order_partition(view_date_str), "user_status_log")
+    # 人数与留饭名单来自增量维护的每日汇总
+    lunch_rollup = get_daily_rollup(snap, view_date_str, "Lunch")
+    dinner_rollup = get_daily_rollup(snap, view_date_str, "Dinner")
+    master = build_admin_master(snap, view_date_str)
+    if not master.empty:
+        # 统计数字
+        k1, k2, k3 = st.columns(3)
+        # 三个数字都来自同一份汇总，按用户表的行数计 (重复电话也算)
+        k1.metric("总人数", lunch_rollup.total())
+        k2.metric("午餐", lunch_rollup.eaters())
+        k3.metric("晚餐", dinner_rollup.eaters())
+    
+        st.markdown("---")
+    
+        # --- 管理员功能区：状态管理 (修改为多选 + Form) ---
+        st.subheader(TRANS["admin_status_mgr"])
+    
+        with st.form("status_update_form"):
+            col_m1, col_m2, col_m3 = st.columns([2, 1, 1])
+        
+            user_list = master.apply(lambda x: f"{x['name']} ({x['phone']})", axis=1).tolist()
+            # 变更为多选框
+            sel_users_mgr = col_m1.multiselect("选择员工(可多选) / Select Users", user_list, key="mgr_users")
+        
+            new_status = col_m2.radio("状态 / Status", ["active", "leave"], 
+                                     format_func=lambda x: TRANS["admin_status_active"] if x == "active" else TRANS["admin_status_leave"],
+                                     key="mgr_status", label_visibility="collapsed")
+        
+            # Form submit button
+            submitted = col_m3.form_submit_button(TRANS["admin_status_update"])
+        
+            if submitted:
+                if sel_users_mgr:
+                    # 提取所有选中的电话号码
+                    target_phones = [u.split('(')[-1].replace(')', '') for u in sel_users_mgr]
+                    if batch_update_user_status(snap, target_phones, new_status):
+                        st.success(f"Updated {len(target_phones)} users to {new_status}!")
+                        time_lib.sleep(1) # Wait for propagation
+                        st.rerun()
+                else:
+                    st.warning("Please select at least one user.")
+    
+        # --- 批量改餐：全厂停餐、整条线加班留饭 ---
+        with st.expander(TRANS["admin_bulk_title"]):
+            with st.form("bulk_order_form"):
+                # 默认不选全部：选了员工就只改这些人；全部员工必须另外勾选确认
+                bulk_all = st.checkbox(TRANS["admin_bulk_all"], value=False, key="bulk_all")
+                bulk_users = st.multiselect("选择员工(可多选) / Select Users", user_list, key="bulk_users")
+                today = get_thai_time().date()
+                bulk_dates = st.date_input(TRANS["admin_bulk_dates"], value=(today, today), key="bulk_dates")
+                bulk_meals = st.multiselect(TRANS["admin_bulk_meals"], MEAL_TYPES, default=MEAL_TYPES, key="bulk_meals",
+                                            format_func=lambda m: TRANS["lunch"] if m == "Lunch" else TRANS["dinner"])
+                def format_action(a):
+                    if a.startswith("LATE"): return f"🥡 {a.split('_')[1]}"
+                    return {"CANCELED": TRANS["btn_no"], "BOOKED": TRANS["btn_eat"], "DELETE": TRANS["btn_undo"]}[a]
+                actions = list(dict.fromkeys(bulk_order_actions("Lunch") + bulk_order_actions("Dinner")))
+                bulk_action = st.selectbox(TRANS["admin_bulk_action"], actions, format_func=format_action, key="bulk_action")
+                bulk_confirm = st.checkbox(TRANS["admin_bulk_confirm_all"], value=False, key="bulk_confirm_all")
+
+                if st.form_submit_button(TRANS["admin_bulk_apply"]):
+                    # 日期范围只点了一天时返回一个元素
+                    dates = list(bulk_dates) if isinstance(bulk_dates, (list, tuple)) else [bulk_dates]
+                    # 选了员工时以选择为准，没选才看"全部员工"
+                    phones = [u.split('(')[-1].replace(')', '') for u in bulk_users] or (None if bulk_all else [])
+                    try:
+                        if not dates: raise ValueError(TRANS["admin_bulk_dates"])
+                        if phones == []: raise ValueError(TRANS["admin_bulk_need_users"])
+                        if phones is None and not bulk_confirm: raise ValueError(TRANS["admin_bulk_need_confirm"])
+                        n = bulk_update_orders(snap, phones, bulk_meals, bulk_action,
+                                               dates[0].strftime("%Y-%m-%d"), dates[-1].strftime("%Y-%m-%d"))
+                    except ValueError as e:
+                        st.error(str(e))
+                    else:
+                        st.success(f"{TRANS['admin_bulk_success']}: {n}")
+                        time_lib.sleep(1)
+                        st.rerun()
+
+        st.markdown("---")
+
+        # 删除用户逻辑
+        with st.expander("🗑️ 删除用户 / Delete User"):
+            sel_user_del = st.selectbox("选择用户", ["Select..."] + user_list, key="del_user")
+            if st.button("Confirm Delete", type="primary"):
+                if sel_user_del != "Select...":
+                    target_p = sel_user_del.split('(')[-1].replace(')', '')
+                    delete_user_logic(snap, target_p)
+                    st.success("Deleted")
+                    st.rerun()
+    
+        # 列表显示 (增加状态图标)
+        display_df = master.copy()
+        def format_status(s):
+            if s == "NORMAL": return "✅ 吃"
+            if s == "NO": return "❌ 不吃"
+            if s.startswith("LATE"): return f"🥡 {s.split('_')[1]}"
+            return s
+    
+        # 增加状态图标列
+        display_df['St'] = display_df['status'].apply(lambda x: "🟢" if x == 'active' else "🔴")
+        display_df['L_Display'] = display_df['L_Status'].apply(format_status)
+        display_df['D_Display'] = display_df['D_Status'].apply(format_status)
+
+        st.dataframe(
+            display_df[['St', 'name', 'phone', 'L_Display', 'D_Display']].rename(
+                columns={'St': '状态', 'name': '姓名', 'phone': '电话', 'L_Display': TRANS['lunch'], 'D_Display': TRANS['dinner']}
+            ), 
+            use_container_width=True, 
+            hide_index=True
+        )
+    else:
+        st.info("No data.")
+
+@st.fragment
+@on_site
+@with_snapshot
+def render_admin_month(snap):
+    # 月报逻辑已在 calculate_monthly_stats 中更新
+    now = get_thai_time()
+    c_m1, c_m2 = st.columns(2)
+    sel_year = c_m1.number_input("Year", min_value=2024, max_value=2030, value=now.year)
+    sel_month = c_m2.number_input("Month", min_value=1, max_value=12, value=now.month)
+    if st.button("Generate Report"):
+        with st.spinner("Calculating..."):
+            daily_df, person_df = get_monthly_stats(snap, sel_year, sel_month)
+            if daily_df is not None:
+                st.bar_chart(daily_df.set_index("Date")[["Lunch", "Dinner"]])
+                person_df = person_df.reset_index().rename(columns={'index': 'Phone'})
+                person_df['Phone'] = person_df['Phone'].astype(str)
+                st.dataframe(person_df[['Name', 'Phone', 'L', 'D']], use_container_width=True, hide_index=True)
+            else:
+                st.warning("No Data")
+
+    # 封存 (冷归档) 已结账的月份
+    sel_table = order_partition(f"{sel_year:04d}-{sel_month:02d}")
+    if sel_table in get_backend().sealed_months():
+        st.caption(f"{TRANS['admin_sealed_info']} · sha256 {get_backend().sealed_months()[sel_table][:12]}")
+    elif st.button(TRANS["admin_seal_month"]):
+        with st.spinner("Processing..."):
+            try:
+                sealed = seal_order_month(snap, sel_year, sel_month)
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                if sealed is None:
+                    st.warning(TRANS["admin_seal_open_month"])
+                else:
+                    st.success(f"{TRANS['admin_seal_success']}: {sealed[0]} rows · sha256 {sealed[1][:12]}")
+
+    # 多月工资导出：点下载时才逐月计算并分块写出 (已算过 / 已封存的月份直接复用月报结果)
+    st.markdown(f"**{TRANS['admin_export_title']}**")
+    months = [f"{y:04d}-{m:02d}" for y in range(2024, now.year + 1) for m in range(1, 13) if (y, m) <= (now.year, now.month)]
+    c_e1, c_e2 = st.columns(2)
+    exp_start = c_e1.selectbox(TRANS["admin_export_from"], months, index=max(len(months) - 3, 0), key="export_start")
+    exp_end = c_e2.selectbox(TRANS["admin_export_to"], months, index=len(months) - 1, key="export_end")
+    c_e3, c_e4 = st.columns(2)
+    exp_kind = c_e3.radio(TRANS["admin_export_kind"], list(EXPORT_KINDS), key="export_kind", horizontal=True,
+                          format_func=lambda k: TRANS[f"admin_export_{k}"])
+    exp_fmt = c_e4.radio(TRANS["admin_export_format"], list(EXPORT_FORMATS), key="export_format", horizontal=True,
+                         format_func=str.upper)
+    try:
+        export_months(exp_start, exp_end)
+    except ValueError as e:
+        st.error(str(e))
+    else:
+        @bind_site
+        def build_export():
+            chunks = export_report(DataSnapshot(overlay_pending=False), exp_kind, exp_start, exp_end, exp_fmt)
+            out = io.BytesIO()
+            for chunk in chunks:
+                out.write(chunk)
+            out.seek(0)
+            return out
+        st.download_button(TRANS["admin_export_download"], data=build_export,
+                           file_name=f"meal_{exp_kind}_{exp_start}_{exp_end}.{exp_fmt}", mime=EXPORT_FORMATS[exp_fmt])
+
+def render_admin_panel(snap):
     st.markdown("---")
     with st.expander(TRANS["admin_entry"]):
-        if not st.session_state.get('admin_authed', False):
+        # 登录只对当前工厂有效，每个工厂用自己的管理员密码
+        if st.session_state.get('admin_authed') != site:
             pin = st.text_input("PIN", type="password")
             if st.button(TRANS["admin_login"]):
-                if pin == ADMIN_PIN:
-                    st.session_state.admin_authed = True
+                if pin == site_config().admin_pin:
+                    st.session_state.admin_authed = site
                     st.rerun()
                 else:
                     st.error("Error")
@@ -437,189 +598,78 @@ def render_admin_panel():
             c1, c2 = st.columns([3, 1])
             with c1: st.write("### " + TRANS["app_title"])
             with c2: 
-                if st.button(TRANS["refresh"]): st.cache_data.clear(); st.rerun()
+                if st.button(TRANS["refresh"]): on_data_changed(); st.rerun()
             
             if st.button(TRANS["admin_clean"], type="secondary"):
                 with st.spinner("Processing..."):
-                    admin_clean_database()
+                    admin_clean_database(snap)
                     st.success(TRANS["admin_clean_success"])
                     time_lib.sleep(1)
                     st.rerun()
+
+            if not get_backend().phones_canonical():
+                if st.button(TRANS["admin_migrate_phones"], type="secondary"):
+                    with st.spinner("Processing..."):
+                        migrate_canonical_phones(snap)
+                        st.success(TRANS["admin_migrate_success"])
+                        time_lib.sleep(1)
+                        st.rerun()
+
+            if not get_backend().partitioned():
+                if st.button(TRANS["admin_partition_orders"], type="secondary"):
+                    with st.spinner("Processing..."):
+                        migrate_order_partitions(snap)
+                        st.success(TRANS["admin_partition_success"])
+                        time_lib.sleep(1)
+                        st.rerun()
             
-            # 1. 优先加载数据
             view_date = st.date_input("查看日期 / View Date", value=get_thai_time().date(), key="admin_date")
             view_date_str = view_date.strftime("%Y-%m-%d")
-
-            users = get_db("users")
-            orders = get_db("orders")
-
-            if users.empty:
+            no_users = snap.users.empty
+            if no_users:
                 st.warning("暂无用户数据 / No User Data")
-                master = pd.DataFrame(columns=['name', 'phone', 'L_Status', 'D_Status', 'status'])
-            else:
-                master = users.copy()
-                master['phone'] = master['phone'].astype(str).apply(standardize_phone)
-                # 确保 status 存在
-                if 'status' not in master.columns:
-                    master['status'] = 'active'
-                master['status'] = master['status'].fillna('active')
-                
-                l_map = {}
-                d_map = {}
-                if not orders.empty:
-                    today_orders = orders[orders['date'] == view_date_str]
-                    for _, r in today_orders.iterrows():
-                        if r['meal_type'] == 'Lunch': l_map[standardize_phone(r['phone'])] = r['action']
-                        if r['meal_type'] == 'Dinner': d_map[standardize_phone(r['phone'])] = r['action']
-
-                is_sun_view = (view_date.weekday() == 6)
-                
-                # 应用新的解析逻辑，传入 status
-                master['L_Status'] = master.apply(lambda r: resolve_meal_status(l_map.get(r['phone']), is_sun_view, r['status']), axis=1)
-                master['D_Status'] = master.apply(lambda r: resolve_meal_status(d_map.get(r['phone']), is_sun_view, r['status']), axis=1)
 
-            # 2. 定义标签页
-            tab1, tab2, tab3 = st.tabs([TRANS["tab_today"], TRANS["tab_month"], TRANS["chef_view"]])
+            tab1, tab2, tab3, tab4 = st.tabs([TRANS["tab_today"], TRANS["tab_month"], TRANS["chef_view"], TRANS["tab_perf"]])
             
             # --- Tab 1: 原始列表 ---
             with tab1:
-                if not master.empty:
-                    # 统计数字
-                    k1, k2, k3 = st.columns(3)
-                    k1.metric("总人数", len(master))
-                    k2.metric("午餐", len(master[master['L_Status'] != 'NO']))
-                    k3.metric("晚餐", len(master[master['D_Status'] != 'NO']))
-                    
-                    st.markdown("---")
-                    
-                    # --- 管理员功能区：状态管理 (修改为多选 + Form) ---
-                    st.subheader(TRANS["admin_status_mgr"])
-                    
-                    with st.form("status_update_form"):
-                        col_m1, col_m2, col_m3 = st.columns([2, 1, 1])
-                        
-                        user_list = master.apply(lambda x: f"{x['name']} ({x['phone']})", axis=1).tolist()
-                        # 变更为多选框
-                        sel_users_mgr = col_m1.multiselect("选择员工(可多选) / Select Users", user_list, key="mgr_users")
-                        
-                        new_status = col_m2.radio("状态 / Status", ["active", "leave"], 
-                                                 format_func=lambda x: TRANS["admin_status_active"] if x == "active" else TRANS["admin_status_leave"],
-                                                 key="mgr_status", label_visibility="collapsed")
-                        
-                        # Form submit button
-                        submitted = col_m3.form_submit_button(TRANS["admin_status_update"])
-                        
-                        if submitted:
-                            if sel_users_mgr:
-                                # 提取所有选中的电话号码
-                                target_phones = [u.split('(')[-1].replace(')', '') for u in sel_users_mgr]
-                                if batch_update_user_status(target_phones, new_status):
-                                    st.success(f"Updated {len(target_phones)} users to {new_status}!")
-                                    time_lib.sleep(1) # Wait for propagation
-                                    st.rerun()
-                            else:
-                                st.warning("Please select at least one user.")
-                    
-                    st.markdown("---")
-
-                    # 删除用户逻辑
-                    with st.expander("🗑️ 删除用户 / Delete User"):
-                        sel_user_del = st.selectbox("选择用户", ["Select..."] + user_list, key="del_user")
-                        if st.button("Confirm Delete", type="primary"):
-                            if sel_user_del != "Select...":
-                                target_p = sel_user_del.split('(')[-1].replace(')', '')
-                                delete_user_logic(target_p)
-                                st.success("Deleted")
-                                st.rerun()
-                    
-                    # 列表显示 (增加状态图标)
-                    display_df = master.copy()
-                    def format_status(s):
-                        if s == "NORMAL": return "✅ 吃"
-                        if s == "NO": return "❌ 不吃"
-                        if s.startswith("LATE"): return f"🥡 {s.split('_')[1]}"
-                        return s
-                    
-                    # 增加状态图标列
-                    display_df['St'] = display_df['status'].apply(lambda x: "🟢" if x == 'active' else "🔴")
-                    display_df['L_Display'] = display_df['L_Status'].apply(format_status)
-                    display_df['D_Display'] = display_df['D_Status'].apply(format_status)
-
-                    st.dataframe(
-                        display_df[['St', 'name', 'phone', 'L_Display', 'D_Display']].rename(
-                            columns={'St': '状态', 'name': '姓名', 'phone': '电话', 'L_Display': TRANS['lunch'], 'D_Display': TRANS['dinner']}
-                        ), 
-                        use_container_width=True, 
-                        hide_index=True
-                    )
-                else:
-                    st.info("No data.")
+                render_admin_today(snap, view_date_str)
 
             # --- Tab 2: 月报 ---
             with tab2:
-                # 月报逻辑已在 calculate_monthly_stats 中更新
-                now = get_thai_time()
-                c_m1, c_m2 = st.columns(2)
-                sel_year = c_m1.number_input("Year", min_value=2024, max_value=2030, value=now.year)
-                sel_month = c_m2.number_input("Month", min_value=1, max_value=12, value=now.month)
-                if st.button("Generate Report"):
-                    with st.spinner("Calculating..."):
-                        daily_df, person_df = calculate_monthly_stats(sel_year, sel_month)
-                        if daily_df is not None:
-                            st.bar_chart(daily_df.set_index("Date")[["Lunch", "Dinner"]])
-                            person_df = person_df.reset_index().rename(columns={'index': 'Phone'})
-                            person_df['Phone'] = person_df['Phone'].astype(str)
-                            st.dataframe(person_df[['Name', 'Phone', 'L', 'D']], use_container_width=True, hide_index=True)
-                        else:
-                            st.warning("No Data")
+                render_admin_month(snap)
 
             # --- Tab 3: 厨师看板 ---
             with tab3:
                 st.subheader(f"{TRANS['chef_view_title']} ({view_date_str})")
                 
-                if master.empty:
+                if no_users:
                      st.info(TRANS["chef_empty"])
                 else:
-                    # 厨师看板逻辑与之前一致，因为 master 中的 L_Status 已经通过 resolve_meal_status 处理了休假逻辑
-                    # (即休假的人如果没有手动点留饭，L_Status 是 NO，不会出现在这里)
-                    
-                    # --- 午餐留饭区域 ---
-                    st.markdown(f"### {TRANS['chef_lunch_sec']}")
-                    lunch_late_people = master[master['L_Status'].str.startswith("LATE")]
-                    if lunch_late_people.empty:
-                        st.caption(TRANS["chef_empty"])
-                    else:
-                        lunch_late_people['Time'] = lunch_late_people['L_Status'].apply(lambda x: x.split('_')[1] if '_' in x else 'Unknown')
-                        l_grouped = lunch_late_people.groupby('Time')
-                        for time_slot, group in l_grouped:
-                            with st.container(border=True):
-                                st.markdown(f"#### ⏰ {time_slot} {TRANS['chef_pickup']}")
-                                st.warning(f"{TRANS['chef_total']} {len(group)} {TRANS['chef_people']}")
-                                cols = st.columns(3)
-                                for idx, (_, row) in enumerate(group.iterrows()):
-                                    cols[idx % 3].write(f"🏷️ **{row['name']}**")
-                    
-                    st.markdown("---")
-                    
-                    # --- 晚餐留饭区域 ---
-                    st.markdown(f"### {TRANS['chef_dinner_sec']}")
-                    dinner_late_people = master[master['D_Status'].str.startswith("LATE")]
-                    if dinner_late_people.empty:
-                        st.caption(TRANS["chef_empty"])
-                    else:
-                        dinner_late_people['Time'] = dinner_late_people['D_Status'].apply(lambda x: x.split('_')[1] if '_' in x else 'Unknown')
-                        d_grouped = dinner_late_people.groupby('Time')
-                        for time_slot, group in d_grouped:
-                            with st.container(border=True):
-                                st.markdown(f"#### ⏰ {time_slot} {TRANS['chef_pickup']}")
-                                st.warning(f"{TRANS['chef_total']} {len(group)} {TRANS['chef_people']}")
-                                cols = st.columns(3)
-                                for idx, (_, row) in enumerate(group.iterrows()):
-                                    cols[idx % 3].write(f"🏷️ **{row['name']}**")
+                    render_chef_board(snap, view_date_str)
+
+            # --- Tab 4: 性能 ---
+            with tab4:
+                render_perf_panel()
 
 # ==========================================
 # 6. 程序入口与 Cookie
 # ==========================================
+# 整页重跑计时 (被 st.rerun() / st.stop() 打断的重跑不计入)
+rerun_started = time_lib.perf_counter()
+
+# 多工厂：?site= 参数或访问的域名决定本会话的工厂，之后所有读写都在该工厂的存储和缓存里
+try:
+    site = resolve_site(st.query_params.get("site"), st.context.headers.get("host"))
+except KeyError:
+    st.error(f"{TRANS['unknown_site']}: {st.query_params.get('site')}")
+    st.stop()
+use_site(site)
+st.session_state.site = site
+# 同一个浏览器可能登录多个工厂：每个工厂各用一个登录 Cookie
+AUTH_COOKIE = "auth_phone" if site == DEFAULT_SITE else f"auth_phone_{site}"
+start_order_compactor()
+
 cookie_manager = stx.CookieManager(key="meal_app_auth")
 cookies = cookie_manager.get_all()
 
@@ -627,20 +677,25 @@ def perform_login(phone, name):
     st.session_state.phone = phone
     st.session_state.user_name = name
     # 1. Cookie
-    cookie_manager.set("auth_phone", phone, expires_at=datetime.now() + timedelta(days=30))
+    cookie_manager.set(AUTH_COOKIE, phone, expires_at=datetime.now() + timedelta(days=30))
     # 2. URL 参数
     st.query_params["phone"] = phone
     st.rerun()
 
 def perform_logout():
-    cookie_manager.delete("auth_phone")
+    cookie_manager.delete(AUTH_COOKIE)
     st.session_state.phone = None
     st.session_state.user_name = None
     st.session_state.user_status = None # 清理状态
     st.session_state.admin_authed = False
     st.query_params.clear()
+    if site != DEFAULT_SITE: st.query_params["site"] = site
     st.rerun()
 
+# 本次运行的数据快照，页面各处 (包括本次运行里的片段) 共用
+snap = DataSnapshot()
+snap.done = False
+
 if 'phone' not in st.session_state:
     st.session_state.phone = None
 if 'user_name' not in st.session_state:
@@ -652,12 +707,12 @@ if 'user_status' not in st.session_state:
 if not st.session_state.phone:
     qp = st.query_params
     url_phone = qp.get("phone", None)
-    cookie_phone = cookies.get("auth_phone") if cookies else None
+    cookie_phone = cookies.get(AUTH_COOKIE) if cookies else None
     
     target = url_phone if url_phone else cookie_phone
     
     if target:
-        user = get_user_by_phone(target)
+        user = get_user_by_phone(snap, target)
         if user is not None:
             st.session_state.phone = user['phone']
             st.session_state.user_name = user['name']
@@ -665,7 +720,7 @@ if not st.session_state.phone:
             st.session_state.user_status = user.get('status', 'active')
             
             if not url_phone: st.query_params["phone"] = user['phone']
-            if not cookie_phone: cookie_manager.set("auth_phone", user['phone'], expires_at=datetime.now() + timedelta(days=30))
+            if not cookie_phone: cookie_manager.set(AUTH_COOKIE, user['phone'], expires_at=datetime.now() + timedelta(days=30))
             st.rerun()
 
 # --- 渲染路由 ---
@@ -676,7 +731,7 @@ if st.session_state.phone:
     c1, c2 = st.columns([3, 1])
     with c1:
         st.write(f"👋 {TRANS['welcome']}, **{st.session_state.user_name}**")
-        st.caption(f"📱 {st.session_state.phone}")
+        st.caption(f"📱 {st.session_state.phone}" + (f" · 🏭 {site_config().name}" if len(SITE_CONFIGS) > 1 else ""))
         # 显示休假状态
         if st.session_state.user_status == 'leave':
              st.warning(f"**{TRANS['leave_head']}**")
@@ -684,33 +739,12 @@ if st.session_state.phone:
         if st.button(TRANS["logout"]): perform_logout()
     
     # --- 新增：员工自助设置状态 ---
-    with st.expander("⚙️ " + TRANS["user_settings"]):
-        st.write("设置我的状态 / Set My Status:")
-        
-        # 状态切换回调函数
-        def on_user_status_change():
-            new_status = st.session_state.user_status_radio
-            update_user_status(st.session_state.phone, new_status)
-            st.session_state.user_status = new_status
-            
-        current_s = st.session_state.user_status
-        st.radio(
-            "选择状态",
-            ["active", "leave"],
-            index=0 if current_s == 'active' else 1,
-            format_func=lambda x: TRANS["admin_status_active"] if x == "active" else TRANS["admin_status_leave"],
-            horizontal=True,
-            key="user_status_radio",
-            on_change=on_user_status_change,
-            label_visibility="collapsed"
-        )
-    # -----------------------------
+    render_status_settings()
 
     st.markdown(f'<div class="link-box">{TRANS["ios_alert"]}</div>', unsafe_allow_html=True)
     st.markdown("---")
     
     now = get_thai_time()
-    current_time = now.time()
     
     default_date = now.date()
     if now.hour >= AUTO_SWITCH_HOUR:
@@ -719,105 +753,37 @@ if st.session_state.phone:
         
     selected_date = st.date_input(TRANS["date_label"], value=default_date)
     selected_date_str = selected_date.strftime("%Y-%m-%d")
+    snap.prefetch("user_status_log")
     
-    is_sun = (selected_date.weekday() == 6)
-    is_on_leave = (st.session_state.user_status == 'leave')
+    rules = get_rules_calendar()
+    is_off_day = all(rules.meal_rule(st.session_state.phone, selected_date_str, meal)[0] for meal in ["Lunch", "Dinner"])
+    # 所选日期当天生效的状态 (查看过去的日期时不受之后改状态的影响)
+    day_status = get_user_status_on(snap, st.session_state.phone, selected_date_str, st.session_state.user_status)
     
     # 动态显示规则提示
-    if is_on_leave:
+    if day_status == 'leave':
         st.warning(TRANS["leave_rule"])
     else:
-        rule_title = TRANS["sun_head"] if is_sun else TRANS["wd_head"]
-        rule_msg = TRANS["sun_rule"] if is_sun else TRANS["wd_rule"]
+        if not is_off_day: rule_title = TRANS["wd_head"]
+        else: rule_title = TRANS["sun_head"] if selected_date.weekday() == 6 else TRANS["off_head"]
+        rule_msg = TRANS["sun_rule"] if is_off_day else TRANS["wd_rule"]
         st.info(f"**{rule_title}**\n\n{rule_msg}")
     
-    is_today_selected = (selected_date == now.date())
     col1, col2 = st.columns(2)
-    
-    # --- 午餐逻辑 ---
-    with col1:
-        with st.container(border=True):
-            st.markdown(f"#### {TRANS['lunch']}")
-            act_raw = get_status(st.session_state.phone, "Lunch", selected_date_str)
-            # 传入当前用户的状态
-            current_status = resolve_meal_status(act_raw, is_sun, st.session_state.user_status)
-            
-            if current_status == "NORMAL": st.success(TRANS["status_eat"])
-            elif current_status.startswith("LATE"): st.warning(f"{TRANS['status_late']} {current_status.split('_')[1]}")
-            else: st.error(TRANS["status_no"])
-            
-            is_locked = False
-            if is_today_selected and current_time > LUNCH_DEADLINE:
-                is_locked = True
-                
-            if is_locked:
-                st.caption(TRANS["locked"])
-            else:
-                if current_status != "NO":
-                     if st.button(TRANS["btn_no"], key="l_n", type="primary"): update_order(st.session_state.phone, st.session_state.user_name, "Lunch", "CANCELED", selected_date_str); st.rerun()
-                
-                if current_status != "NORMAL":
-                    # 只有在休假状态或者周日，或者已经点了不吃的情况下，才显示“我要吃”
-                    if is_sun or is_on_leave: 
-                        if st.button(TRANS["btn_eat"], key="l_e", type="primary"): update_order(st.session_state.phone, st.session_state.user_name, "Lunch", "BOOKED", selected_date_str); st.rerun()
-                    else: 
-                        if st.button(TRANS["btn_undo"], key="l_u"): update_order(st.session_state.phone, st.session_state.user_name, "Lunch", "DELETE", selected_date_str); st.rerun()
-
-                st.markdown("---")
-                st.write(f"**{TRANS['lbl_late_title']}**")
-                cols = st.columns(len(LUNCH_LATE_OPTIONS))
-                for idx, t_opt in enumerate(LUNCH_LATE_OPTIONS):
-                    is_active = (current_status == f"LATE_{t_opt}")
-                    if cols[idx].button(t_opt, key=f"lunch_late_{t_opt}", disabled=is_active):
-                         update_order(st.session_state.phone, st.session_state.user_name, "Lunch", f"LATE_{t_opt}", selected_date_str)
-                         st.rerun()
-
-    # --- 晚餐逻辑 ---
-    with col2:
-        with st.container(border=True):
-            st.markdown(f"#### {TRANS['dinner']}")
-            act_raw = get_status(st.session_state.phone, "Dinner", selected_date_str)
-            current_status = resolve_meal_status(act_raw, is_sun, st.session_state.user_status)
-            
-            if current_status == "NORMAL": st.success(TRANS["status_eat"])
-            elif current_status.startswith("LATE"): st.warning(f"{TRANS['status_late']} {current_status.split('_')[1]}")
-            else: st.error(TRANS["status_no"])
-            
-            is_locked = False
-            if is_today_selected and current_time > DINNER_DEADLINE:
-                is_locked = True
-            
-            if is_locked:
-                st.caption(TRANS["locked"])
-            else:
-                if current_status != "NO":
-                    if st.button(TRANS["btn_no"], key="d_n", type="primary"): 
-                        update_order(st.session_state.phone, st.session_state.user_name, "Dinner", "CANCELED", selected_date_str)
-                        st.rerun()
-                
-                if current_status != "NORMAL":
-                     if is_sun or is_on_leave:
-                         if st.button(TRANS["btn_eat"], key="d_e"): 
-                             update_order(st.session_state.phone, st.session_state.user_name, "Dinner", "BOOKED", selected_date_str)
-                             st.rerun()
-                     else:
-                         if st.button(TRANS["btn_undo"], key="d_u"): 
-                             update_order(st.session_state.phone, st.session_state.user_name, "Dinner", "DELETE", selected_date_str)
-                             st.rerun()
-
-                st.markdown("---")
-                st.write(f"**{TRANS['lbl_late_title']}**")
-                cols = st.columns(len(DINNER_LATE_OPTIONS))
-                for idx, t_opt in enumerate(DINNER_LATE_OPTIONS):
-                    is_active = (current_status == f"LATE_{t_opt}")
-                    if cols[idx].button(t_opt, key=f"late_{t_opt}", disabled=is_active):
-                         update_order(st.session_state.phone, st.session_state.user_name, "Dinner", f"LATE_{t_opt}", selected_date_str)
-                         st.rerun()
+    with col1: render_meal_card(snap, "Lunch", selected_date_str)
+    with col2: render_meal_card(snap, "Dinner", selected_date_str)
 
     st.markdown("---")
     with st.expander(TRANS["help_title"]): st.info(TRANS["help_txt"])
-    render_admin_panel()
+    render_admin_panel(snap)
 
 else:
-    render_login()
-    render_admin_panel()
+    render_login(snap)
+    render_admin_panel(snap)
+
+get_metrics().observe("app.rerun", time_lib.perf_counter() - rerun_started)
+
+# 之后片段单独重跑时不再用这个快照
+snap.done = True
+if DEBUG_MODE:
+    snap.assert_read_budget()
@@ -0,0 +1,251 @@
+# 性能测量脚本
+#   python bench.py suite [--users 100,1000,5000] [--months 3] [--density 0.3] [--repeats 5] [--latency-ms 0]
+#     热点操作基准：合成工厂数据 + 内存版 GSheetsConnection，按员工规模报告每个操作的耗时、
+#     内存峰值以及对表格的读写次数和字节数。
+#   python bench.py coldstart [--runs 5]
+#     冷启动：新进程导入核心模块的耗时，以及报表服务 / Streamlit 页面从启动进程到返回第一个字节的时间。
+#     在放有 .streamlit/secrets.toml 的目录下运行，子进程使用同一份配置。
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from collections import Counter
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+import core
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# --- 合成工厂数据 ---
+# users 个员工、最近 months 个月 (含本月)，每人每天每餐以 density 的概率点过一次。
+# 动作比例接近真实情况：平日多是不吃 / 留饭，周日多是我要吃，休假的人点的基本是我要吃 / 留饭；
+# leave_rate 的人当前在休假，并在窗口内某天开始休假 (状态变更日志里有记录)。
+
+def synthetic_factory(users=1000, months=3, density=0.3, leave_rate=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    today = core.get_thai_time().date()
+    first = (pd.Timestamp(today).to_period("M") - (months - 1)).start_time
+    days = pd.date_range(first, pd.Timestamp(today).to_period("M").end_time.normalize(), freq="D")
+
+    phones = np.array([f"08{i:08d}" for i in range(users)], dtype=object)
+    on_leave = rng.random(users) < leave_rate
+    users_df = pd.DataFrame({
+        "phone": phones,
+        "name": [f"Worker {i:05d}" for i in range(users)],
+        "reg_date": first.strftime("%Y-%m-%d"),
+        "status": np.where(on_leave, "leave", "active"),
+    })
+
+    leave_from = days[rng.integers(0, len(days), users)].strftime("%Y-%m-%d").to_numpy()
+    leavers = np.flatnonzero(on_leave)
+    log_df = pd.DataFrame({
+        "phone": np.concatenate([phones[leavers], phones[leavers]]),
+        "status": ["active"] * len(leavers) + ["leave"] * len(leavers),
+        "effective_from": np.concatenate([[core.STATUS_BASELINE_DATE] * len(leavers), leave_from[leavers]]),
+    })
+
+    clicked = np.flatnonzero(rng.random(users * len(days) * 2) < density)
+    user_idx, rest = np.divmod(clicked, len(days) * 2)
+    day_idx, meal_idx = np.divmod(rest, 2)
+    sunday = np.asarray(days.weekday == 6)[day_idx]
+    leave_day = on_leave[user_idx] & (days.strftime("%Y-%m-%d").to_numpy()[day_idx] >= leave_from[user_idx])
+    late = np.where(meal_idx == 0,
+                    rng.choice([f"LATE_{t}" for t in core.LUNCH_LATE_OPTIONS], len(clicked)),
+                    rng.choice([f"LATE_{t}" for t in core.DINNER_LATE_OPTIONS], len(clicked)))
+    roll = rng.random(len(clicked))
+    action = np.select(
+        [~sunday & ~leave_day & (roll < 0.6), ~sunday & ~leave_day & (roll < 0.9),
+         (sunday | leave_day) & (roll < 0.7), (sunday | leave_day) & (roll < 0.9)],
+        ["CANCELED", late, "BOOKED", late],
+        default=np.where(sunday | leave_day, "CANCELED", "BOOKED"))
+    orders_df = pd.DataFrame({
+        "date": days.strftime("%Y-%m-%d").to_numpy()[day_idx],
+        "phone": phones[user_idx],
+        "name": users_df["name"].to_numpy()[user_idx],
+        "meal_type": np.where(meal_idx == 0, "Lunch", "Dinner"),
+        "action": action,
+        "time": [f"{h:02d}:{m:02d}:00" for h, m in zip(rng.integers(6, 18, len(clicked)), rng.integers(0, 60, len(clicked)))],
+    })
+    return {"users": users_df, "orders": orders_df, "user_status_log": log_df}
+
+# --- 内存版 GSheetsConnection ---
+# 只实现页面用到的 read / update (没有 client 属性，后端自动走 update 整表写入的路径)。
+# 记录每种调用的次数和传输的数据量 (按 DataFrame 内存大小估算)，用来比较不同实现的读写放大。
+# latency 秒模拟每次调用的网络往返。
+
+class FakeGSheetsConnection:
+    def __init__(self, sheets, latency=0.0):
+        self.sheets = {name: df.copy() for name, df in sheets.items()}
+        self.latency = latency
+        self.calls = Counter()
+        self.bytes = Counter()
+
+    def read(self, worksheet=None, ttl=None, dtype=None, **kwargs):
+        time.sleep(self.latency)
+        self.calls["read"] += 1
+        if worksheet not in self.sheets:
+            raise KeyError(f"worksheet not found: {worksheet}")
+        df = self.sheets[worksheet].copy()
+        self.bytes["read"] += int(df.memory_usage(deep=True).sum())
+        return df
+
+    def update(self, worksheet=None, data=None, **kwargs):
+        time.sleep(self.latency)
+        self.calls["update"] += 1
+        self.bytes["update"] += int(data.memory_usage(deep=True).sum())
+        self.sheets[worksheet] = data.reset_index(drop=True).copy()
+        return data
+
+# --- 基准套件 ---
+
+RESOURCES = [core.get_cache, core.get_rollups, core.get_user_directories, core.get_change_feed,
+             core.get_timeline_memo, core.get_write_queue, core.get_month_stats]
+
+def install(sheets, latency=0.0):
+    # 用假的连接替换后端，并清空所有进程级缓存，保证每个规模互不影响
+    core.configure({"STORAGE_BACKEND": "gsheets", "ARCHIVE_DIR": tempfile.mkdtemp(prefix="meal_bench_")})
+    conn = FakeGSheetsConnection(sheets, latency)
+    core.get_backend.set(core.GSheetsBackend(conn, archive=core.OrderArchive(core.ARCHIVE_DIR)))
+    for get in RESOURCES:
+        get.clear()
+    return conn
+
+def measure(conn, op, repeats):
+    # 先预热一次 (把数据读进共享缓存)，再计时；最后单独跑一次 tracemalloc 测内存峰值
+    op(0)
+    samples = []
+    before_calls, before_bytes = conn.calls.copy(), conn.bytes.copy()
+    for i in range(repeats):
+        start = time.perf_counter()
+        op(i + 1)
+        samples.append(time.perf_counter() - start)
+    calls = sum((conn.calls - before_calls).values()) / repeats
+    moved = sum((conn.bytes - before_bytes).values()) / repeats
+    tracemalloc.start()
+    op(repeats + 1)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(samples), peak, calls, moved
+
+def suite(sizes, months, density, repeats, latency=0.0):
+    print(f"{'users':>6}  {'operation':<22} {'median ms':>10} {'peak MB':>9} {'sheet calls':>12} {'sheet MB':>9}")
+    for users in sizes:
+        sheets = synthetic_factory(users, months, density)
+        conn = install(sheets, latency)
+        today = core.get_thai_time().date()
+        today_str = today.strftime("%Y-%m-%d")
+        tomorrow_str = (today + timedelta(days=1)).strftime("%Y-%m-%d")
+        phones = sheets["users"]["phone"].tolist()
+
+        def get_status_warm(i):
+            core.get_status(core.DataSnapshot(), phones[i % users], "Lunch", today_str)
+
+        def get_status_cold(i):
+            core.on_data_changed()
+            core.get_status(core.DataSnapshot(), phones[i % users], "Lunch", today_str)
+
+        def update_order(i):
+            core.update_order(core.DataSnapshot(), phones[i % users], "Worker", "Dinner", "LATE_19:00", tomorrow_str)
+
+        def admin_master(i):
+            core.build_admin_master(core.DataSnapshot(), today_str)
+
+        def admin_master_cold(i):
+            core.on_data_changed()
+            core.build_admin_master(core.DataSnapshot(), today_str)
+
+        def monthly_stats(i):
+            core.calculate_monthly_stats(core.DataSnapshot(), today.year, today.month)
+
+        def clean_database(i):
+            core.admin_clean_database(core.DataSnapshot())
+
+        for name, op in [("get_status (warm)", get_status_warm), ("get_status (cold)", get_status_cold),
+                         ("update_order", update_order), ("admin master", admin_master),
+                         ("admin master (cold)", admin_master_cold),
+                         ("calculate_monthly_stats", monthly_stats), ("admin_clean_database", clean_database)]:
+            median, peak, calls, moved = measure(conn, op, repeats)
+            print(f"{users:>6}  {name:<22} {median * 1000:>10.2f} {peak / 2**20:>9.2f} {calls:>12.1f} {moved / 2**20:>9.2f}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def import_time(module):
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    env = dict(os.environ, PYTHONPATH=HERE)
+    out = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    return float(out.stdout)
+
+def time_to_first_byte(cmd, url, timeout=120):
+    # 从启动进程开始计时，直到 url 返回第一个字节
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=5) as resp:
+                    resp.read(1)
+                return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                time.sleep(0.02)
+        raise TimeoutError(url)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def report(label, samples):
+    print(f"{label:<28} median {statistics.median(samples) * 1000:8.0f} ms   "
+          f"min {min(samples) * 1000:8.0f} ms   (n={len(samples)})")
+
+def coldstart(runs):
+    report("import core", [import_time("core") for _ in range(runs)])
+    service = []
+    streamlit = []
+    for _ in range(runs):
+        port = free_port()
+        service.append(time_to_first_byte(
+            [sys.executable, os.path.join(HERE, "service.py"), "serve", "--host", "127.0.0.1", "--port", str(port)],
+            f"http://127.0.0.1:{port}/daily"))
+        port = free_port()
+        streamlit.append(time_to_first_byte(
+            [sys.executable, "-m", "streamlit", "run", os.path.join(HERE, "app.py"),
+             "--server.headless", "true", "--server.port", str(port)],
+            f"http://127.0.0.1:{port}/"))
+    report("service TTFB (/daily)", service)
+    report("streamlit TTFB (/)", streamlit)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="报餐系统性能测量 / meal app benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench = sub.add_parser("suite")
+    bench.add_argument("--users", default="100,1000,5000")
+    bench.add_argument("--months", type=int, default=3)
+    bench.add_argument("--density", type=float, default=0.3)
+    bench.add_argument("--repeats", type=int, default=5)
+    bench.add_argument("--latency-ms", type=float, default=0, help="模拟每次表格调用的网络往返")
+    cold = sub.add_parser("coldstart")
+    cold.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+    if args.command == "suite":
+        suite([int(n) for n in args.users.split(",")], args.months, args.density, args.repeats, args.latency_ms / 1000)
+    elif args.command == "coldstart":
+        coldstart(args.runs)
+
+
+if __name__ == "__main__":
+    main()
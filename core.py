@@ -0,0 +1,2488 @@
+# 报餐系统核心：配置、数据层与业务规则。
+# 不渲染任何页面，Streamlit 页面 (app.py) 和无界面的报表服务 (service.py) 共用。
+# 导入时没有副作用：streamlit、Google 表格连接、pyarrow 都在第一次用到时才加载。
+
+import pandas as pd
+import numpy as np
+from datetime import datetime, time, timedelta, timezone
+import calendar
+import contextvars
+import copy
+import csv
+import io
+import sqlite3
+import threading
+import json
+import os
+import tempfile
+from collections import deque
+from collections.abc import Mapping
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import time as time_lib
+
+# ==========================================
+# 2. 业务配置
+# ==========================================
+# 导入本模块不做任何 I/O：模块级配置先取默认值，configure() 时才用 secrets 覆盖。
+# Streamlit 页面在使用前调用 configure(st.secrets)；报表服务、基准测试可以传入自己的字典。
+SECRETS = {}
+
+def get_secret(key, default):
+    try:
+        return SECRETS[key]
+    except:
+        return default
+
+def configure(secrets=None):
+    # secrets 为 None 时读取 Streamlit 的 st.secrets (这时才导入 streamlit)
+    global SECRETS, ADMIN_PIN, STORAGE_BACKEND, SQLITE_PATH, ORDER_LOG_MODE, COMPACT_INTERVAL_SEC
+    global CACHE_MAX_STALENESS, CACHE_REFRESH_AFTER, WRITE_QUEUE_FLUSH_MS, WRITE_QUEUE_MAX_BATCH, WRITE_QUEUE_JOURNAL
+    global CHEF_REFRESH_SEC, ARCHIVE_DIR, DEBUG_MODE, FETCH_WORKERS, SITE_CONFIGS
+    if secrets is None:
+        import streamlit as st
+        secrets = st.secrets
+    SECRETS = secrets
+
+    ADMIN_PIN = get_secret("ADMIN_PIN", "8888")
+
+    # 存储后端："gsheets" (Google 表格，默认) 或 "sqlite" (本地带索引的数据库)
+    STORAGE_BACKEND = get_secret("STORAGE_BACKEND", "gsheets")
+    SQLITE_PATH = get_secret("SQLITE_PATH", "meal_app.db")
+
+    # 订单事件日志模式：每次点击只追加一行事件，后台定时压缩成当前状态
+    ORDER_LOG_MODE = bool(get_secret("ORDER_LOG_MODE", False))
+    COMPACT_INTERVAL_SEC = int(get_secret("COMPACT_INTERVAL_SEC", 300))
+
+    # 进程级共享缓存 (秒)：超过 REFRESH_AFTER 先返回旧数据并在后台刷新，
+    # 超过 MAX_STALENESS 必须同步重新拉取；MAX_STALENESS 设为 0 表示关闭缓存
+    CACHE_MAX_STALENESS = float(get_secret("CACHE_MAX_STALENESS", 60))
+    CACHE_REFRESH_AFTER = float(get_secret("CACHE_REFRESH_AFTER", 10))
+    # 一次渲染要用的几张表并发拉取的线程数上限 (每张表一次远程往返)
+    FETCH_WORKERS = int(get_secret("FETCH_WORKERS", 4))
+
+    # 点餐写入合并队列：各会话的点击先进队列 (本地日志落盘)，每 FLUSH_MS 毫秒或攒够 MAX_BATCH 条
+    # 合并成一次后端写入；FLUSH_MS 为 0 表示关闭，点击直接写后端
+    WRITE_QUEUE_FLUSH_MS = int(get_secret("WRITE_QUEUE_FLUSH_MS", 0))
+    WRITE_QUEUE_MAX_BATCH = int(get_secret("WRITE_QUEUE_MAX_BATCH", 200))
+    WRITE_QUEUE_JOURNAL = get_secret("WRITE_QUEUE_JOURNAL", "order_journal.jsonl")
+
+    # 厨师看板自动刷新间隔 (秒)；刷新时只拉取变更流里的增量
+    CHEF_REFRESH_SEC = float(get_secret("CHEF_REFRESH_SEC", 5))
+
+    # 已结账月份的冷归档目录 (Parquet 文件)；必须是持久化存储，封存后活数据里不再保留该月订单
+    ARCHIVE_DIR = get_secret("ARCHIVE_DIR", "archive")
+
+    # 调试模式：每次渲染结束时检查每张表的读取次数，防止回归成重复整表读取
+    DEBUG_MODE = bool(get_secret("DEBUG", False))
+
+    # 多工厂：每个工厂的配置 (存储、管理员密码、留饭时段、吃饭规则)，见"多工厂"一节
+    sites = plain_config(get_secret("SITES", {}))
+    SITE_CONFIGS = {DEFAULT_SITE: SiteConfig(DEFAULT_SITE, sites.pop(DEFAULT_SITE, {}))}
+    for site, overrides in sorted(sites.items()):
+        SITE_CONFIGS[site] = SiteConfig(site, overrides)
+
+def plain_config(value):
+    # st.secrets 的嵌套段落转成普通的 dict / list
+    if isinstance(value, Mapping): return {str(k): plain_config(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)): return [plain_config(v) for v in value]
+    return value
+
+# --- 多工厂 ---
+# 一个部署服务多个工厂，按 ?site=<名字> 或访问的域名选择。secrets 里每个 [SITES.<名字>] 段
+# 覆盖下面这些键，没写的沿用全局配置；不配置 SITES 时只有 default 一个工厂，行为和以前一样。
+#   [SITES.north]
+#   NAME = "北厂 / North"
+#   HOSTS = ["north.meal.example.com"]   # 不写时子域名等于工厂名也能选中 (north.xxx)
+#   ADMIN_PIN = "1234"
+#   SQLITE_PATH = "north.db"             # SQLite：每个工厂一个库文件，默认 <库名>_north.db
+#   WORKSHEET_PREFIX = "north_"          # Google 表格：同一个表格文件里按前缀分工作表，默认 "north_"
+#   GSHEETS_CONNECTION = "gsheets"       # 放在别的表格文件里时指定另一个连接
+#   LUNCH_LATE_OPTIONS = ["12:00", "12:30"]
+#   [SITES.north.MEAL_RULES]             # 整段替换全局的 MEAL_RULES
+# 每个工厂有自己的后端、共享缓存、汇总、变更流和写入队列，一个工厂的高峰不会挤掉其他工厂的缓存；
+# Google 表格连接 (同名共用) 和并发拉取线程池所有工厂共用。
+# 当前工厂放在 contextvars 里：页面每次运行、报表服务每个请求开头用 use_site() 切换，
+# 后台线程和线程池任务用 bind_site() 沿用提交时的工厂。
+DEFAULT_SITE = "default"
+SITE = contextvars.ContextVar("meal_site", default=DEFAULT_SITE)
+
+def site_path(path, site):
+    # default 工厂沿用原路径，其他工厂在文件名后加工厂名：meal_app.db -> meal_app_north.db
+    if site == DEFAULT_SITE: return path
+    stem, ext = os.path.splitext(path)
+    return f"{stem}_{site}{ext}"
+
+class SiteConfig:
+    def __init__(self, site, overrides):
+        def get(key, default):
+            return overrides.get(key, default)
+
+        self.site = site
+        self.name = str(get("NAME", site))
+        self.hosts = [str(h).lower() for h in get("HOSTS", [])]
+        self.admin_pin = get("ADMIN_PIN", ADMIN_PIN)
+        self.storage_backend = get("STORAGE_BACKEND", STORAGE_BACKEND)
+        self.sqlite_path = get("SQLITE_PATH", site_path(SQLITE_PATH, site))
+        self.gsheets_connection = get("GSHEETS_CONNECTION", "gsheets")
+        self.worksheet_prefix = get("WORKSHEET_PREFIX", "" if site == DEFAULT_SITE else f"{site}_")
+        self.archive_dir = get("ARCHIVE_DIR", ARCHIVE_DIR if site == DEFAULT_SITE else os.path.join(ARCHIVE_DIR, site))
+        self.write_queue_journal = get("WRITE_QUEUE_JOURNAL", site_path(WRITE_QUEUE_JOURNAL, site))
+        self.order_log_mode = bool(get("ORDER_LOG_MODE", ORDER_LOG_MODE))
+        # None 表示沿用默认留饭时段 (模块常量在本函数之后定义，用到时再取)
+        self.late = {"Lunch": get("LUNCH_LATE_OPTIONS", None), "Dinner": get("DINNER_LATE_OPTIONS", None)}
+        # 默认吃饭规则 (节假日、调休、分组)，格式见"规则日历"一节；编译后的日历按配置内容的版本缓存
+        self.meal_rules = plain_config(get("MEAL_RULES", get_secret("MEAL_RULES", {})))
+        self.rules_version = hashlib.sha1(json.dumps(self.meal_rules, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def late_options(self, meal_type):
+        options = self.late[meal_type]
+        if options is None: return LUNCH_LATE_OPTIONS if meal_type == "Lunch" else DINNER_LATE_OPTIONS
+        return [str(t) for t in options]
+
+def site_config():
+    return SITE_CONFIGS[SITE.get()]
+
+def resolve_site(requested=None, host=None):
+    # ?site= 参数优先 (未知的工厂抛 KeyError)，其次按访问的域名匹配 HOSTS 或子域名，都没有就是 default
+    if requested:
+        if requested not in SITE_CONFIGS: raise KeyError(requested)
+        return requested
+    host = (host or "").split(":")[0].lower()
+    if host:
+        for site, config in SITE_CONFIGS.items():
+            if host in config.hosts or (host.count(".") >= 2 and host.split(".")[0] == site): return site
+    return DEFAULT_SITE
+
+def use_site(site):
+    if site not in SITE_CONFIGS: raise KeyError(site)
+    SITE.set(site)
+
+def bind_site(fn):
+    # 新线程不继承 contextvars：包装后的函数在任何线程里都按调用 bind_site 时的工厂运行
+    site = SITE.get()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        token = SITE.set(site)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            SITE.reset(token)
+    return run
+
+configure({})
+
+def read_secrets_file():
+    # 不经过 streamlit 读取 secrets：与 Streamlit 相同的位置，当前目录的覆盖用户目录的
+    import tomllib
+    secrets = {}
+    for path in [os.path.expanduser("~/.streamlit/secrets.toml"), os.path.join(".streamlit", "secrets.toml")]:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                secrets.update(tomllib.load(f))
+    return secrets
+
+def resource(factory):
+    # 进程级单例 (代替 st.cache_resource)：第一次调用时创建，之后所有会话和线程共用
+    lock = threading.Lock()
+    box = []
+
+    @functools.wraps(factory)
+    def get():
+        if not box:
+            with lock:
+                if not box: box.append(factory())
+        return box[0]
+
+    def set_value(value):
+        # 基准测试 / 脚本可以直接注入实例 (例如假的 Google 表格后端)
+        with lock:
+            box[:] = [value]
+
+    get.clear = box.clear
+    get.set = set_value
+    return get
+
+def site_resource(factory):
+    # 每个工厂一个单例 (后端、缓存、汇总等)，用法与 resource 相同；set() 只替换当前工厂的实例
+    lock = threading.Lock()
+    boxes = {}
+
+    @functools.wraps(factory)
+    def get():
+        site = SITE.get()
+        if site not in boxes:
+            with lock:
+                if site not in boxes: boxes[site] = factory()
+        return boxes[site]
+
+    def set_value(value):
+        with lock:
+            boxes[SITE.get()] = value
+
+    get.clear = boxes.clear
+    get.set = set_value
+    return get
+
+# --- 性能计时 ---
+# 后端读写、规则计算、每次页面重跑都记一次耗时。每个操作保留最近 METRICS_WINDOW 次的滚动窗口，
+# 外加累计次数和总耗时；分位数 (p50/p95/p99) 只在查看 / 导出时计算。
+# 记录一次只是两次 perf_counter 加一次 deque 追加 (约 1 微秒)，生产环境常开。
+METRICS_WINDOW = 2048
+METRICS_QUANTILES = [0.5, 0.95, 0.99]
+
+class Metrics:
+    def __init__(self, window, site=DEFAULT_SITE):
+        self.window = window
+        self.site = site
+        self.lock = threading.Lock()
+        self.samples = {}  # 操作名 -> 最近的耗时 (秒)
+        self.counts = {}
+        self.totals = {}
+        self.since = time_lib.time()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def reset(self):
+        with self.lock:
+            self.samples, self.counts, self.totals = {}, {}, {}
+            self.since = time_lib.time()
+
+    def summary(self):
+        # 每个操作一行：累计次数 / 总耗时，以及窗口内的分位数和最大值 (秒)
+        with self.lock:
+            samples = {name: list(q) for name, q in self.samples.items()}
+            counts, totals = dict(self.counts), dict(self.totals)
+        rows = []
+        for name in sorted(samples):
+            window = np.asarray(samples[name])
+            p50, p95, p99 = np.quantile(window, METRICS_QUANTILES)
+            rows.append({"op": name, "count": counts[name], "total": totals[name],
+                         "p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(window.max())})
+        return rows
+
+    def to_json(self):
+        return json.dumps({"site": self.site, "since": self.since, "window": self.window, "operations": self.summary()},
+                          ensure_ascii=False)
+
+    def to_prometheus(self, prefix="meal_app"):
+        metric = f"{prefix}_operation_seconds"
+        lines = [f"# HELP {metric} Latency of instrumented operations (quantiles over the last {self.window} calls).",
+                 f"# TYPE {metric} summary"]
+        escape = lambda s: s.replace("\\", "\\\\").replace('"', '\\"')
+        for row in self.summary():
+            labels = f'site="{escape(self.site)}",op="{escape(row["op"])}"'
+            for q, key in zip(METRICS_QUANTILES, ["p50", "p95", "p99"]):
+                lines.append(f'{metric}{{{labels},quantile="{q}"}} {row[key]:.6g}')
+            lines.append(f'{metric}_sum{{{labels}}} {row["total"]:.6g}')
+            lines.append(f'{metric}_count{{{labels}}} {row["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+# 每个工厂单独统计：管理员的性能面板和 /metrics 只看本工厂的操作 (导出时带 site 标签)
+@site_resource
+def get_metrics():
+    return Metrics(METRICS_WINDOW, SITE.get())
+
+def timed(name, per_table=False):
+    # 给函数 / 方法计时；per_table=True 时按第一个参数之后的表名分开统计 (后端的 read/write/append)
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time_lib.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                get_metrics().observe(f"{name}:{args[1]}" if per_table else name, time_lib.perf_counter() - start)
+        return wrapper
+    return decorate
+
+CHANGE_FEED_SIZE = 1000
+MAX_READS_PER_TABLE = 1
+# 后端元数据 (迁移标记) 的本进程缓存最多用多少秒；迁移可能发生在其他进程 (报表服务、另一个页面进程)
+BACKEND_META_MAX_AGE = 30
+
+THAILAND_OFFSET = timedelta(hours=7)
+
+LUNCH_DEADLINE = time(10, 0)
+DINNER_DEADLINE = time(15, 0)
+AUTO_SWITCH_HOUR = 18
+
+# 新增：留饭时间选项 (分别配置午餐和晚餐)
+LUNCH_LATE_OPTIONS = ["12:30", "13:00"]
+DINNER_LATE_OPTIONS = ["19:00", "20:00", "21:00"]
+
+# ==========================================
+# 3. 核心数据层
+# ==========================================
+TABLE_COLUMNS = {
+    "users": ["phone", "name", "reg_date", "status"],
+    "orders": ["date", "phone", "name", "meal_type", "action", "time"],
+    "order_events": ["date", "phone", "name", "meal_type", "action", "time"],
+    "order_events_archive": ["date", "phone", "name", "meal_type", "action", "time", "compacted_at"],
+    "meta": ["key", "value"],
+    # 订单月分区目录：每个月一张 orders_YYYY_MM 表
+    "order_partitions": ["month", "table_name", "created_at"],
+    # 已封存 (冷归档) 月份：行数 + 归档文件 SHA-256
+    "order_archive": ["month", "table_name", "rows", "sha256", "sealed_at"],
+    # 用户状态变更日志：effective_from (YYYY-MM-DD) 起生效
+    "user_status_log": ["phone", "status", "effective_from"],
+}
+# 含电话列的表 (电话规范化迁移会重写这些表；订单分区另外按目录追加)
+PHONE_TABLES = ["users", "orders", "order_events", "order_events_archive", "user_status_log"]
+# 第一次改状态时补记的基线 (之前一直是原状态) 的生效日期
+STATUS_BASELINE_DATE = "1970-01-01"
+ORDER_KEY = ["date", "meal_type", "phone"]
+ORDER_PARTITION_PREFIX = "orders_"
+
+# --- 订单月分区 ---
+# 分区表名由日期直接算出 (2026-10-19 -> orders_2026_10)，单日读写不需要查目录
+def order_partition(date_str):
+    return ORDER_PARTITION_PREFIX + str(date_str)[:7].replace("-", "_")
+
+def order_partition_series(dates):
+    return ORDER_PARTITION_PREFIX + dates.astype(str).str[:7].str.replace("-", "_", regex=False)
+
+def is_order_partition(table):
+    suffix = table[len(ORDER_PARTITION_PREFIX):]
+    return table.startswith(ORDER_PARTITION_PREFIX) and len(suffix) == 7 and suffix[4] == "_" \
+        and suffix[:4].isdigit() and suffix[5:].isdigit()
+
+def table_columns(table):
+    if is_order_partition(table): return TABLE_COLUMNS["orders"]
+    return TABLE_COLUMNS.get(table)
+
+def get_thai_time():
+    return datetime.now(timezone.utc) + THAILAND_OFFSET
+
+def standardize_phone(val):
+    if pd.isna(val): return ""
+    s = str(val).strip()
+    if s.endswith(".0"): s = s[:-2]
+    digits = "".join(filter(str.isdigit, s))
+    if len(digits) == 9: digits = '0' + digits
+    return digits
+
+# 向量化版 standardize_phone，规则相同：去掉 .0 -> 只留数字 -> 9 位左补 0
+def standardize_phone_series(values):
+    s = pd.Series(values, dtype=object)
+    missing = s.isna()
+    text = s.astype(str).str.strip()
+    text = text.where(~text.str.endswith(".0"), text.str[:-2])
+    digits = text.str.replace(r"[^0-9]", "", regex=True)
+    digits = digits.where(digits.str.len() != 9, "0" + digits)
+    # 含非 ASCII 字符 (例如缅文数字) 的少数值走标量版本，保证结果完全一致
+    exotic = ~missing & text.str.contains(r"[^\x00-\x7f]", regex=True)
+    if exotic.any():
+        digits[exotic] = s[exotic].map(standardize_phone)
+    return digits.where(~missing, "")
+
+def keep_leading_zero(value):
+    # 写入表格时以 0 开头的纯数字 (电话) 按文本保存，否则表格会把前导 0 吃掉
+    return value[:1] == "0" and value.isdigit()
+
+def normalize_name(name):
+    return str(name).strip().lower()
+
+def normalize_table(sheet_name, df, canonical=False):
+    if table_columns(sheet_name) is not None and df.empty:
+        return pd.DataFrame(columns=table_columns(sheet_name))
+    # 已迁移为规范格式的数据直接使用，不再逐行清洗
+    if 'phone' in df.columns and not canonical:
+        df['phone'] = standardize_phone_series(df['phone'])
+
+    # 兼容性处理：如果users表没有status列，自动补全默认值
+    if sheet_name == "users" and "status" not in df.columns:
+        df["status"] = "active"
+    return df
+
+def fold_order_events(state, events):
+    # 每个 (日期, 餐别, 电话) 只保留最新一条；DELETE 表示回到默认规则，不保留行
+    merged = pd.concat([state, events], ignore_index=True)
+    if merged.empty: return normalize_table("orders", merged)
+    merged = merged.drop_duplicates(subset=ORDER_KEY, keep='last')
+    merged = merged[merged['action'] != "DELETE"]
+    return merged.reindex(columns=TABLE_COLUMNS["orders"]).reset_index(drop=True)
+
+# --- 订单的紧凑内存表示 ---
+# 共享缓存里的订单表各列都是分类列：每个不同的值只存一份，行里只存整数编码，多年历史也只占很少内存。
+# meal_type / action 的类别以固定词表开头 (包括所有留饭时段)，编码在所有表之间一致，规则可以按编码查表；
+# 词表之外的历史值按字母序追加在后面，不会丢失。列的取值仍是原来的文本，按文本比较、写回后端都不受影响。
+# 日期按天数 (距 1970-01-01，int32) 计算时只解析每个不同的日期一次。
+DAY_EPOCH = pd.Timestamp("1970-01-01")
+MEAL_TYPES = ["Lunch", "Dinner"]
+ORDER_ACTIONS = list(dict.fromkeys(["BOOKED", "CANCELED", "DELETE"]
+                                   + [f"LATE_{t}" for t in LUNCH_LATE_OPTIONS + DINNER_LATE_OPTIONS]))
+ORDER_VOCABS = {"meal_type": MEAL_TYPES, "action": ORDER_ACTIONS}
+
+def vocab_categories(values, vocab):
+    present = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else pd.unique(values.dropna())
+    return list(vocab) + sorted(set(present) - set(vocab))
+
+def vocab_codes(values, vocab):
+    # 返回 (编码数组, 类别列表)；空值编码为 -1
+    categories = vocab_categories(values, vocab)
+    return pd.Categorical(values, categories=categories).codes, categories
+
+def compact_order_frame(df):
+    if df.empty: return df
+    df = df.copy()
+    for col in df.columns:
+        if col in ORDER_VOCABS:
+            df[col] = df[col].astype(pd.CategoricalDtype(vocab_categories(df[col], ORDER_VOCABS[col])))
+        elif not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    return df
+
+def day_ordinals(dates):
+    # 日期列 -> 天数 (int32)，无法识别的日期为 -1
+    dates = pd.Series(dates)
+    if not isinstance(dates.dtype, pd.CategoricalDtype):
+        dates = dates.astype("category")
+    parsed = pd.to_datetime(pd.Series(dates.cat.categories, dtype=object), errors="coerce")
+    days = ((parsed - DAY_EPOCH).dt.days.fillna(-1)).to_numpy(dtype="int32")
+    # 编码 -1 (空值) 取到末尾追加的 -1
+    return np.append(days, np.int32(-1))[dates.cat.codes.to_numpy()]
+
+# --- 存储后端 ---
+# read_table / write_db 以及所有业务函数都只通过后端接口访问数据。
+# 基类用"整表读 -> 修改 -> 整表写"实现单行操作，Google 表格后端直接沿用；
+# SQLite 后端用索引把点击变成一次 upsert、把状态查询变成一次点查。
+
+class StorageBackend:
+    # log_mode=True 时订单写入只追加到 order_events，读取时与 orders 折叠
+    # archive: 已封存月份的 OrderArchive，None 表示不启用冷归档
+    # point_reads: 单个订单可以用索引点查 (get_order_action)，不必读整个月
+    point_reads = False
+
+    def __init__(self, log_mode=False, archive=None):
+        self.log_mode = log_mode
+        self.archive = archive
+        self.sealed = None
+        self.sealed_at = 0.0
+        # 整表读-改-写 (压缩、批量写、迁移) 互斥
+        self.write_lock = threading.Lock()
+        self.meta = None
+        self.meta_at = 0.0
+        self.catalog_lock = threading.Lock()
+        self.known_partitions = set()
+
+    def read(self, table):
+        raise NotImplementedError
+
+    def write(self, table, df):
+        raise NotImplementedError
+
+    def append(self, table, df):
+        self.write(table, pd.concat([self.read_optional(table), df], ignore_index=True))
+
+    def read_optional(self, table):
+        # 事件表/归档表第一次使用前可能还不存在
+        try:
+            return normalize_table(table, self.read(table), self.phones_canonical(table))
+        except Exception:
+            return normalize_table(table, pd.DataFrame())
+
+    def load(self, table):
+        if is_order_partition(table):
+            return self.load_partition(table)
+        if table == "orders" and self.partitioned():
+            # 全量视图：按目录拼接所有月份分区，只有管理员全量操作会用到
+            parts = parallel_map(self.read_optional, self.order_partitions())
+            df = pd.concat(parts, ignore_index=True) if parts else normalize_table("orders", pd.DataFrame())
+        else:
+            df = normalize_table(table, self.read(table), self.phones_canonical(table))
+        if table == "orders" and self.log_mode:
+            df = fold_order_events(df, self.read_optional("order_events"))
+        if table == "orders" and self.sealed_months():
+            # 已封存的月份在归档文件里，活数据中已经没有
+            df = pd.concat([self.read_archive(t) for t in sorted(self.sealed_months())] + [df], ignore_index=True)
+        return df
+
+    def load_partition(self, table):
+        if table in self.sealed_months():
+            return self.read_archive(table)
+        if not self.partitioned():
+            # 还没迁移：从共享缓存里的整表切出这个月 (各个月份共用一次整表读取)，调用方不用关心存储布局。
+            # 需要最新数据的读-改-写 (封存) 不走这里，自己读整表
+            orders = get_cache().get("orders")
+            if orders.empty: return normalize_table("orders", pd.DataFrame())
+            return orders[order_partition_series(orders['date']) == table].reset_index(drop=True)
+        df = self.read_optional(table)
+        if self.log_mode:
+            events = self.read_optional("order_events")
+            df = fold_order_events(df, events[order_partition_series(events['date']) == table])
+        return df
+
+    # --- 冷归档：已封存月份只读，从归档文件读取 ---
+    # 封存可能发生在其他进程：本进程的封存列表与元数据一样，超过 BACKEND_META_MAX_AGE 秒就重读，写入前总是重读
+    def sealed_months(self):
+        if self.archive is None: return {}
+        if self.sealed is None or time_lib.monotonic() - self.sealed_at > BACKEND_META_MAX_AGE:
+            self.refresh_sealed()
+        return self.sealed
+
+    def refresh_sealed(self):
+        if self.archive is None: return
+        df = self.read_optional("order_archive")
+        self.sealed, self.sealed_at = dict(zip(df['table_name'], df['sha256'])), time_lib.monotonic()
+
+    def read_archive(self, table, columns=None):
+        return self.archive.read(table, self.sealed_months()[table], columns)
+
+    def check_writable(self, rows, sealed=None):
+        # sealed: 已封存的分区表名；不传时用本进程缓存的列表 (入队前的快速检查)
+        sealed_tables = self.sealed_months() if sealed is None else sealed
+        sealed = [r["date"] for r in rows if order_partition(r["date"]) in sealed_tables]
+        if sealed:
+            raise ValueError(f"月份已封存，订单只读 / month is sealed: {sealed[0]}")
+
+    # --- 订单分区目录 ---
+    def partitioned(self):
+        return self.get_meta("orders_partitioned") == "1"
+
+    def order_partitions(self):
+        catalog = self.read_optional("order_partitions")
+        with self.catalog_lock:
+            self.known_partitions = set(catalog['table_name'])
+            return sorted(self.known_partitions)
+
+    def partition_orders(self):
+        # 把整张 orders 表按月拆到分区；返回拆出的月份数，已经迁移过返回 0。
+        # 点击写入 (apply_orders) 也持有 write_lock，迁移期间本进程的点击等迁移完成后写进分区
+        with self.write_lock:
+            self.refresh_meta()
+            if self.partitioned(): return 0
+            orders = normalize_table("orders", self.read("orders"), self.phones_canonical())
+            tables = order_partition_series(orders['date'])
+            valid = tables.map(is_order_partition).astype(bool)
+            for table, part in orders[valid].groupby(tables[valid]):
+                self.write(table, part)
+                self.register_partition(table)
+            self.set_meta("orders_partitioned", "1")
+            self.write("orders", orders[~valid])
+            return int(tables[valid].nunique())
+
+    def seal_partition(self, table):
+        # 把一个月的订单冻结成归档文件、登记校验和并从活数据中移除；返回 (行数, sha256)，已封存返回 None
+        with self.write_lock:
+            self.refresh_meta()
+            self.refresh_sealed()
+            if table in self.sealed_months(): return None
+            month = table[len(ORDER_PARTITION_PREFIX):].replace("_", "-")
+            if self.log_mode and self.read_optional("order_events")['date'].astype(str).str.startswith(month).any():
+                raise ValueError(f"该月还有未压缩的点餐记录，请重试 / month has uncompacted order events, retry: {month}")
+            # 封存的内容必须是后端的最新数据：未迁移时直接读整表切出这个月，不用共享缓存
+            partitioned = self.partitioned()
+            if partitioned:
+                orders = self.load(table)
+            else:
+                live = normalize_table("orders", self.read("orders"), self.phones_canonical())
+                in_month = order_partition_series(live['date']) == table
+                orders = live[in_month]
+            rows, digest = self.archive.freeze(table, orders)
+            self.append("order_archive", pd.DataFrame([{
+                "month": month, "table_name": table, "rows": rows, "sha256": digest, "sealed_at": get_thai_time().strftime("%Y-%m-%d %H:%M:%S"),
+            }]))
+            self.sealed = None
+            # 活数据里只保留未封存的月份
+            if partitioned:
+                self.write(table, orders.iloc[0:0])
+            else:
+                self.write("orders", live[~in_month])
+            return rows, digest
+
+    def register_partition(self, table):
+        # 第一次写入某个月时登记到目录；本进程已知的分区直接跳过
+        if table in self.known_partitions: return
+        if table in self.order_partitions(): return
+        with self.catalog_lock:
+            self.append("order_partitions", pd.DataFrame([{
+                "month": table[len(ORDER_PARTITION_PREFIX):].replace("_", "-"), "table_name": table,
+                "created_at": get_thai_time().strftime("%Y-%m-%d %H:%M:%S"),
+            }]))
+            self.known_partitions.add(table)
+
+    def add_user(self, row):
+        df = self.load("users")
+        self.write("users", pd.concat([df, pd.DataFrame([row])], ignore_index=True))
+
+    def delete_user(self, phone):
+        df = self.load("users")
+        if not df.empty:
+            self.write("users", df[df['phone'] != phone])
+
+    def set_user_status(self, phones, status):
+        df = self.load("users")
+        if df.empty: return False
+        df.loc[df['phone'].isin(phones), 'status'] = status
+        self.write("users", df)
+        return True
+
+    def apply_order(self, row):
+        self.apply_orders([row])
+
+    def apply_orders(self, rows):
+        # 一批订单变更一次写完；同一 (日期, 餐别, 电话) 以最后一条为准，DELETE 表示删除该行
+        if not rows: return
+        batch = pd.DataFrame(rows)
+        # 标记和封存列表用本进程的缓存 (超过 BACKEND_META_MAX_AGE 秒重读)，每次点击不再多读两张表；
+        # 写入失败后清掉缓存，下次重试时重读。本进程的迁移 / 封存也持有 write_lock，期间的点击等它们完成
+        try:
+            self.check_writable(rows)
+            if self.log_mode:
+                self.append("order_events", batch)
+                return
+            batch = batch.drop_duplicates(subset=ORDER_KEY, keep='last')
+            with self.write_lock:
+                if not self.partitioned():
+                    # 读-改-写只基于活数据：load() 会拼上已封存月份的归档，写回去会把封存的月份又放回 orders
+                    live = normalize_table("orders", self.read("orders"), self.phones_canonical())
+                    # orders 是空的：可能其他进程刚做完迁移，重读标记确认存储布局
+                    if live.empty: self.refresh_meta()
+                    if not self.partitioned():
+                        self.write("orders", self.merge_orders(live, batch))
+                        return
+                # 分区模式：每个涉及的月份只读写自己的分区
+                for table, part in batch.groupby(order_partition_series(batch['date'])):
+                    self.write(table, self.merge_orders(self.read_optional(table), part))
+                    self.register_partition(table)
+        except Exception:
+            self.meta = self.sealed = None
+            raise
+
+    @staticmethod
+    def merge_orders(df, batch):
+        if not df.empty:
+            hit = pd.MultiIndex.from_frame(df[ORDER_KEY]).isin(pd.MultiIndex.from_frame(batch[ORDER_KEY]))
+            df = df[~hit]
+        return pd.concat([df, batch[batch['action'] != "DELETE"]], ignore_index=True)
+
+    # --- 元数据 (key/value)：记录数据格式等标记 ---
+    # 本进程缓存超过 BACKEND_META_MAX_AGE 秒就重读，其他进程做的迁移在这之后生效；写入路径持锁时总是重读
+    def get_meta(self, key, default=None):
+        if self.meta is None or time_lib.monotonic() - self.meta_at > BACKEND_META_MAX_AGE:
+            self.refresh_meta()
+        return self.meta.get(key, default)
+
+    def refresh_meta(self):
+        try:
+            df = self.read("meta")
+            meta = dict(zip(df['key'].astype(str), df['value'].astype(str))) if not df.empty else {}
+        except Exception:
+            # 表还不存在；读取暂时失败时沿用上次的标记
+            meta = self.meta if self.meta is not None else {}
+        self.meta, self.meta_at = meta, time_lib.monotonic()
+
+    def set_meta(self, key, value):
+        self.refresh_meta()
+        self.meta[key] = str(value)
+        self.write("meta", pd.DataFrame(list(self.meta.items()), columns=TABLE_COLUMNS["meta"]))
+
+    def phones_canonical(self, table=None):
+        if table == "meta": return True
+        return self.get_meta("phones_canonical") == "1"
+
+    def compact_order_log(self):
+        # 把事件日志折叠进 orders，已折叠的事件移入归档表；没有事件时只做按键去重
+        with self.write_lock:
+            self.refresh_meta()
+            events = self.read_optional("order_events")
+            if self.partitioned():
+                for table, part in events.groupby(order_partition_series(events['date'])):
+                    self.write(table, fold_order_events(self.read_optional(table), part))
+                    self.register_partition(table)
+            else:
+                state = normalize_table("orders", self.read("orders"), self.phones_canonical())
+                self.write("orders", fold_order_events(state, events))
+            if events.empty: return 0
+            self.append("order_events_archive", events.assign(compacted_at=get_thai_time().strftime("%Y-%m-%d %H:%M:%S")))
+            # 只删掉已经归档的前 len(events) 行：压缩期间新追加的事件排在后面，原样留在日志里
+            self.drop_head("order_events", len(events))
+            return len(events)
+
+    def drop_head(self, table, count):
+        # 删掉表的前 count 行；没有行级删除的后端只能整表重写
+        self.write(table, self.read_optional(table).iloc[count:])
+
+
+class GSheetsBackend(StorageBackend):
+    # prefix: 工作表名前缀，多个工厂共用一个表格文件时区分各自的表
+    def __init__(self, conn, log_mode=False, archive=None, prefix=""):
+        super().__init__(log_mode, archive)
+        self.conn = conn
+        self.prefix = prefix
+        self.checked_headers = set()
+
+    @timed("gsheets.read", per_table=True)
+    def read(self, table):
+        # 电话列按文本读取，保留前导 0
+        return self.conn.read(worksheet=self.prefix + table, ttl=0, dtype={"phone": str})
+
+    @timed("gsheets.write", per_table=True)
+    def write(self, table, df):
+        from gspread.exceptions import WorksheetNotFound
+        from gspread_dataframe import set_with_dataframe
+        try:
+            client = self.conn.client
+            try:
+                ws = client._select_worksheet(worksheet=self.prefix + table)
+            except WorksheetNotFound:
+                ws = client._open_spreadsheet().add_worksheet(
+                    title=self.prefix + table, rows=len(df) + 1, cols=max(len(df.columns), 1))
+        except AttributeError:
+            # 公开链接模式没有写权限，交给连接自己报错
+            return self.conn.update(worksheet=self.prefix + table, data=df)
+        ws.clear()
+        set_with_dataframe(ws, df, string_escaping=keep_leading_zero)
+        self.checked_headers.add(table)
+
+    @timed("gsheets.append", per_table=True)
+    def append(self, table, df):
+        # 服务账号模式下直接在表尾追加行，不再整表下载/上传
+        from gspread.exceptions import WorksheetNotFound
+        try:
+            ws = self.conn.client._select_worksheet(worksheet=self.prefix + table)
+        except WorksheetNotFound:
+            return self.write(table, df)
+        except AttributeError:
+            return super().append(table, df)
+        cols = table_columns(table) or list(df.columns)
+        if table not in self.checked_headers:
+            if not ws.row_values(1): ws.append_row(cols, value_input_option="RAW")
+            self.checked_headers.add(table)
+        values = df.reindex(columns=cols).fillna("").astype(str).values.tolist()
+        ws.append_rows(values, value_input_option="RAW")
+
+    @timed("gsheets.drop_head", per_table=True)
+    def drop_head(self, table, count):
+        # 服务账号模式下直接删除第 2 ~ count+1 行 (第 1 行是表头)，不清空重写：
+        # 点击追加事件不持有 write_lock，整表重写会弄丢读取之后、写回之前追加的行
+        if count <= 0: return
+        try:
+            ws = self.conn.client._select_worksheet(worksheet=self.prefix + table)
+        except AttributeError:
+            return super().drop_head(table, count)
+        ws.delete_rows(2, count + 1)
+
+
+class SQLiteBackend(StorageBackend):
+    point_reads = True
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            phone TEXT PRIMARY KEY, name TEXT, reg_date TEXT, status TEXT
+        );
+        CREATE TABLE IF NOT EXISTS orders (
+            date TEXT, phone TEXT, name TEXT, meal_type TEXT, action TEXT, time TEXT
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_orders_key ON orders (date, meal_type, phone);
+        CREATE TABLE IF NOT EXISTS order_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT, phone TEXT, name TEXT, meal_type TEXT, action TEXT, time TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_order_events_key ON order_events (date, meal_type, phone, seq);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS order_events_archive (
+            seq INTEGER, date TEXT, phone TEXT, name TEXT, meal_type TEXT, action TEXT, time TEXT,
+            compacted_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS order_partitions (month TEXT PRIMARY KEY, table_name TEXT, created_at TEXT);
+        CREATE TABLE IF NOT EXISTS user_status_log (phone TEXT, status TEXT, effective_from TEXT);
+        CREATE TABLE IF NOT EXISTS order_archive (
+            month TEXT PRIMARY KEY, table_name TEXT, rows INTEGER, sha256 TEXT, sealed_at TEXT
+        );
+    """
+
+    def __init__(self, path, log_mode=False, archive=None):
+        super().__init__(log_mode, archive)
+        # Streamlit 每个会话一个线程，共用一个连接并加锁
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(self.SCHEMA)
+        self.created_partitions = set()
+
+    def ensure_partition(self, table):
+        # 订单分区表结构与 orders 相同；调用方持有 self.lock
+        if table in self.created_partitions: return
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                        "(date TEXT, phone TEXT, name TEXT, meal_type TEXT, action TEXT, time TEXT)")
+        self.db.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{table}_key ON {table} (date, meal_type, phone)")
+        self.created_partitions.add(table)
+
+    def begin(self):
+        # 调用方持有 self.lock 并在 with self.db 内。BEGIN IMMEDIATE 立即拿到库的写锁：
+        # 其他进程的写入 (点击、迁移、封存) 要等本事务提交，事务里读到的标记在提交前不会变
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def meta_value(self, key):
+        # 调用方持有 self.lock；直接查库，不经过本进程的元数据缓存
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @timed("sqlite.read", per_table=True)
+    def read(self, table):
+        with self.lock:
+            return self.select(table)
+
+    def select(self, table):
+        # 调用方持有 self.lock
+        cols = ", ".join(table_columns(table))
+        return pd.read_sql_query(f"SELECT {cols} FROM {table} ORDER BY rowid", self.db)
+
+    @timed("sqlite.write", per_table=True)
+    def write(self, table, df):
+        with self.lock, self.db:
+            self.replace_rows(table, df)
+
+    def replace_rows(self, table, df):
+        # 调用方持有 self.lock 并在事务内
+        cols, rows = self._rows(table, df)
+        if is_order_partition(table): self.ensure_partition(table)
+        self.db.execute(f"DELETE FROM {table}")
+        # 唯一索引下重复行以最后一条为准，与 get_status 取最后一条的语义一致
+        self.db.executemany(
+            f"INSERT OR REPLACE INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+            rows,
+        )
+
+    @timed("sqlite.append", per_table=True)
+    def append(self, table, df):
+        cols, rows = self._rows(table, df)
+        with self.lock, self.db:
+            if is_order_partition(table): self.ensure_partition(table)
+            self.db.executemany(
+                f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                rows,
+            )
+
+    def _rows(self, table, df):
+        cols = table_columns(table)
+        df = df.reindex(columns=cols)
+        df = df.astype(object).where(df.notna(), None)
+        return cols, df.values.tolist()
+
+    @timed("sqlite.get_order_action")
+    def get_order_action(self, date, meal_type, phone):
+        # 一个 (日期, 餐别, 电话) 的当前动作：事件日志里最新的一条优先，其次是当前状态表；都走索引
+        key = (date, meal_type, phone)
+        with self.lock:
+            if self.log_mode:
+                row = self.db.execute("SELECT action FROM order_events WHERE date = ? AND meal_type = ? AND phone = ? "
+                                      "ORDER BY seq DESC LIMIT 1", key).fetchone()
+                if row: return None if row[0] == "DELETE" else row[0]
+            table = order_partition(date) if self.meta_value("orders_partitioned") == "1" else "orders"
+            try:
+                row = self.db.execute(f"SELECT action FROM {table} WHERE date = ? AND meal_type = ? AND phone = ?", key).fetchone()
+            except sqlite3.OperationalError:
+                return None  # 这个月的分区还不存在
+        return row[0] if row else None
+
+    @timed("sqlite.add_user")
+    def add_user(self, row):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO users (phone, name, reg_date, status) VALUES (?, ?, ?, ?)",
+                tuple(row[c] for c in TABLE_COLUMNS["users"]),
+            )
+
+    @timed("sqlite.delete_user")
+    def delete_user(self, phone):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM users WHERE phone = ?", (phone,))
+
+    @timed("sqlite.set_user_status")
+    def set_user_status(self, phones, status):
+        with self.lock, self.db:
+            if self.db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None: return False
+            self.db.executemany("UPDATE users SET status = ? WHERE phone = ?", [(status, p) for p in phones])
+        return True
+
+    def partition_orders(self):
+        # 读 orders、写分区和目录、置标记、清空原表都在同一个写事务里：
+        # 其他线程 / 进程的点击要么在迁移之前落进 orders 被一起搬走，要么在之后直接写进分区
+        canonical = self.phones_canonical()
+        stamp = get_thai_time().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            with self.write_lock, self.lock, self.db:
+                self.begin()
+                if self.meta_value("orders_partitioned") == "1": return 0
+                orders = normalize_table("orders", self.select("orders"), canonical)
+                tables = order_partition_series(orders['date'])
+                valid = tables.map(is_order_partition).astype(bool)
+                for table, part in orders[valid].groupby(tables[valid]):
+                    self.replace_rows(table, part)
+                    self.db.execute("INSERT OR IGNORE INTO order_partitions (month, table_name, created_at) VALUES (?, ?, ?)",
+                                    (table[len(ORDER_PARTITION_PREFIX):].replace("_", "-"), table, stamp))
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('orders_partitioned', '1')")
+                self.replace_rows("orders", orders[~valid])
+        except Exception:
+            # 事务回滚后新建的分区表也不存在了
+            self.created_partitions.clear()
+            raise
+        self.meta = None
+        return int(tables[valid].nunique())
+
+    def sealed_tables(self, tables):
+        # 调用方持有 self.lock 并在写事务内：直接查库，其他进程刚提交的封存也能看到
+        tables = list(tables)
+        return {t for (t,) in self.db.execute(
+            f"SELECT table_name FROM order_archive WHERE table_name IN ({', '.join('?' * len(tables))})", tables)}
+
+    def seal_partition(self, table):
+        # 读这个月、写归档文件、登记、从活数据删除都在同一个写事务里：
+        # 其他线程 / 进程的点击要么在封存之前写入 (被一起归档)，要么在之后被拒绝，不会丢失
+        canonical = self.phones_canonical()
+        month = table[len(ORDER_PARTITION_PREFIX):].replace("_", "-")
+        with self.write_lock, self.lock, self.db:
+            self.begin()
+            if self.sealed_tables([table]): return None
+            if self.log_mode and self.db.execute(
+                    "SELECT 1 FROM order_events WHERE substr(date, 1, 7) = ? LIMIT 1", (month,)).fetchone():
+                raise ValueError(f"该月还有未压缩的点餐记录，请重试 / month has uncompacted order events, retry: {month}")
+            partitioned = self.meta_value("orders_partitioned") == "1"
+            exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            if partitioned:
+                orders = normalize_table("orders", self.select(table) if exists else pd.DataFrame(), canonical)
+            else:
+                live = normalize_table("orders", self.select("orders"), canonical)
+                in_month = order_partition_series(live['date']) == table
+                orders = live[in_month]
+            rows, digest = self.archive.freeze(table, orders)
+            self.db.execute("INSERT INTO order_archive (month, table_name, rows, sha256, sealed_at) VALUES (?, ?, ?, ?, ?)",
+                            (month, table, rows, digest, get_thai_time().strftime("%Y-%m-%d %H:%M:%S")))
+            if partitioned:
+                if exists: self.db.execute(f"DELETE FROM {table}")
+            else:
+                self.replace_rows("orders", live[~in_month])
+        self.sealed = None
+        return rows, digest
+
+    @timed("sqlite.apply_orders")
+    def apply_orders(self, rows):
+        if not rows: return
+        if self.log_mode:
+            with self.lock, self.db:
+                self.begin()
+                self.check_writable(rows, self.sealed_tables({order_partition(r["date"]) for r in rows}))
+                cols, values = self._rows("order_events", pd.DataFrame(rows))
+                self.db.executemany(
+                    f"INSERT INTO order_events ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})", values)
+            return
+        with self.lock, self.db:
+            # 分区标记和封存列表在写事务里读：其他进程刚做完迁移也会写进分区，不会写进已清空的 orders；
+            # 刚封存的月份直接拒绝
+            self.begin()
+            self.check_writable(rows, self.sealed_tables({order_partition(r["date"]) for r in rows}))
+            partitioned = self.meta_value("orders_partitioned") == "1"
+            tables = {}
+            for r in rows:
+                table = order_partition(r["date"]) if partitioned else "orders"
+                tables.setdefault(table, {})[(r["date"], r["meal_type"], r["phone"])] = r
+            for table, latest in tables.items():
+                if partitioned: self.ensure_partition(table)
+                upserts = [tuple(r[c] for c in TABLE_COLUMNS["orders"]) for r in latest.values() if r["action"] != "DELETE"]
+                deletes = [key for key, r in latest.items() if r["action"] == "DELETE"]
+                self.db.executemany(
+                    f"""INSERT INTO {table} (date, phone, name, meal_type, action, time) VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (date, meal_type, phone)
+                        DO UPDATE SET name = excluded.name, action = excluded.action, time = excluded.time""",
+                    upserts,
+                )
+                self.db.executemany(f"DELETE FROM {table} WHERE date = ? AND meal_type = ? AND phone = ?", deletes)
+        if partitioned:
+            for table in tables: self.register_partition(table)
+
+    def compact_order_log(self):
+        # 单个事务内完成：折叠到 orders -> 归档 -> 清理日志，压缩期间的新事件不受影响
+        stamp = get_thai_time().strftime("%Y-%m-%d %H:%M:%S")
+        with self.write_lock, self.lock, self.db:
+            self.begin()
+            partitioned = self.meta_value("orders_partitioned") == "1"
+            max_seq = self.db.execute("SELECT MAX(seq) FROM order_events").fetchone()[0]
+            if max_seq is None: return 0
+            latest = """SELECT * FROM order_events WHERE seq IN (
+                            SELECT MAX(seq) FROM order_events WHERE seq <= ? GROUP BY date, meal_type, phone)"""
+            if partitioned:
+                # 分区模式：按事件涉及的月份分别折叠进对应分区
+                months = [m for (m,) in self.db.execute(
+                    "SELECT DISTINCT substr(date, 1, 7) FROM order_events WHERE seq <= ?", (max_seq,))]
+                targets = [(order_partition(m), " AND substr(date, 1, 7) = ?", (max_seq, m)) for m in months]
+            else:
+                targets = [("orders", "", (max_seq,))]
+            for table, month_filter, params in targets:
+                if partitioned: self.ensure_partition(table)
+                self.db.execute(
+                    f"""INSERT INTO {table} (date, phone, name, meal_type, action, time)
+                        SELECT date, phone, name, meal_type, action, time FROM ({latest})
+                        WHERE action != 'DELETE'{month_filter}
+                        ON CONFLICT (date, meal_type, phone)
+                        DO UPDATE SET name = excluded.name, action = excluded.action, time = excluded.time""",
+                    params,
+                )
+                self.db.execute(
+                    f"""DELETE FROM {table} WHERE (date, meal_type, phone) IN (
+                            SELECT date, meal_type, phone FROM ({latest}) WHERE action = 'DELETE'{month_filter})""",
+                    params,
+                )
+            self.db.execute(
+                """INSERT INTO order_events_archive
+                   SELECT seq, date, phone, name, meal_type, action, time, ? FROM order_events WHERE seq <= ?""",
+                (stamp, max_seq),
+            )
+            count = self.db.execute("DELETE FROM order_events WHERE seq <= ?", (max_seq,)).rowcount
+        if partitioned:
+            for table, _, _ in targets: self.register_partition(table)
+        return count
+
+
+# --- 已结账月份的列式冷归档 ---
+# 整月订单冻结成一个 Parquet 文件：电话 / 姓名 / 餐别 / 动作字典编码，日期存为距 1970-01-01 的天数。
+# 读取时内存映射、只解码需要的列；文件的 SHA-256 记在 order_archive 表，每个进程首次打开时校验一次。
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class OrderArchive:
+    def __init__(self, directory):
+        self.directory = directory
+        self.verified = {}
+
+    def path(self, table):
+        return os.path.join(self.directory, table + ".parquet")
+
+    def freeze(self, table, orders):
+        frozen = pd.DataFrame({
+            "date": day_ordinals(orders['date']),
+            "phone": orders['phone'].astype("category"),
+            "name": orders['name'].astype("category"),
+            "meal_type": orders['meal_type'].astype("category"),
+            "action": orders['action'].astype("category"),
+            "time": orders['time'],
+        })
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(table)
+        tmp = path + ".tmp"
+        frozen.to_parquet(tmp, index=False)
+        digest = file_sha256(tmp)
+        os.replace(tmp, path)
+        return len(frozen), digest
+
+    @timed("archive.read", per_table=True)
+    def read(self, table, checksum, columns=None):
+        path = self.path(table)
+        stat = os.stat(path)
+        stamp = (checksum, stat.st_mtime_ns, stat.st_size)
+        if self.verified.get(table) != stamp:
+            if file_sha256(path) != checksum:
+                raise ValueError(f"归档文件校验失败 / archive checksum mismatch: {path}")
+            self.verified[table] = stamp
+        import pyarrow.parquet as pq
+        df = pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+        # 天数还原成日期文本的分类列，与缓存里的活数据同样是紧凑表示
+        if "date" in df.columns:
+            ordinals, codes = np.unique(df['date'].to_numpy(), return_inverse=True)
+            labels = (DAY_EPOCH + pd.to_timedelta(ordinals, unit="D")).strftime("%Y-%m-%d")
+            df['date'] = pd.Categorical.from_codes(codes, labels)
+        return compact_order_frame(df)
+
+
+@site_resource
+def get_backend():
+    site = site_config()
+    archive = OrderArchive(site.archive_dir)
+    if site.storage_backend == "sqlite":
+        return SQLiteBackend(site.sqlite_path, log_mode=site.order_log_mode, archive=archive)
+    # Google 表格依赖很重 (gspread / google-auth)，只在真正使用时加载
+    # st.connection 按名字缓存：多个工厂在同一个表格文件里时共用一个连接
+    import streamlit as st
+    from streamlit_gsheets import GSheetsConnection
+    return GSheetsBackend(st.connection(site.gsheets_connection, type=GSheetsConnection),
+                          log_mode=site.order_log_mode, archive=archive, prefix=site.worksheet_prefix)
+
+# --- 进程级共享缓存 ---
+# 所有会话共用同一份已解析(电话已规范化)的表。每次写入把全局数据版本加一，
+# 并记为该表的最新版本；缓存条目的版本落后于表版本时必须重新拉取。
+# 订单月分区共用 orders 的版本：任何订单写入都让所有分区的缓存失效。
+
+def version_key(table):
+    return "orders" if is_order_partition(table) else table
+
+class CacheEntry:
+    def __init__(self, df, version, fetched_at):
+        self.df = df
+        self.version = version
+        self.fetched_at = fetched_at
+
+
+class SharedCache:
+    def __init__(self, loader, max_staleness, refresh_after):
+        self.loader = loader
+        self.max_staleness = max_staleness
+        self.refresh_after = refresh_after
+        self.lock = threading.Lock()
+        self.version = 0
+        self.table_versions = {}
+        self.entries = {}
+        self.fetch_locks = {}
+        self.refreshing = set()
+
+    def bump(self, *tables):
+        # 返回 (各表写入前的版本, 新版本)，供增量维护的汇总判断自己是否跟得上
+        with self.lock:
+            tables = {version_key(t) for t in tables or set(self.entries) | set(self.table_versions)}
+            previous = {table: self.table_versions.get(table, 0) for table in tables}
+            self.version += 1
+            for table in tables:
+                self.table_versions[table] = self.version
+            return previous, self.version
+
+    def table_version(self, table):
+        with self.lock:
+            return self.table_versions.get(version_key(table), 0)
+
+    def is_fresh(self, table):
+        # get() 会直接返回缓存里的数据 (不需要同步重新拉取)
+        if self.max_staleness <= 0: return False
+        with self.lock:
+            entry = self.entries.get(table)
+            return self.is_valid(table, entry) and time_lib.monotonic() - entry.fetched_at <= self.max_staleness
+
+    def contains(self, table):
+        with self.lock:
+            return table in self.entries
+
+    def discard(self, table):
+        # 只丢掉缓存的数据，不推进版本：下次用到时重新拉取
+        with self.lock:
+            self.entries.pop(table, None)
+
+    def is_valid(self, table, entry):
+        return entry is not None and entry.version >= self.table_versions.get(version_key(table), 0)
+
+    def get(self, table):
+        if self.max_staleness <= 0:
+            return self.loader(table)
+        requested_at = time_lib.monotonic()
+        with self.lock:
+            entry = self.entries.get(table)
+            valid = self.is_valid(table, entry)
+        if valid:
+            age = requested_at - entry.fetched_at
+            if age <= self.max_staleness:
+                if age > self.refresh_after:
+                    self.refresh_async(table)
+                return entry.df
+        return self.fetch(table, requested_at)
+
+    def fetch(self, table, requested_at):
+        # 同一张表同一时间只拉取一次，其余会话等这次的结果
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(table, threading.Lock())
+        with fetch_lock:
+            with self.lock:
+                entry = self.entries.get(table)
+                if self.is_valid(table, entry) and entry.fetched_at >= requested_at:
+                    return entry.df
+                version = self.version
+            df = self.loader(table)
+            with self.lock:
+                self.entries[table] = CacheEntry(df, version, time_lib.monotonic())
+            return df
+
+    def refresh_async(self, table):
+        with self.lock:
+            if table in self.refreshing: return
+            self.refreshing.add(table)
+
+        def run():
+            try:
+                self.fetch(table, time_lib.monotonic())
+            except Exception:
+                pass
+            finally:
+                with self.lock:
+                    self.refreshing.discard(table)
+
+        threading.Thread(target=bind_site(run), name=f"cache-refresh-{table}", daemon=True).start()
+
+
+@site_resource
+def get_cache():
+    return SharedCache(load_cached, CACHE_MAX_STALENESS, CACHE_REFRESH_AFTER)
+
+def load_cached(table):
+    # 缓存里的订单表 (含月分区) 用紧凑表示；后端 load() 本身仍返回文本列，供读-改-写使用
+    df = get_backend().load(table)
+    return compact_order_frame(df) if version_key(table) == "orders" else df
+
+def on_data_changed(*tables):
+    # 不传表名表示全部失效 (例如管理员手动刷新)，变更流的订阅方也要重建
+    if not tables: get_change_feed().publish("reset")
+    return get_cache().bump(*tables)
+
+# --- 变更流 ---
+# 每条订单 / 用户变更追加一条记录，游标单调递增；看板记住上次的游标，轮询时只取之后的变更。
+# 只保留最近 CHANGE_FEED_SIZE 条；游标太旧或中间有整表级变更 (reset) 时返回 None，订阅方重建。
+
+class ChangeFeed:
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.cursor = 0
+        self.entries = deque(maxlen=size)
+
+    def publish(self, kind, **change):
+        with self.lock:
+            self.cursor += 1
+            self.entries.append((self.cursor, kind, change))
+            return self.cursor
+
+    def head(self):
+        with self.lock:
+            return self.cursor
+
+    def since(self, cursor):
+        # 返回 (新游标, [(类型, 内容)...])；没有新变更时不复制任何东西
+        with self.lock:
+            if cursor == self.cursor: return cursor, []
+            oldest = self.entries[0][0] if self.entries else self.cursor + 1
+            if cursor < oldest - 1 or cursor > self.cursor: return self.cursor, None
+            changes = [(kind, change) for seq, kind, change in self.entries if seq > cursor]
+            head = self.cursor
+        if any(kind == "reset" for kind, _ in changes): return head, None
+        return head, changes
+
+@site_resource
+def get_change_feed():
+    return ChangeFeed(CHANGE_FEED_SIZE)
+
+# --- 并发拉取 ---
+# 互不依赖的表放进有上限的线程池同时拉取，墙钟时间约等于最慢的那一张。
+# 同一张表的并发请求由 SharedCache.fetch 合并成一次。池内线程里再要求并发时直接顺序执行，避免池被占满后互相等待。
+FETCH_THREAD = threading.local()
+
+@resource
+def get_fetch_pool():
+    return ThreadPoolExecutor(max_workers=max(FETCH_WORKERS, 1), thread_name_prefix="fetch")
+
+def parallel_map(fn, items):
+    items = list(items)
+    if len(items) < 2 or getattr(FETCH_THREAD, "active", False):
+        return [fn(item) for item in items]
+
+    def run(item):
+        FETCH_THREAD.active = True
+        return fn(item)
+
+    return list(get_fetch_pool().map(bind_site(run), items))
+
+def read_table(sheet_name):
+    # 只读：返回共享缓存中的 DataFrame，调用方不得原地修改
+    try:
+        return get_cache().get(sheet_name)
+    except:
+        return pd.DataFrame()
+
+# --- 单次渲染的数据快照 ---
+# 每次脚本运行创建一个 DataSnapshot，所有业务函数都从它取数据，
+# 每张表在一次运行中最多读取一次；写入后失效对应的表。
+
+class DataSnapshot:
+    # overlay_pending=False：只读进程 (报表服务) 不启动写入队列，只看已写入后端的数据
+    def __init__(self, overlay_pending=True):
+        self.overlay_pending = overlay_pending
+        self.tables = {}
+        self.versions = {}
+        self.reads = {}
+
+    def table(self, name):
+        if name not in self.tables:
+            self.prefetch(name)
+        return self.tables[name]
+
+    def prefetch(self, *names):
+        # 把本次渲染要用的几张表一起拉取 (并发)，之后 table() 直接命中
+        missing = [name for name in dict.fromkeys(names) if name not in self.tables]
+        if not missing: return self
+        for name in missing:
+            self.reads[name] = self.reads.get(name, 0) + 1
+            # 先记版本再读：读到的数据至少包含该版本之前的所有写入
+            self.versions[name] = get_cache().table_version(name)
+        # 后端在调用线程创建 (Streamlit 的连接对象需要脚本上下文)
+        get_backend()
+        queue = get_write_queue() if self.overlay_pending else None
+        for name, df in zip(missing, parallel_map(read_table, missing)):
+            if version_key(name) == "orders" and queue is not None:
+                # 队列里还没落到后端的点击叠加在上面，所有会话立即可见
+                df = queue.overlay(df, name)
+            self.tables[name] = df
+        return self
+
+    def version(self, name):
+        # 快照里已有的表返回读取时记下的版本，否则是共享缓存的当前版本
+        return self.versions[name] if name in self.tables else get_cache().table_version(name)
+
+    @property
+    def users(self):
+        return self.table("users")
+
+    @property
+    def orders(self):
+        return self.table("orders")
+
+    # 单日 / 单月只读对应的月分区
+    def orders_on(self, date_str):
+        return self.table(order_partition(date_str))
+
+    def month_orders(self, year, month, columns=None):
+        table = order_partition(f"{year:04d}-{month:02d}")
+        backend = get_backend()
+        if columns is None or table not in backend.sealed_months():
+            return self.table(table)
+        # 已封存的月份不会变：直接内存映射读归档文件，只取需要的列
+        name = f"{table}[{','.join(columns)}]"
+        if name not in self.tables:
+            self.reads[name] = self.reads.get(name, 0) + 1
+            self.tables[name] = backend.read_archive(table, columns)
+        return self.tables[name]
+
+    def invalidate(self, *names):
+        for name in names:
+            self.tables.pop(name, None)
+            if name == "orders":
+                for table in [t for t in self.tables if is_order_partition(t)]:
+                    self.tables.pop(table)
+
+    def assert_read_budget(self):
+        over = {name: n for name, n in self.reads.items() if n > MAX_READS_PER_TABLE}
+        assert not over, f"本次渲染重复读取数据表 / tables read more than once per render: {over}"
+
+def write_db(sheet_name, df):
+    if 'phone' in df.columns:
+        df['phone'] = standardize_phone_series(df['phone'])
+    get_backend().write(sheet_name, df)
+    get_change_feed().publish("reset")
+    on_data_changed(sheet_name)
+
+@timed("admin_clean_database")
+def admin_clean_database(snap):
+    # 读-改-写必须基于后端最新数据，不能用缓存
+    users = get_backend().load("users")
+    if not users.empty:
+        users = users.drop_duplicates(subset=['phone'], keep='last')
+        write_db("users", users)
+    # 订单：折叠事件日志，并保证每个 (日期, 餐别, 电话) 只有一条
+    compact_orders()
+    snap.invalidate("users", "orders")
+
+# 一次性迁移：把所有表里的电话写成规范格式，并记录标记，之后读取跳过清洗
+def migrate_canonical_phones(snap):
+    backend = get_backend()
+    with backend.write_lock:
+        partitions = backend.order_partitions() if backend.partitioned() else []
+        for table in PHONE_TABLES + partitions:
+            try:
+                raw = backend.read(table)
+            except Exception:
+                continue  # 表不存在
+            if raw.empty: continue
+            backend.write(table, normalize_table(table, raw))
+        backend.set_meta("phones_canonical", "1")
+    on_data_changed()
+    snap.invalidate(*PHONE_TABLES)
+
+# 一次性迁移：把整张 orders 表按月拆到 orders_YYYY_MM 分区并登记目录，之后单日读写只碰当月分区。
+# 先写分区、再置标记、最后清空原表 (SQLite 在一个事务里完成)；中途失败可以重跑。日期无法识别的行留在原表。
+def migrate_order_partitions(snap):
+    count = get_backend().partition_orders()
+    on_data_changed()
+    snap.invalidate("orders")
+    return count
+
+# 封存已结账的月份：整月订单冻结成归档文件并记录校验和，然后从活数据中移除。
+# 之后该月只读，月报直接读归档文件。
+def seal_order_month(snap, year, month):
+    backend = get_backend()
+    table = order_partition(f"{year:04d}-{month:02d}")
+    if backend.archive is None or table in backend.sealed_months(): return None
+    if table >= order_partition(get_thai_time().strftime("%Y-%m")): return None
+    if backend.log_mode: backend.compact_order_log()
+    sealed = backend.seal_partition(table)
+    if sealed is None: return None
+    on_data_changed("orders")
+    snap.invalidate("orders")
+    return sealed
+
+# --- 点餐写入合并队列 ---
+# 所有会话的订单变更按 (日期, 餐别, 电话) 合并 (后写覆盖先写)，后台线程定时批量写入后端。
+# 入队先追加到本地日志并 fsync，写入成功后再从日志中移除，进程崩溃重启后会重放。
+
+class OrderWriteQueue:
+    def __init__(self, flush, journal_path, flush_ms, max_batch):
+        self.flush_fn = flush
+        self.journal_path = journal_path
+        self.interval = flush_ms / 1000
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = {}
+        self.generation = 0
+        self.overlay_memo = {}
+        self.replay_journal()
+        threading.Thread(target=bind_site(self.run), name=f"order-write-queue-{SITE.get()}", daemon=True).start()
+
+    def replay_journal(self):
+        if not os.path.exists(self.journal_path): return
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时写了一半的最后一行
+                self.pending[tuple(row[c] for c in ORDER_KEY)] = row
+        self.generation += 1
+
+    def enqueue(self, row):
+        key = tuple(row[c] for c in ORDER_KEY)
+        with self.lock:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending.pop(key, None)
+            self.pending[key] = row
+            self.generation += 1
+            full = len(self.pending) >= self.max_batch
+        if full: self.wakeup.set()
+
+    def pending_row(self, key):
+        # 还没写入后端的那条变更 (按 ORDER_KEY)，没有返回 None
+        with self.lock:
+            return self.pending.get(key)
+
+    def overlay(self, orders, table="orders"):
+        with self.lock:
+            if not self.pending: return orders
+            base, generation, merged = self.overlay_memo.get(table, (None, None, None))
+            if base is orders and generation == self.generation: return merged
+            rows = list(self.pending.values())
+            generation = self.generation
+        if table != "orders":
+            rows = [row for row in rows if order_partition(row["date"]) == table]
+            # 这个月没有待写入的点击 (例如导出的历史月份)：原样返回，也不记进 overlay_memo
+            if not rows: return orders
+        merged = fold_order_events(orders, pd.DataFrame(rows, columns=TABLE_COLUMNS["orders"]))
+        with self.lock:
+            self.overlay_memo[table] = (orders, generation, merged)
+        return merged
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch = dict(self.pending)
+            if not batch: return 0
+            self.flush_fn(list(batch.values()))
+            with self.lock:
+                # 写入期间又被改过的键保留，等下一轮
+                for key, row in batch.items():
+                    if self.pending.get(key) is row: del self.pending[key]
+                self.generation += 1
+                # 叠加结果只在有待写入点击时有用，队列清空后不再持有各月的数据表
+                if not self.pending: self.overlay_memo.clear()
+                self.rewrite_journal()
+            return len(batch)
+
+    def rewrite_journal(self):
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for row in self.pending.values():
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass  # 后端暂时不可用：保留在队列和日志里，下一轮重试
+
+
+def flush_order_batch(rows):
+    backend = get_backend()
+    try:
+        backend.apply_orders(rows)
+    except ValueError:
+        # 入队之后才被封存的月份写不进去了：丢掉这些点击再写一次，不能让整批一直重试
+        backend.refresh_sealed()
+        backend.apply_orders([r for r in rows if order_partition(r["date"]) not in backend.sealed_months()])
+    # 这些变更入队时已经计入每日汇总，这里只推进版本
+    previous, version = on_data_changed("orders")
+    get_rollups().advance("orders", previous["orders"], version)
+
+@site_resource
+def get_write_queue():
+    if WRITE_QUEUE_FLUSH_MS <= 0: return None
+    return OrderWriteQueue(flush_order_batch, site_config().write_queue_journal, WRITE_QUEUE_FLUSH_MS, WRITE_QUEUE_MAX_BATCH)
+
+def compact_orders():
+    count = get_backend().compact_order_log()
+    on_data_changed("orders")
+    return count
+
+@site_resource
+def start_order_compactor():
+    # 每个进程每个工厂只启动一个后台压缩线程
+    if not site_config().order_log_mode: return None
+
+    def loop():
+        while True:
+            time_lib.sleep(COMPACT_INTERVAL_SEC)
+            try:
+                compact_orders()
+            except Exception:
+                pass
+
+    worker = threading.Thread(target=bind_site(loop), name=f"order-log-compactor-{SITE.get()}", daemon=True)
+    worker.start()
+    return worker
+
+# ==========================================
+# 4. 业务逻辑
+# ==========================================
+
+# --- 用户目录 ---
+# 电话 -> 用户行 的字典索引 + 规范化姓名计数，每个 users 版本只构建一次，
+# 注册 / 删除 / 改状态时原地更新 (版本衔接规则同每日汇总)。登录与注册查重都是 O(1)。
+
+class UserDirectory:
+    def __init__(self, users, version):
+        self.version = version
+        self.built_at = time_lib.monotonic()
+        self.by_phone = {}
+        self.name_counts = {}
+        if users.empty: return
+        for row in users.to_dict('records'):
+            if pd.isna(row.get('status')): row['status'] = 'active'
+            # 重复电话取第一行，与原来 iloc[0] 的行为一致
+            if row['phone'] in self.by_phone: continue
+            self.by_phone[row['phone']] = row
+            self._count_name(row.get('name'), 1)
+
+    def _count_name(self, name, delta):
+        if pd.isna(name): return
+        key = normalize_name(name)
+        self.name_counts[key] = self.name_counts.get(key, 0) + delta
+        if self.name_counts[key] <= 0: del self.name_counts[key]
+
+    def get(self, phone):
+        return self.by_phone.get(phone)
+
+    def name_exists(self, name):
+        return normalize_name(name) in self.name_counts
+
+    def add(self, row):
+        self.by_phone[row['phone']] = dict(row)
+        self._count_name(row['name'], 1)
+
+    def remove(self, phone):
+        row = self.by_phone.pop(phone, None)
+        if row is not None: self._count_name(row.get('name'), -1)
+
+    def set_status(self, phones, status):
+        for phone in phones:
+            if phone in self.by_phone: self.by_phone[phone]['status'] = status
+
+
+class UserDirectoryStore:
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.directory = None
+
+    def get(self, version):
+        with self.lock:
+            d = self.directory
+            if d is None or d.version != version or time_lib.monotonic() - d.built_at > self.max_age:
+                self.directory = None
+                return None
+            return d
+
+    def put(self, directory, version):
+        with self.lock:
+            if directory.version == version: self.directory = directory
+
+    def apply(self, previous, version, update):
+        with self.lock:
+            if self.directory is None: return
+            if self.directory.version != previous:
+                self.directory = None
+                return
+            update(self.directory)
+            self.directory.version = version
+
+
+@site_resource
+def get_user_directories():
+    return UserDirectoryStore(CACHE_MAX_STALENESS)
+
+def get_user_directory(snap):
+    store = get_user_directories()
+    current = get_cache().table_version("users")
+    directory = store.get(current)
+    if directory is None:
+        users = snap.users
+        directory = UserDirectory(users, snap.versions["users"])
+        store.put(directory, current)
+    return directory
+
+def get_user_by_phone(snap, phone):
+    user = get_user_directory(snap).get(standardize_phone(phone))
+    return pd.Series(user) if user is not None else None
+
+def check_name_exist(snap, name):
+    return get_user_directory(snap).name_exists(name)
+
+@timed("register_new_user")
+def register_new_user(snap, phone, name):
+    clean_p = standardize_phone(phone)
+    directory = get_user_directory(snap)
+    if directory.get(clean_p) is not None: return "PHONE_EXIST"
+    if directory.name_exists(name): return "NAME_EXIST"
+    
+    # 默认新用户状态为 active
+    new_user = {
+        "phone": clean_p,
+        "name": str(name).strip(),
+        "reg_date": get_thai_time().strftime("%Y-%m-%d"),
+        "status": "active"
+    }
+    try:
+        get_backend().add_user(new_user)
+    except sqlite3.IntegrityError:
+        # 目录还没看到其他进程刚注册的同一电话
+        on_data_changed("users")
+        return "PHONE_EXIST"
+    previous, version = on_data_changed("users")
+    get_user_directories().apply(previous["users"], version, lambda d: d.add(new_user))
+    publish_change("users", previous["users"], version, "user_added", phone=clean_p, name=new_user["name"])
+    snap.invalidate("users")
+    return "SUCCESS"
+
+def publish_change(table, previous, version, kind, **change):
+    # 一条变更同时用于：增量更新共享的每日汇总 + 写入变更流 (厨师看板轮询)
+    get_rollups().apply_change(table, previous, version, kind, change)
+    get_change_feed().publish(kind, **change)
+
+def update_user_status(snap, phone, new_status):
+    return batch_update_user_status(snap, [phone], new_status)
+
+# 新增：批量更新用户状态
+@timed("batch_update_user_status")
+def batch_update_user_status(snap, phone_list, new_status):
+    # 清洗电话号码列表
+    clean_phones = [standardize_phone(p) for p in phone_list]
+    backend = get_backend()
+    directory = get_user_directory(snap)
+    timeline = get_status_timeline(snap)
+    if backend.set_user_status(clean_phones, new_status):
+        # 状态变更从今天起生效，之前的日期 (报表) 保持原状态
+        today = get_thai_time().strftime("%Y-%m-%d")
+        changes = [{"phone": p, "status": directory.get(p)['status'], "effective_from": STATUS_BASELINE_DATE}
+                   for p in clean_phones if p not in timeline.phones and directory.get(p) is not None]
+        changes += [{"phone": p, "status": new_status, "effective_from": today} for p in clean_phones]
+        backend.append("user_status_log", pd.DataFrame(changes, columns=TABLE_COLUMNS["user_status_log"]))
+        previous, version = on_data_changed("users", "user_status_log")
+        get_user_directories().apply(previous["users"], version, lambda d: d.set_status(clean_phones, new_status))
+        publish_change("users", previous["users"], version, "status",
+                       phones=clean_phones, status=new_status, effective_from=today)
+        snap.invalidate("users", "user_status_log")
+        return True
+    return False
+
+@timed("update_order")
+def update_order(snap, phone, name, meal_type, action, target_date_str):
+    target_p = standardize_phone(phone)
+    row = {
+        "date": target_date_str, "phone": target_p, "name": name,
+        "meal_type": meal_type, "action": action,
+        "time": get_thai_time().strftime("%H:%M:%S")
+    }
+    # 封存月份直接拒绝，不能让坏数据进入写入队列
+    get_backend().check_writable([row])
+    queue = get_write_queue()
+    if queue is not None:
+        # 进队列即对所有会话可见 (快照叠加)，版本在批量写入后端时才推进
+        queue.enqueue(row)
+        version = get_cache().table_version("orders")
+        publish_change("orders", version, version, "order",
+                       date=target_date_str, meal_type=meal_type, phone=target_p, action=action)
+        snap.invalidate("orders")
+        return
+    get_backend().apply_order(row)
+    previous, version = on_data_changed("orders")
+    publish_change("orders", previous["orders"], version, "order",
+                   date=target_date_str, meal_type=meal_type, phone=target_p, action=action)
+    snap.invalidate("orders")
+
+@timed("get_status")
+def get_status(snap, phone, meal_type, target_date_str):
+    target_p = standardize_phone(phone)
+    table = order_partition(target_date_str)
+    backend = get_backend()
+    # 每次点击都会让共享缓存里的订单失效：快照里还没有这个月、缓存也要重新拉取时，
+    # 支持点查的后端 (SQLite) 只查这一格，不为一个状态重读整个月
+    if (backend.point_reads and table not in snap.tables and not get_cache().is_fresh(table)
+            and table not in backend.sealed_months()):
+        queue = get_write_queue() if snap.overlay_pending else None
+        pending = queue.pending_row((target_date_str, meal_type, target_p)) if queue is not None else None
+        if pending is not None:
+            return None if pending["action"] == "DELETE" else pending["action"]
+        return backend.get_order_action(target_date_str, meal_type, target_p)
+    df = snap.orders_on(target_date_str)
+    if df.empty: return None
+    res = df[(df['date'] == target_date_str) & (df['meal_type'] == meal_type) & (df['phone'] == target_p)]
+    return res.iloc[-1]['action'] if not res.empty else None
+
+# --- 批量改餐 ---
+# 全厂停餐、整条线加班留饭：给选定员工 (None 表示全部) 在一段日期内的若干餐统一设置同一个动作。
+# 先整体校验，全部通过后一次写入后端 (分区模式下每个涉及的月份一次)，不再逐人逐餐读写整张表。
+BULK_MAX_DAYS = 62
+
+def bulk_order_actions(meal_type):
+    return ["CANCELED", "BOOKED", "DELETE"] + [f"LATE_{t}" for t in site_config().late_options(meal_type)]
+
+@timed("bulk_update_orders")
+def bulk_update_orders(snap, phones, meal_types, action, start_date_str, end_date_str):
+    try:
+        start = datetime.strptime(start_date_str, "%Y-%m-%d").date()
+        end = datetime.strptime(end_date_str, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        raise ValueError(f"日期无效 / invalid date: {start_date_str} ~ {end_date_str}")
+    if end < start:
+        raise ValueError("结束日期早于开始日期 / end date is before start date")
+    if (end - start).days >= BULK_MAX_DAYS:
+        raise ValueError(f"一次最多 {BULK_MAX_DAYS} 天 / at most {BULK_MAX_DAYS} days per bulk change")
+    if not meal_types:
+        raise ValueError("请选择餐别 / no meal selected")
+    for meal_type in meal_types:
+        if meal_type not in MEAL_TYPES:
+            raise ValueError(f"未知餐别 / unknown meal: {meal_type}")
+        if action not in bulk_order_actions(meal_type):
+            raise ValueError(f"{meal_type} 不能设置 / not a valid {meal_type} action: {action}")
+
+    directory = get_user_directory(snap)
+    if phones is None:
+        targets = [(p, row['name']) for p, row in directory.by_phone.items()]
+    else:
+        targets = {}
+        for raw in phones:
+            user = directory.get(standardize_phone(raw))
+            if user is None:
+                raise ValueError(f"用户不存在 / unknown user: {raw}")
+            targets[user['phone']] = user['name']
+        targets = list(targets.items())
+    if not targets:
+        raise ValueError("没有选中员工 / no users selected")
+
+    now = get_thai_time().strftime("%H:%M:%S")
+    dates = [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end - start).days + 1)]
+    rows = [{"date": d, "phone": p, "name": name, "meal_type": m, "action": action, "time": now}
+            for d in dates for m in meal_types for p, name in targets]
+    backend = get_backend()
+    backend.check_writable(rows)
+    # 队列里更早的点击先落到后端，否则稍后刷写会把这次批量修改覆盖掉
+    queue = get_write_queue()
+    if queue is not None: queue.flush()
+    backend.apply_orders(rows)
+    on_data_changed("orders")
+    # 变更太多，不逐条进变更流：看板和每日汇总按版本整体重建
+    get_change_feed().publish("reset")
+    snap.invalidate("orders")
+    return len(rows)
+
+def delete_user_logic(snap, phone):
+    target = standardize_phone(phone)
+    get_backend().delete_user(target)
+    previous, version = on_data_changed("users")
+    get_user_directories().apply(previous["users"], version, lambda d: d.remove(target))
+    publish_change("users", previous["users"], version, "user_deleted", phone=target)
+    snap.invalidate("users")
+
+# --- 用户状态时间线 ---
+# user_status_log 里每条记录是 (电话, 状态, 生效日期)。某人某天的状态用 as-of 连接求出：
+# 生效日期 <= 当天的最后一条记录；从未改过状态的人用 users 表里的当前状态。
+# 所有日期一次 merge_asof，报表保持历史准确且仍是线性复杂度。
+
+class StatusTimeline:
+    def __init__(self, log):
+        self.source = log
+        if log.empty or 'effective_from' not in log.columns:
+            log = pd.DataFrame(columns=TABLE_COLUMNS["user_status_log"])
+        self.log = pd.DataFrame({
+            "phone": log['phone'].astype(str),
+            "effective_from": pd.to_datetime(log['effective_from']),
+            "as_of_status": log['status'].astype(str),
+        }).sort_values("effective_from", kind="stable")
+        self.phones = set(self.log['phone'])
+
+    @timed("rules.status_on")
+    def status_on(self, phones, dates, current):
+        # phones / dates / current 等长 (dates 可以是单个日期)；返回每行当天的状态
+        current = np.asarray(current, dtype=object)
+        result = current.copy()
+        if not self.phones or len(result) == 0: return result
+        query = pd.DataFrame({"phone": pd.Series(phones, dtype=str).to_numpy(), "row": np.arange(len(result))})
+        query["date"] = pd.to_datetime(pd.Series(dates, index=query.index) if np.ndim(dates) else dates)
+        query = query[query['phone'].isin(self.phones)].sort_values("date", kind="stable")
+        if query.empty: return result
+        joined = pd.merge_asof(query, self.log, left_on="date", right_on="effective_from", by="phone", direction="backward")
+        hit = joined['as_of_status'].notna().to_numpy()
+        result[joined['row'].to_numpy()[hit]] = joined['as_of_status'].to_numpy(dtype=object)[hit]
+        return result
+
+    @timed("rules.status_grid")
+    def status_grid(self, phones, days, current):
+        # 电话 × 日期 的状态矩阵；只有改过状态的人参与连接
+        current = np.asarray(current, dtype=object)
+        grid = np.repeat(current[:, None], len(days), axis=1)
+        changed = np.flatnonzero(pd.Index(phones).isin(self.phones))
+        if len(changed) == 0: return grid
+        rows = self.status_on(np.repeat(np.asarray(phones, dtype=object)[changed], len(days)),
+                              np.tile(np.asarray(days), len(changed)),
+                              np.repeat(current[changed], len(days)))
+        grid[changed] = rows.reshape(len(changed), len(days))
+        return grid
+
+
+@site_resource
+def get_timeline_memo():
+    return {}
+
+def get_status_timeline(snap):
+    # 日志表没变 (共享缓存返回同一个对象) 就复用已排序的时间线
+    log = snap.table("user_status_log")
+    memo = get_timeline_memo()
+    timeline = memo.get("timeline")
+    if timeline is None or timeline.source is not log:
+        timeline = StatusTimeline(log)
+        memo["timeline"] = timeline
+    return timeline
+
+def get_user_status_on(snap, phone, date_str, current):
+    return get_status_timeline(snap).status_on([standardize_phone(phone)], date_str, [current])[0]
+
+# --- 规则日历 ---
+# 默认吃不吃、几点截止，由规则配置 MEAL_RULES 编译成日历表：按 (用户组, 餐别, 日期) 预先算好
+# "默认不吃" 标志和截止时间 (当天的第几分钟)。查询只是数组下标，规则再多也不增加逐人逐天的判断。
+# 日历按年编译、按配置版本缓存。配置示例 (secrets.toml)：
+#   [MEAL_RULES]
+#   off_weekdays = [6]                        # 默认不吃的星期 (0=周一 … 6=周日)，不写就是只有周日
+#   holidays = ["2026-12-31", "2027-01-01"]   # 放假：全天默认不吃
+#   workdays = ["2027-01-03"]                 # 调休上班：即使是休息的星期也按工作日
+#   deadlines = { Lunch = "10:00", Dinner = "15:00" }
+#   special_deadlines = { "2026-12-24" = { Dinner = "12:00" } }
+#   [MEAL_RULES.groups.saturday_shift]        # 分组：写了的键覆盖全厂设置
+#   phones = ["0812345678"]
+#   off_weekdays = [5, 6]
+#   meals = { Dinner = "NO" }                 # 这一餐平时也默认不吃
+# 休假的人仍然所有餐默认不吃；手动点过的动作优先于默认规则。
+DEFAULT_GROUP = "default"
+
+def rules_day(value):
+    try:
+        return (pd.Timestamp(datetime.strptime(str(value), "%Y-%m-%d")) - DAY_EPOCH).days
+    except ValueError:
+        raise ValueError(f"规则日期无效 / invalid date in MEAL_RULES: {value}")
+
+def rules_minutes(value):
+    try:
+        t = value if isinstance(value, time) else datetime.strptime(str(value), "%H:%M").time()
+    except ValueError:
+        raise ValueError(f"规则时间无效 / invalid time in MEAL_RULES: {value}")
+    return t.hour * 60 + t.minute
+
+class RulesCalendar:
+    def __init__(self, rules, version):
+        self.version = version
+        self.lock = threading.Lock()
+        groups = rules.get("groups", {})
+        base = {key: value for key, value in rules.items() if key != "groups"}
+        self.groups = [DEFAULT_GROUP] + sorted(groups)
+        self.specs = [self.compile_spec(base)] + [self.compile_spec({**base, **groups[name]}) for name in self.groups[1:]]
+        self.group_of = {}
+        for idx, name in enumerate(self.groups[1:], start=1):
+            for phone in groups[name].get("phones", []):
+                self.group_of[standardize_phone(phone)] = idx
+        self.years = {}  # 年份 -> (1 月 1 日的天数, 默认不吃 [组, 餐别, 天], 截止分钟 [组, 餐别, 天])
+
+    @staticmethod
+    def compile_spec(spec):
+        deadlines = {"Lunch": LUNCH_DEADLINE, "Dinner": DINNER_DEADLINE, **spec.get("deadlines", {})}
+        meals = spec.get("meals", {})
+        return {
+            "off_weekdays": [int(d) for d in spec.get("off_weekdays", [6])],
+            "holidays": [rules_day(d) for d in spec.get("holidays", [])],
+            "workdays": [rules_day(d) for d in spec.get("workdays", [])],
+            "meal_off": [meals.get(meal, "NORMAL") == "NO" for meal in MEAL_TYPES],
+            "cutoff": [rules_minutes(deadlines[meal]) for meal in MEAL_TYPES],
+            "special": [{rules_day(d): rules_minutes(v[meal]) for d, v in spec.get("special_deadlines", {}).items() if meal in v}
+                        for meal in MEAL_TYPES],
+        }
+
+    def year(self, year):
+        with self.lock:
+            table = self.years.get(year)
+        if table is None:
+            table = self.compile_year(year)
+            with self.lock:
+                self.years[year] = table
+        return table
+
+    def compile_year(self, year):
+        days = pd.date_range(f"{year}-01-01", f"{year}-12-31", freq="D")
+        ordinals = np.asarray((days - DAY_EPOCH).days)
+        weekday = np.asarray(days.weekday)
+        off = np.zeros((len(self.groups), len(MEAL_TYPES), len(days)), dtype=bool)
+        cutoff = np.zeros(off.shape, dtype=np.int16)
+        for g, spec in enumerate(self.specs):
+            day_off = (np.isin(weekday, spec["off_weekdays"]) | np.isin(ordinals, spec["holidays"])) & ~np.isin(ordinals, spec["workdays"])
+            for m in range(len(MEAL_TYPES)):
+                off[g, m] = day_off | spec["meal_off"][m]
+                cutoff[g, m] = spec["cutoff"][m]
+                for day, minutes in spec["special"][m].items():
+                    if ordinals[0] <= day <= ordinals[-1]: cutoff[g, m, day - ordinals[0]] = minutes
+        return ordinals[0], off, cutoff
+
+    def tables(self, dates):
+        # 日期 -> (默认不吃 [组, 餐别, 天], 截止分钟 [组, 餐别, 天])
+        dates = pd.DatetimeIndex(pd.to_datetime(dates))
+        ordinals, years = np.asarray((dates - DAY_EPOCH).days), np.asarray(dates.year)
+        off = np.empty((len(self.groups), len(MEAL_TYPES), len(dates)), dtype=bool)
+        cutoff = np.empty(off.shape, dtype=np.int16)
+        for year in np.unique(years):
+            start, year_off, year_cutoff = self.year(int(year))
+            mask = years == year
+            off[:, :, mask] = year_off[:, :, ordinals[mask] - start]
+            cutoff[:, :, mask] = year_cutoff[:, :, ordinals[mask] - start]
+        return off, cutoff
+
+    def group_codes(self, phones):
+        return np.fromiter((self.group_of.get(p, 0) for p in phones), dtype=np.intp, count=len(phones))
+
+    def off_by_group(self, date_str, meal_type):
+        # 某天某餐每个组是否默认不吃
+        return self.tables([date_str])[0][:, MEAL_TYPES.index(meal_type), 0]
+
+    def off_grid(self, phones, days):
+        # 每人 × 餐别 × 天 的默认不吃标志
+        return self.tables(days)[0][self.group_codes(phones)]
+
+    def meal_rule(self, phone, date_str, meal_type):
+        # 单人单餐：(默认不吃, 截止时间)
+        off, cutoff = self.tables([date_str])
+        g, m = self.group_of.get(standardize_phone(phone), 0), MEAL_TYPES.index(meal_type)
+        minutes = int(cutoff[g, m, 0])
+        return bool(off[g, m, 0]), time(minutes // 60, minutes % 60)
+
+
+@site_resource
+def get_rules_memo():
+    return {}
+
+def get_rules_calendar():
+    memo = get_rules_memo()
+    rules = memo.get("calendar")
+    site = site_config()
+    if rules is None or rules.version != site.rules_version:
+        rules = RulesCalendar(site.meal_rules, site.rules_version)
+        memo["calendar"] = rules
+    return rules
+
+# 核心逻辑升级：判断状态
+# 参数 is_off: 这一天这一餐按规则日历默认不吃 (周日、节假日、分组设置)
+# 参数 user_status: 'active' 或 'leave'
+@timed("rules.resolve_meal_status")
+def resolve_meal_status(action, is_off, user_status="active"):
+    # 1. 优先判断是否有手动操作记录
+    if pd.notna(action) and action is not None:
+        s_act = str(action)
+        if s_act == "CANCELED": return "NO"
+        if s_act == "DELETE": 
+            # 如果点击了撤销，回归默认状态
+            # 如果是休假，默认就是不吃；如果是正常，看规则日历
+            if user_status == 'leave': return "NO"
+            return "NO" if is_off else "NORMAL"
+        if s_act == "BOOKED": return "NORMAL"
+        if s_act.startswith("LATE"): return s_act
+    
+    # 2. 如果没有手动记录，走默认规则
+    
+    # 如果用户在休假，默认就是不吃
+    if user_status == 'leave':
+        return "NO"
+        
+    # 如果用户正常
+    return "NO" if is_off else "NORMAL"
+
+# 向量化版本：规则与 resolve_meal_status 完全一致，一次处理整列
+# actions / is_off / user_status 为等长数组 (标量会自动广播)，返回状态数组
+@timed("rules.resolve_meal_status_vec")
+def resolve_meal_status_vec(actions, is_off, user_status="active"):
+    actions = np.asarray(actions, dtype=object)
+    is_off = np.broadcast_to(np.asarray(is_off, dtype=bool), actions.shape)
+    on_leave = np.broadcast_to(np.asarray(user_status, dtype=object) == 'leave', actions.shape)
+
+    # 没有记录的位置当作空字符串，不会命中任何动作
+    s_act = np.where(pd.notna(actions), actions, "").astype(str)
+
+    # 没有手动记录 (或撤销 DELETE / 未知动作) 时走默认规则：休假或周日不吃
+    default = np.where(on_leave | is_off, "NO", "NORMAL")
+    return np.select(
+        [s_act == "CANCELED", s_act == "BOOKED", np.char.startswith(s_act, "LATE")],
+        ["NO", "NORMAL", s_act],
+        default=default,
+    ).astype(object)
+
+# 编码版本：actions 是按 categories 编码的动作 (-1 表示没有记录)。每个类别只按上面的规则解析一次，
+# 再按编码查表；依赖默认规则的类别 (撤销 / 未知 / 没有记录) 按 is_off 和状态逐格取默认值
+@timed("rules.resolve_meal_status_codes")
+def resolve_meal_status_codes(codes, categories, is_off, user_status="active"):
+    labels = np.append(np.asarray(categories, dtype=object), None)
+    explicit = resolve_meal_status_vec(labels, False, "active")
+    follows_default = explicit != resolve_meal_status_vec(labels, True, "active")
+    codes = np.asarray(codes)
+    default = np.where((np.asarray(user_status, dtype=object) == 'leave') | np.asarray(is_off, dtype=bool), "NO", "NORMAL")
+    return np.where(follows_default[codes], default, explicit[codes]).astype(object)
+
+# --- 每日人数汇总 (厨房看板) ---
+# 每个 (日期, 餐别) 一份：NORMAL / NO / LATE_<时间> 人数和留饭名单。
+# 第一次查看时从快照构建，之后由下单、改状态、注册、删除增量更新，看板读取为 O(1)。
+# 汇总记录自己对应的 users / orders 表版本；增量更新只在版本刚好衔接时应用，
+# 其他途径的写入 (整表写、压缩、手动刷新) 会让版本对不上，汇总随之丢弃重建。
+
+class DailyRollup:
+    def __init__(self, date_str, meal_type, versions):
+        self.date_str = date_str
+        self.meal_type = meal_type
+        self.versions = dict(versions)
+        self.built_at = time_lib.monotonic()
+        # 当天这一餐每个用户组是否默认不吃 (规则日历)
+        self.rules_version = site_config().rules_version
+        self.off_by_group = get_rules_calendar().off_by_group(date_str, meal_type)
+        self.users = {}      # phone -> [name, status]
+        # phone -> 用户表里这个电话的行数：历史重复数据按行计人数，与用户列表、原来的统计一致
+        self.rows = {}
+        self.actions = {}    # phone -> 当天该餐的手动动作 (包括已删除用户的记录)
+        self.resolved = {}   # phone -> (解析后的状态, 计入的行数)
+        self.counts = {}
+        self.total_rows = 0
+        self.late_names = {}  # LATE_<时间> -> {phone: name}
+
+    @classmethod
+    @timed("rules.rollup_build")
+    def build(cls, date_str, meal_type, users, orders, versions, timeline=None):
+        rollup = cls(date_str, meal_type, versions)
+        if not orders.empty:
+            day = orders[(orders['date'] == date_str) & (orders['meal_type'] == meal_type)]
+            rollup.actions = dict(zip(day['phone'], day['action']))
+        if not users.empty:
+            # 重复电话的姓名、状态以最后一行为准 (与"深度修复"后的数据一致)，人数按行数计
+            rollup.rows = users['phone'].value_counts().to_dict()
+            users = users.drop_duplicates(subset=['phone'], keep='last')
+            if 'status' in users.columns:
+                statuses = users['status'].fillna('active')
+            else:
+                statuses = pd.Series('active', index=users.index)
+            if timeline is not None:
+                # 当天生效的状态 (历史日期不受之后改状态的影响)
+                statuses = pd.Series(timeline.status_on(users['phone'], date_str, statuses), index=users.index)
+            is_off = rollup.off_by_group[get_rules_calendar().group_codes(users['phone'])]
+            resolved = resolve_meal_status_vec(users['phone'].map(rollup.actions), is_off, statuses)
+            for phone, name, status, res in zip(users['phone'], users['name'], statuses, resolved):
+                rollup.users[phone] = [name, status]
+                rollup._add(phone, res)
+        return rollup
+
+    def _add(self, phone, status):
+        rows = self.rows.get(phone, 1)
+        self.resolved[phone] = (status, rows)
+        self.counts[status] = self.counts.get(status, 0) + rows
+        self.total_rows += rows
+        if status.startswith("LATE"):
+            self.late_names.setdefault(status, {})[phone] = self.users[phone][0]
+
+    def _remove(self, phone):
+        status, rows = self.resolved.pop(phone, (None, 0))
+        if status is None: return
+        self.counts[status] -= rows
+        self.total_rows -= rows
+        if status.startswith("LATE"):
+            self.late_names[status].pop(phone, None)
+
+    def _refresh(self, phone):
+        self._remove(phone)
+        if phone in self.users:
+            name, status = self.users[phone]
+            is_off = self.off_by_group[get_rules_calendar().group_of.get(phone, 0)]
+            self._add(phone, resolve_meal_status(self.actions.get(phone), is_off, status))
+
+    @timed("rules.rollup_apply_change")
+    def apply_change(self, kind, change):
+        # 变更流里的一条变更 (也是共享汇总的增量更新)
+        if kind == "order":
+            if (change["date"], change["meal_type"]) == (self.date_str, self.meal_type):
+                self.set_action(change["phone"], change["action"])
+        elif kind == "status":
+            # 状态从生效日期起才影响
+            if self.date_str < change["effective_from"]: return
+            for phone in change["phones"]:
+                if phone in self.users: self.set_user(phone, self.users[phone][0], change["status"])
+        elif kind == "user_added":
+            # 同一条变更可能被重复应用 (看板先取游标再读汇总)，行数不能累加
+            self.rows.setdefault(change["phone"], 1)
+            self.set_user(change["phone"], change["name"], "active")
+        elif kind == "user_deleted":
+            self.drop_user(change["phone"])
+
+    def set_action(self, phone, action):
+        if action == "DELETE":
+            self.actions.pop(phone, None)
+        else:
+            self.actions[phone] = action
+        self._refresh(phone)
+
+    def set_user(self, phone, name, status):
+        self.users[phone] = [name, status]
+        self._refresh(phone)
+
+    def drop_user(self, phone):
+        # 删除用户会删掉这个电话的所有行
+        self.users.pop(phone, None)
+        self.rows.pop(phone, None)
+        self._remove(phone)
+
+    def total(self):
+        return self.total_rows
+
+    def eaters(self):
+        return self.total() - self.counts.get("NO", 0)
+
+    def late_groups(self):
+        # {取餐时间: [姓名...]}，只含有人的时间段
+        return {slot.split('_')[1] if '_' in slot else 'Unknown': list(names.values())
+                for slot, names in sorted(self.late_names.items()) if names}
+
+
+class RollupStore:
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.rollups = {}
+
+    def get(self, date_str, meal_type, versions):
+        with self.lock:
+            rollup = self.rollups.get((date_str, meal_type))
+            if rollup is None: return None
+            # 版本对不上、规则改过或太旧 (可能有其他进程/手工修改表格) 就丢弃重建
+            if (rollup.versions != versions or rollup.rules_version != site_config().rules_version
+                    or time_lib.monotonic() - rollup.built_at > self.max_age):
+                del self.rollups[(date_str, meal_type)]
+                return None
+            return rollup
+
+    def put(self, rollup, versions):
+        with self.lock:
+            if rollup.versions == versions:
+                self.rollups[(rollup.date_str, rollup.meal_type)] = rollup
+
+    def snapshot(self, rollup):
+        # 会话自己持有、自己增量更新的副本 (厨师看板)：在锁内复制，其他会话的点击不会只应用了一半
+        with self.lock:
+            return copy.deepcopy(rollup)
+
+    def _advance(self, table, previous, version, update):
+        with self.lock:
+            for key, rollup in list(self.rollups.items()):
+                if rollup.versions.get(table) != previous:
+                    del self.rollups[key]
+                    continue
+                update(rollup)
+                rollup.versions[table] = version
+
+    def advance(self, table, previous, version):
+        self._advance(table, previous, version, lambda rollup: None)
+
+    def apply_change(self, table, previous, version, kind, change):
+        self._advance(table, previous, version, lambda rollup: rollup.apply_change(kind, change))
+
+
+@site_resource
+def get_rollups():
+    return RollupStore(CACHE_MAX_STALENESS)
+
+@timed("get_daily_rollup")
+def get_daily_rollup(snap, date_str, meal_type):
+    cache = get_cache()
+    current = {"users": cache.table_version("users"), "orders": cache.table_version("orders")}
+    rollup = get_rollups().get(date_str, meal_type, current)
+    if rollup is None:
+        snap.prefetch("users", order_partition(date_str), "user_status_log")
+        users, orders = snap.users, snap.orders_on(date_str)
+        versions = {"users": snap.versions["users"], "orders": snap.versions[order_partition(date_str)]}
+        rollup = DailyRollup.build(date_str, meal_type, users, orders, versions, get_status_timeline(snap))
+        get_rollups().put(rollup, current)
+    return rollup
+
+def copy_daily_rollup(snap, date_str, meal_type):
+    return get_rollups().snapshot(get_daily_rollup(snap, date_str, meal_type))
+
+# 月报：一次性构建 用户 × 天 × 餐别 的稠密网格，用最新动作覆盖后沿各轴求和
+# 复杂度 O(用户数 × 天数 + 订单数)
+@timed("calculate_monthly_stats")
+def calculate_monthly_stats(snap, year, month):
+    table = order_partition(f"{year:04d}-{month:02d}")
+    snap.prefetch("users", "user_status_log", *([] if table in get_backend().sealed_months() else [table]))
+    users = snap.users
+    orders = snap.month_orders(year, month, columns=["date", "phone", "meal_type", "action"])
+    if users.empty: return None, None
+    
+    # 填充 status 默认值
+    if 'status' in users.columns:
+        statuses = users['status'].fillna('active')
+    else:
+        statuses = pd.Series('active', index=users.index)
+    
+    start_date = f"{year}-{month:02d}-01"
+    end_day = calendar.monthrange(year, month)[1]
+    days = pd.date_range(start_date, periods=end_day, freq="D")
+    
+    # 同一电话的多行 (历史重复数据) 结果相同：网格按去重后的电话建，每日人数按行数加权
+    # phone -> 当前状态 的映射，作为没有状态变更记录的人的默认值
+    phones = users['phone']
+    user_status_map = dict(zip(phones, statuses))
+    uniq_phones = pd.Index(phones.drop_duplicates()).rename(None)
+    row_weights = phones.value_counts().reindex(uniq_phones).to_numpy()
+    # 每人每天的状态：按状态变更日志做 as-of 连接 (没改过状态的人整月都是当前状态)
+    uniq_status = uniq_phones.map(user_status_map).to_numpy(dtype=object)
+    status_grid = get_status_timeline(snap).status_grid(uniq_phones, days, uniq_status)
+
+    # 本月订单：按编码填进 电话 × 餐别 × 天 的动作编码网格，每格取最后一条 (-1 表示没有记录)
+    actions = np.full((len(uniq_phones), 2, end_day), -1, dtype=np.int32)
+    categories = ORDER_ACTIONS
+    has_month_orders = False
+    if not orders.empty:
+        first_day = (days[0] - DAY_EPOCH).days
+        day = day_ordinals(orders['date']) - first_day
+        mask = (day >= 0) & (day < end_day)
+        has_month_orders = bool(mask.any())
+        month_orders = orders[mask]
+        # 电话编码直接对应用户表 (去重后的) 行号，餐别 / 动作是固定词表编码
+        phone_idx = uniq_phones.get_indexer(month_orders['phone'])
+        meal_idx, _ = vocab_codes(month_orders['meal_type'], MEAL_TYPES)
+        action_codes, categories = vocab_codes(month_orders['action'], ORDER_ACTIONS)
+        keep = (phone_idx >= 0) & (meal_idx >= 0) & (meal_idx < 2)
+        cell = ((phone_idx.astype(np.int64) * 2 + meal_idx) * end_day + day[mask])[keep]
+        # 倒序后第一次出现的就是最后一条
+        last = len(cell) - 1 - np.unique(cell[::-1], return_index=True)[1]
+        actions.reshape(-1)[cell[last]] = action_codes[keep][last]
+
+    # 默认不吃的格子来自规则日历 (组 × 餐别 × 天)，不再逐天判断周日 / 节假日
+    is_off = get_rules_calendar().off_grid(uniq_phones, days)
+    eat = resolve_meal_status_codes(actions, categories, is_off, status_grid[:, None, :]) != "NO"
+
+    daily_counts = (eat * row_weights[:, None, None]).sum(axis=0)
+    daily_df = pd.DataFrame({
+        "Date": days.strftime("%Y-%m-%d"),
+        "Lunch": daily_counts[0].astype("int64"),
+        "Dinner": daily_counts[1].astype("int64"),
+    })
+
+    # 个人统计 (保持原有行为：当月没有任何订单记录时个人次数为 0)
+    person_totals = eat.sum(axis=2) if has_month_orders else np.zeros((len(uniq_phones), 2), dtype=int)
+    names = users.drop_duplicates(subset=['phone'], keep='last').set_index('phone')['name'].reindex(uniq_phones)
+    person_df = pd.DataFrame({
+        'L': person_totals[:, 0].astype("int64"),
+        'D': person_totals[:, 1].astype("int64"),
+        'Name': names.to_numpy(dtype=object),
+    }, index=uniq_phones)
+    
+    return daily_df, person_df
+
+# --- 月报结果缓存 ---
+# 记住每个月的月报结果和计算时用到的表版本 (已封存月份记归档的 sha256)、写入队列的代数以及规则版本；
+# 版本都没变就直接复用，多月导出、反复生成同一个月的报表都不用重新读订单、重新计算。
+# 只记版本号，不持有数据表本身。和每日汇总一样，超过 max_age 也重建 (可能有其他进程/手工修改表格)。
+MONTH_STATS_KEEP = 36
+
+class MonthStatsCache:
+    def __init__(self, keep, max_age):
+        self.keep = keep
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, deps):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return None
+            if entry[0] != deps or time_lib.monotonic() - entry[2] > self.max_age:
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def put(self, key, deps, result):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (deps, result, time_lib.monotonic())
+            while len(self.entries) > self.keep:
+                del self.entries[next(iter(self.entries))]
+
+@site_resource
+def get_month_stats():
+    return MonthStatsCache(MONTH_STATS_KEEP, CACHE_MAX_STALENESS)
+
+def get_monthly_stats(snap, year, month):
+    table = order_partition(f"{year:04d}-{month:02d}")
+    sealed = get_backend().sealed_months()
+    queue = get_write_queue() if snap.overlay_pending else None
+    # 先记版本再计算：计算期间有写入的话，存下的版本偏旧，下次只会多算一次，不会复用旧结果
+    deps = (snap.version("users"), snap.version("user_status_log"),
+            sealed[table] if table in sealed else snap.version(table),
+            queue.generation if queue is not None else 0, site_config().rules_version)
+    result = get_month_stats().get((year, month), deps)
+    if result is None:
+        result = calculate_monthly_stats(snap, year, month)
+        get_month_stats().put((year, month), deps, result)
+    return result
+
+# --- 多月工资导出 ---
+# 按月逐个计算 (规则与月报相同)，边算边把行写成 CSV / XLSX 的字节块交给调用方 (下载按钮、命令行)。
+# 每算完一个月就从快照里丢掉该月的订单表，导出前不在共享缓存里的月份也从共享缓存丢掉，
+# 导出多长的区间内存都只占一个月的量。
+#   people: 每人每月一行 (month, name, phone, L, D)，工资按人汇总
+#   daily:  每天一行 (date, L, D)
+EXPORT_KINDS = {"people": ["month", "name", "phone", "L", "D"], "daily": ["date", "L", "D"]}
+EXPORT_FORMATS = {"csv": "text/csv", "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
+EXPORT_CHUNK_ROWS = 2000
+EXPORT_MAX_MONTHS = 120
+
+def export_months(start_month, end_month):
+    # "YYYY-MM" ~ "YYYY-MM" -> [(年, 月), ...]
+    try:
+        start = datetime.strptime(str(start_month), "%Y-%m")
+        end = datetime.strptime(str(end_month), "%Y-%m")
+    except ValueError:
+        raise ValueError(f"月份无效 / invalid month: {start_month} ~ {end_month}")
+    count = (end.year - start.year) * 12 + end.month - start.month + 1
+    if count < 1:
+        raise ValueError("结束月份早于开始月份 / end month is before start month")
+    if count > EXPORT_MAX_MONTHS:
+        raise ValueError(f"一次最多导出 {EXPORT_MAX_MONTHS} 个月 / at most {EXPORT_MAX_MONTHS} months per export")
+    first = start.year * 12 + start.month - 1
+    return [((first + i) // 12, (first + i) % 12 + 1) for i in range(count)]
+
+def iter_export_rows(snap, kind, months):
+    cache = get_cache()
+    for year, month in months:
+        table = order_partition(f"{year:04d}-{month:02d}")
+        cached = cache.contains(table)
+        daily_df, person_df = get_monthly_stats(snap, year, month)
+        snap.invalidate(*[name for name in snap.tables if name.split("[")[0] == table])
+        if not cached: cache.discard(table)
+        if daily_df is None: return
+        if kind == "daily":
+            yield from daily_df[["Date", "Lunch", "Dinner"]].itertuples(index=False, name=None)
+        else:
+            label = f"{year:04d}-{month:02d}"
+            names = person_df['Name'].fillna("").astype(str)
+            yield from zip([label] * len(person_df), names, person_df.index.astype(str), person_df['L'].tolist(), person_df['D'].tolist())
+
+def iter_csv_chunks(header, rows):
+    # 带 BOM，Excel 直接打开中文 / 缅文姓名不会乱码
+    out = io.StringIO()
+    writer = csv.writer(out)
+    out.write("\ufeff")
+    writer.writerow(header)
+    for i, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if i % EXPORT_CHUNK_ROWS == 0:
+            yield out.getvalue().encode("utf-8")
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue().encode("utf-8")
+
+def iter_xlsx_chunks(kind, header, rows):
+    # openpyxl 的只写模式逐行落盘，不在内存里保留整张表；写完再分块读出临时文件
+    from openpyxl import Workbook
+    book = Workbook(write_only=True)
+    sheet = book.create_sheet(kind)
+    sheet.append(header)
+    for row in rows:
+        sheet.append(list(row))
+    with tempfile.TemporaryFile() as f:
+        book.save(f)
+        f.seek(0)
+        while chunk := f.read(1 << 20):
+            yield chunk
+
+def export_report(snap, kind, start_month, end_month, fmt="csv"):
+    # 返回字节块生成器；参数错误在开始生成之前就抛 ValueError
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"未知报表 / unknown export: {kind}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"未知格式 / unknown format: {fmt}")
+    months = export_months(start_month, end_month)
+    header, rows = EXPORT_KINDS[kind], iter_export_rows(snap, kind, months)
+    return iter_xlsx_chunks(kind, header, rows) if fmt == "xlsx" else iter_csv_chunks(header, rows)
+
+# 管理员总表：每个用户一行，附查看日期当天的午餐 / 晚餐状态
+@timed("build_admin_master")
+def build_admin_master(snap, view_date_str):
+    snap.prefetch("users", order_partition(view_date_str), "user_status_log")
+    users = snap.users
+    if users.empty:
+        return pd.DataFrame(columns=['name', 'phone', 'L_Status', 'D_Status', 'status'])
+    orders = snap.orders_on(view_date_str)
+    master = users.copy()
+    # 确保 status 存在
+    if 'status' not in master.columns:
+        master['status'] = 'active'
+    master['status'] = master['status'].fillna('active')
+    
+    l_map = {}
+    d_map = {}
+    if not orders.empty:
+        # 快照里的电话已经是规范格式
+        today_orders = orders[orders['date'] == view_date_str]
+        l_rows = today_orders[today_orders['meal_type'] == 'Lunch']
+        d_rows = today_orders[today_orders['meal_type'] == 'Dinner']
+        l_map = dict(zip(l_rows['phone'], l_rows['action']))
+        d_map = dict(zip(d_rows['phone'], d_rows['action']))
+
+    rules = get_rules_calendar()
+    group_codes = rules.group_codes(master['phone'])
+    # 查看日期当天生效的状态
+    view_status = get_status_timeline(snap).status_on(master['phone'], view_date_str, master['status'])
+    
+    # 应用新的解析逻辑，传入 status (整列向量化计算)
+    master['L_Status'] = resolve_meal_status_vec(master['phone'].map(l_map), rules.off_by_group(view_date_str, "Lunch")[group_codes], view_status)
+    master['D_Status'] = resolve_meal_status_vec(master['phone'].map(d_map), rules.off_by_group(view_date_str, "Dinner")[group_codes], view_status)
+    return master
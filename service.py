@@ -0,0 +1,236 @@
+# 无界面的只读报表服务 + 命令行
+# 厨房显示屏、工资脚本直接取 JSON / CSV，不用打开 Streamlit 页面、不用输入管理员 PIN。
+#   python service.py serve --port 8502
+#   python service.py daily --date 2026-10-18 --format csv
+#   python service.py late --date 2026-10-18
+#   python service.py monthly --year 2026 --month 10 --format csv
+#   python service.py export --start 2026-07 --end 2026-09 --kind people --format xlsx --output q3.xlsx
+#     多月工资导出 (逐月计算、分块写出)；不写 --output 时输出到标准输出
+# HTTP 接口：GET /daily?date=  /late?date=  /monthly?year=&month=  (都可加 &format=csv)
+#           GET /metrics  性能计时 (Prometheus 文本格式；?format=json 返回 JSON)
+# 数据来自 core 的进程级共享缓存；响应带 ETag，客户端带 If-None-Match 轮询、数据没变时只返回 304。
+# 多工厂部署时每个接口都可以加 &site=<工厂> (或按访问的域名选择)，命令行用 --site。
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from core import configure, read_secrets_file, get_metrics, resolve_site, use_site, DataSnapshot, DailyRollup, get_status_timeline, order_partition, calculate_monthly_stats, get_thai_time, export_report, EXPORT_KINDS, EXPORT_FORMATS
+
+MEALS = ["Lunch", "Dinner"]
+
+# --- 报表 ---
+# 每个报表返回 (JSON 对象, CSV 表头, CSV 行)。规则与页面完全相同 (resolve_meal_status / 状态时间线)。
+
+def daily_rollups(snap, date_str):
+    # 只读服务没有写入，共享汇总的增量更新用不上，直接从快照构建
+    snap.prefetch("users", order_partition(date_str), "user_status_log")
+    users, orders, timeline = snap.users, snap.orders_on(date_str), get_status_timeline(snap)
+    return {meal: DailyRollup.build(date_str, meal, users, orders, {}, timeline) for meal in MEALS}
+
+def daily_report(snap, date_str):
+    meals, rows = {}, []
+    for meal, rollup in daily_rollups(snap, date_str).items():
+        counts = {status: n for status, n in sorted(rollup.counts.items()) if n}
+        meals[meal] = {"total": rollup.total(), "eaters": rollup.eaters(), "counts": counts}
+        rows.append([date_str, meal, rollup.total(), rollup.eaters()])
+    return {"date": date_str, "meals": meals}, ["date", "meal_type", "total", "eaters"], rows
+
+def late_report(snap, date_str):
+    data, rows = {"date": date_str}, []
+    for meal, rollup in daily_rollups(snap, date_str).items():
+        groups = rollup.late_groups()
+        data[meal] = groups
+        rows += [[date_str, meal, slot, name] for slot, names in groups.items() for name in names]
+    return data, ["date", "meal_type", "pickup_time", "name"], rows
+
+def monthly_report(snap, year, month):
+    header = ["name", "phone", "L", "D"]
+    daily_df, person_df = calculate_monthly_stats(snap, year, month)
+    if daily_df is None:
+        return {"year": year, "month": month, "daily": [], "people": []}, header, []
+    people = person_df.reset_index().rename(columns={"index": "phone", "Name": "name"})[header]
+    people["name"] = people["name"].fillna("")
+    data = {"year": year, "month": month,
+            "daily": daily_df.to_dict("records"), "people": people.to_dict("records")}
+    return data, header, people.values.tolist()
+
+def render(report, fmt):
+    data, header, rows = report
+    if fmt == "csv":
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(header)
+        writer.writerows(rows)
+        return out.getvalue().encode("utf-8"), "text/csv; charset=utf-8"
+    return json.dumps(data, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+
+# --- 结果缓存 ---
+# 报表按 (名称, 参数, 格式) 缓存，并记住计算时用到的数据表对象。共享缓存返回的还是同一批对象
+# 就直接复用结果和 ETag，稳定轮询时不重新计算。已封存月份的归档不会变，不参与比较。
+# 只保留最近用过的 REPORT_CACHE_SIZE 份，按日期 / 月份轮询不会让旧结果和它们引用的数据表一直留在内存里。
+REPORT_CACHE_SIZE = 64
+
+class ReportCache:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, build, fmt):
+        snap = DataSnapshot(overlay_pending=False)
+        with self.lock:
+            entry = self.entries.get((key, fmt))
+        if entry is not None and all(snap.table(name) is df for name, df in entry[0].items()):
+            with self.lock:
+                # 命中的移到最后，淘汰时从最久没用过的开始
+                if self.entries.get((key, fmt)) is entry: self.entries[(key, fmt)] = self.entries.pop((key, fmt))
+            return entry[1]
+        body, content_type = render(build(snap), fmt)
+        result = (body, content_type, '"' + hashlib.sha1(body).hexdigest() + '"')
+        deps = {name: df for name, df in snap.tables.items() if "[" not in name}
+        with self.lock:
+            self.entries.pop((key, fmt), None)
+            self.entries[(key, fmt)] = (deps, result)
+            while len(self.entries) > self.size:
+                del self.entries[next(iter(self.entries))]
+        return result
+
+
+REPORTS = ReportCache(REPORT_CACHE_SIZE)
+
+# 报表日期的年份范围 (pandas 的时间戳只到 2262 年)，超出范围按参数错误 (400) 处理
+REPORT_YEARS = range(1970, 2201)
+
+def check_year(year):
+    if year not in REPORT_YEARS: raise ValueError("year")
+    return year
+
+def parse_date(value):
+    date = datetime.strptime(value, "%Y-%m-%d")
+    check_year(date.year)
+    return date.strftime("%Y-%m-%d")
+
+def resolve(path, query):
+    # 返回 (缓存键, 构建函数)；未知路径抛 KeyError，参数错误抛 ValueError
+    today = get_thai_time()
+    if path in ("/daily", "/late"):
+        date_str = parse_date(query.get("date", today.strftime("%Y-%m-%d")))
+        report = daily_report if path == "/daily" else late_report
+        return (path, date_str), lambda snap: report(snap, date_str)
+    if path == "/monthly":
+        year, month = int(query.get("year", today.year)), int(query.get("month", today.month))
+        if not 1 <= month <= 12: raise ValueError("month")
+        check_year(year)
+        return (path, year, month), lambda snap: monthly_report(snap, year, month)
+    raise KeyError(path)
+
+
+class ReportHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            site = resolve_site(query.pop("site", None), self.headers.get("Host"))
+            use_site(site)
+        except KeyError:
+            return self.send_error(404)
+        # 计时按工厂分开：/metrics 也用 ?site= 或 Host 选工厂
+        if url.path == "/metrics":
+            if query.get("format") == "json":
+                return self.send_body(get_metrics().to_json().encode("utf-8"), "application/json; charset=utf-8")
+            return self.send_body(get_metrics().to_prometheus().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+        fmt = "csv" if query.pop("format", "json") == "csv" else "json"
+        try:
+            key, build = resolve(url.path, query)
+        except KeyError:
+            return self.send_error(404)
+        except ValueError:
+            return self.send_error(400)
+        body, content_type, etag = REPORTS.get((site,) + key, build, fmt)
+        get_metrics().observe("service.request" + url.path, time.perf_counter() - start)
+        if etag in [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_body(body, content_type, etag)
+
+    def send_body(self, body, content_type, etag=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag: self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="报餐只读报表 / read-only meal reports")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8502)
+    for name in ["daily", "late"]:
+        p = sub.add_parser(name)
+        p.add_argument("--date", type=parse_date)
+    monthly = sub.add_parser("monthly")
+    monthly.add_argument("--year", type=int)
+    monthly.add_argument("--month", type=int)
+    for p in sub.choices.values():
+        if p is not serve: p.add_argument("--format", choices=["json", "csv"], default="json")
+    export = sub.add_parser("export")
+    export.add_argument("--start", required=True, help="YYYY-MM")
+    export.add_argument("--end", help="YYYY-MM (默认与 --start 相同)")
+    export.add_argument("--kind", choices=list(EXPORT_KINDS), default="people")
+    export.add_argument("--format", choices=list(EXPORT_FORMATS), default="csv")
+    export.add_argument("--output")
+    for p in sub.choices.values():
+        if p is not serve: p.add_argument("--site")
+    args = parser.parse_args(argv)
+    # 与页面读同一份 secrets (.streamlit/secrets.toml)；用 SQLite 后端时完全不需要加载 streamlit
+    configure(read_secrets_file())
+    try:
+        site = resolve_site(getattr(args, "site", None))
+    except KeyError:
+        parser.error(f"unknown site: {args.site}")
+    use_site(site)
+
+    if args.command == "serve":
+        server = ThreadingHTTPServer((args.host, args.port), ReportHandler)
+        print(f"serving on http://{args.host}:{args.port}", file=sys.stderr)
+        server.serve_forever()
+        return
+    if args.command == "export":
+        try:
+            chunks = export_report(DataSnapshot(overlay_pending=False), args.kind, args.start, args.end or args.start, args.format)
+        except ValueError as e:
+            parser.error(str(e))
+        with (open(args.output, "wb") if args.output else open(sys.stdout.fileno(), "wb", closefd=False)) as out:
+            for chunk in chunks:
+                out.write(chunk)
+        return
+    query = {k: str(v) for k, v in vars(args).items() if k in ("date", "year", "month") and v is not None}
+    try:
+        key, build = resolve("/" + args.command, query)
+    except ValueError as e:
+        parser.error(f"参数无效 / invalid argument: {e}")
+    body, _, _ = REPORTS.get((site,) + key, build, args.format)
+    sys.stdout.write(body.decode("utf-8"))
+
+
+if __name__ == "__main__":
+    main()
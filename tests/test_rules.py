@@ -0,0 +1,168 @@
+# 吃饭规则的性质测试：向量化 / 编码版本必须与逐格的 resolve_meal_status 完全一致，
+# 月报 (calculate_monthly_stats) 必须与原来逐人逐天的循环结果一致。
+
+import calendar
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import core
+
+ACTIONS = core.ORDER_ACTIONS + ["LATE_99:99", "FOO", "", None, np.nan]
+STATUSES = ["active", "leave", None, np.nan]
+
+
+def random_cells(rng, n):
+    actions = np.array([ACTIONS[i] for i in rng.integers(0, len(ACTIONS), n)], dtype=object)
+    is_off = rng.random(n) < 0.5
+    statuses = np.array([STATUSES[i] for i in rng.integers(0, len(STATUSES), n)], dtype=object)
+    return actions, is_off, statuses
+
+
+# --- resolve_meal_status_vec / resolve_meal_status_codes ---
+
+@pytest.mark.parametrize("seed", range(5))
+def test_vec_matches_scalar(seed):
+    actions, is_off, statuses = random_cells(np.random.default_rng(seed), 2000)
+    expected = [core.resolve_meal_status(a, o, s) for a, o, s in zip(actions, is_off, statuses)]
+    assert list(core.resolve_meal_status_vec(actions, is_off, statuses)) == expected
+
+
+@pytest.mark.parametrize("is_off", [False, True])
+@pytest.mark.parametrize("status", STATUSES)
+def test_vec_broadcasts_scalars(is_off, status):
+    actions = np.array(ACTIONS, dtype=object)
+    expected = [core.resolve_meal_status(a, is_off, status) for a in actions]
+    assert list(core.resolve_meal_status_vec(actions, is_off, status)) == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_codes_match_scalar(seed):
+    rng = np.random.default_rng(seed)
+    # 编码版本的类别里没有空值：空值用 -1 (没有记录) 表示
+    categories = [a for a in ACTIONS if isinstance(a, str)]
+    codes = rng.integers(-1, len(categories), (50, 2, 31))
+    is_off = rng.random(codes.shape) < 0.5
+    statuses = np.array([STATUSES[i] for i in rng.integers(0, len(STATUSES), 50 * 31)], dtype=object).reshape(50, 1, 31)
+    result = core.resolve_meal_status_codes(codes, categories, is_off, statuses)
+    assert result.shape == codes.shape
+    for idx in np.ndindex(codes.shape):
+        action = categories[codes[idx]] if codes[idx] >= 0 else None
+        assert result[idx] == core.resolve_meal_status(action, is_off[idx], statuses[idx[0], 0, idx[2]])
+
+
+# --- calculate_monthly_stats ---
+
+def reference_monthly_stats(users, orders, year, month):
+    # 原来的实现：逐人逐天判断 (默认规则为周日不吃，状态整月取当前状态)
+    users = users.copy()
+    users['status'] = users['status'].fillna('active')
+    status = dict(zip(users['phone'], users['status']))
+    last = {}
+    for row in orders.itertuples(index=False):
+        last[(row.date, row.phone, row.meal_type)] = row.action
+    end_day = calendar.monthrange(year, month)[1]
+    daily, person = [], {row.phone: {'L': 0, 'D': 0, 'Name': row.name} for row in users.itertuples(index=False)}
+    has_orders = any(key[0].startswith(f"{year}-{month:02d}-") for key in last)
+    for day in range(1, end_day + 1):
+        d_obj = datetime(year, month, day)
+        d_str = d_obj.strftime("%Y-%m-%d")
+        is_sun = d_obj.weekday() == 6
+        counts = {"Lunch": 0, "Dinner": 0}
+        for phone in users['phone']:
+            for meal in counts:
+                if core.resolve_meal_status(last.get((d_str, phone, meal)), is_sun, status[phone]) != "NO":
+                    counts[meal] += 1
+        daily.append({"Date": d_str, **counts})
+        if has_orders:
+            for phone, stats in person.items():
+                for meal, col in [("Lunch", "L"), ("Dinner", "D")]:
+                    if core.resolve_meal_status(last.get((d_str, phone, meal)), is_sun, status[phone]) != "NO":
+                        stats[col] += 1
+    return pd.DataFrame(daily), pd.DataFrame.from_dict(person, orient='index')
+
+
+@pytest.fixture
+def backend(tmp_path):
+    core.configure({"STORAGE_BACKEND": "sqlite", "SQLITE_PATH": str(tmp_path / "meal.db"),
+                    "ARCHIVE_DIR": str(tmp_path / "archive")})
+    for get in [core.get_cache, core.get_timeline_memo, core.get_month_stats, core.get_rules_memo]:
+        get.clear()
+    backend = core.SQLiteBackend(str(tmp_path / "meal.db"))
+    core.get_backend.set(backend)
+    yield backend
+    core.get_backend.clear()
+    core.get_cache.clear()
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_monthly_stats_match_loop(backend, seed):
+    rng = np.random.default_rng(seed)
+    year, month = 2026, int(rng.integers(1, 13))
+    phones = [f"08{i:08d}" for i in range(30)]
+    # 历史数据里同一电话可能有多行
+    user_phones = phones + [phones[i] for i in rng.integers(0, len(phones), 3)]
+    users = pd.DataFrame({
+        "phone": user_phones,
+        "name": [f"user{i}" for i in range(len(user_phones))],
+        "reg_date": "2026-01-01",
+        "status": [STATUSES[i] for i in rng.integers(0, 3, len(user_phones))],
+    })
+    n = 600
+    days = pd.Timestamp(year, month, 1) + pd.to_timedelta(rng.integers(-3, 34, n), unit="D")
+    actions = [a for a in ACTIONS if isinstance(a, str) and a]
+    orders = pd.DataFrame({
+        "date": days.strftime("%Y-%m-%d"),
+        # 也有不在用户表里的电话 (已删除的用户)
+        "phone": [f"08{i:08d}" for i in rng.integers(0, len(phones) + 5, n)],
+        "name": "x",
+        "meal_type": rng.choice(core.MEAL_TYPES, n),
+        "action": [actions[i] for i in rng.integers(0, len(actions), n)],
+        "time": "2026-01-01 08:00:00",
+    })
+    backend.write("users", users)
+    backend.write("orders", orders)
+
+    daily, person = core.calculate_monthly_stats(core.DataSnapshot(), year, month)
+    ref_daily, ref_person = reference_monthly_stats(backend.read("users"), backend.read("orders"), year, month)
+    pd.testing.assert_frame_equal(daily, ref_daily, check_dtype=False)
+    pd.testing.assert_frame_equal(person[['L', 'D', 'Name']], ref_person[['L', 'D', 'Name']],
+                                  check_dtype=False, check_index_type=False)
+
+
+# --- 每日汇总 ---
+
+@pytest.mark.parametrize("seed", range(3))
+def test_daily_rollup_counts_every_user_row(backend, seed):
+    rng = np.random.default_rng(seed)
+    phones = [f"08{i:08d}" for i in range(20)]
+    # 重复电话的行状态一致 (改状态会改所有行)
+    user_phones = phones + [phones[i] for i in rng.integers(0, len(phones), 5)]
+    status = {p: ["active", "leave"][rng.integers(0, 2)] for p in phones}
+    users = pd.DataFrame({"phone": user_phones, "name": user_phones, "reg_date": "2026-01-01",
+                          "status": [status[p] for p in user_phones]})
+    actions = [a for a in ACTIONS if isinstance(a, str) and a]
+    orders = pd.DataFrame({"date": "2026-09-06", "phone": phones, "name": "x", "meal_type": "Lunch",
+                           "action": [actions[i] for i in rng.integers(0, len(actions), len(phones))], "time": ""})
+    rollup = core.DailyRollup.build("2026-09-06", "Lunch", users, orders, {})
+
+    def expected(users, actions):
+        # 原来的统计：用户表每一行算一个人 (2026-09-06 是周日)
+        resolved = [core.resolve_meal_status(actions.get(p), True, s) for p, s in zip(users["phone"], users["status"])]
+        return len(resolved), sum(r != "NO" for r in resolved)
+
+    action_map = dict(zip(orders["phone"], orders["action"]))
+    assert (rollup.total(), rollup.eaters()) == expected(users, action_map)
+
+    # 增量更新 (包括重复应用同一条变更) 之后仍然一致
+    changes = [("order", {"date": "2026-09-06", "meal_type": "Lunch", "phone": user_phones[-1], "action": "BOOKED"}),
+               ("user_added", {"phone": "0899999999", "name": "new"}),
+               ("user_deleted", {"phone": phones[0]})]
+    for kind, change in changes + changes:
+        rollup.apply_change(kind, change)
+    action_map[user_phones[-1]] = "BOOKED"
+    users = pd.concat([users[users["phone"] != phones[0]],
+                       pd.DataFrame([{"phone": "0899999999", "name": "new", "status": "active"}])], ignore_index=True)
+    assert (rollup.total(), rollup.eaters()) == expected(users, action_map)
@@ -0,0 +1,169 @@
+# 存储后端的回归测试：用 bench 里的内存版 Google 表格连接，检查读-改-写不会弄丢或重复订单。
+
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+from gspread.exceptions import WorksheetNotFound
+
+import bench
+import core
+
+
+def live_months(conn):
+    return set(conn.sheets["orders"]["date"].astype(str).str[:7])
+
+
+# --- 封存之后的点击 ---
+
+def test_click_after_seal_keeps_sealed_month_out_of_live_orders():
+    sheets = bench.synthetic_factory(users=40, months=3, density=0.3)
+    conn = bench.install(sheets)
+    today = core.get_thai_time()
+    first = sorted(live_months(conn))[0]
+    year, month = map(int, first.split("-"))
+    live_before = len(conn.sheets["orders"])
+
+    sealed_rows, _ = core.seal_order_month(core.DataSnapshot(), year, month)
+    assert first not in live_months(conn)
+    assert len(conn.sheets["orders"]) == live_before - sealed_rows
+
+    # 单击、批量改餐都走 apply_orders 的整表读-改-写
+    core.update_order(core.DataSnapshot(), "0800000000", "Worker 00000", "Lunch", "CANCELED", today.strftime("%Y-%m-%d"))
+    core.bulk_update_orders(core.DataSnapshot(), ["0800000001", "0800000002"], ["Dinner"], "BOOKED",
+                            today.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d"))
+    assert first not in live_months(conn)
+    assert len(conn.sheets["orders"]) <= live_before - sealed_rows + 3
+
+    # 全量视图里封存的月份只出现一次 (来自归档)
+    full = core.get_backend().load("orders")
+    assert (full["date"].astype(str).str[:7] == first).sum() == sealed_rows
+
+
+# --- 事件日志模式：压缩期间追加的点击 ---
+# 服务账号模式的内存版表格：每个 API 调用是原子的，调用之间其他线程可以插进来。
+
+class FakeWorksheet:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = []
+        self.row_count = self.col_count = 0
+
+    def clear(self):
+        with self.lock:
+            self.rows = []
+
+    def resize(self, rows=None, cols=None):
+        pass
+
+    def update_cells(self, cells, value_input_option=None):
+        with self.lock:
+            for cell in cells:
+                while len(self.rows) < cell.row: self.rows.append([])
+                row = self.rows[cell.row - 1]
+                while len(row) < cell.col: row.append("")
+                row[cell.col - 1] = str(cell.value).lstrip("'")
+
+    def row_values(self, index):
+        with self.lock:
+            return list(self.rows[index - 1]) if len(self.rows) >= index else []
+
+    def append_row(self, values, value_input_option=None):
+        self.append_rows([values])
+
+    def append_rows(self, values, value_input_option=None):
+        with self.lock:
+            self.rows += [list(map(str, row)) for row in values]
+
+    def delete_rows(self, start, end=None):
+        with self.lock:
+            del self.rows[start - 1:(end or start)]
+
+    def frame(self):
+        with self.lock:
+            if not self.rows: return pd.DataFrame()
+            return pd.DataFrame([row + [""] * (len(self.rows[0]) - len(row)) for row in self.rows[1:]], columns=self.rows[0])
+
+
+class FakeClient:
+    def __init__(self):
+        self.sheets = {}
+
+    def _select_worksheet(self, worksheet=None):
+        if worksheet not in self.sheets: raise WorksheetNotFound(worksheet)
+        return self.sheets[worksheet]
+
+    def _open_spreadsheet(self):
+        return self
+
+    def add_worksheet(self, title=None, rows=None, cols=None):
+        return self.sheets.setdefault(title, FakeWorksheet())
+
+
+class FakeServiceConnection:
+    def __init__(self):
+        self.client = FakeClient()
+
+    def read(self, worksheet=None, ttl=None, dtype=None, **kwargs):
+        return self.client._select_worksheet(worksheet).frame()
+
+
+def test_compaction_keeps_events_appended_meanwhile(tmp_path):
+    core.configure({"STORAGE_BACKEND": "gsheets", "ORDER_LOG_MODE": True, "ARCHIVE_DIR": str(tmp_path)})
+    backend = core.GSheetsBackend(FakeServiceConnection(), log_mode=True)
+    click = lambda i: {"date": "2026-09-01", "phone": f"08{i:08d}", "name": "x", "meal_type": "Lunch",
+                       "action": "BOOKED", "time": "08:00:00"}
+    backend.write("orders", core.normalize_table("orders", pd.DataFrame()))
+    backend.apply_orders([click(i) for i in range(20)])
+
+    # 点击一直在追加，同时反复压缩
+    stop, total = threading.Event(), [20]
+    def clicker():
+        while not stop.is_set() and total[0] < 400:
+            backend.apply_orders([click(total[0])])
+            total[0] += 1
+    thread = threading.Thread(target=clicker)
+    thread.start()
+    for _ in range(10):
+        backend.compact_order_log()
+    stop.set()
+    thread.join()
+    backend.compact_order_log()
+
+    orders = core.normalize_table("orders", backend.read("orders"))
+    assert sorted(orders["phone"]) == [f"08{i:08d}" for i in range(total[0])]
+    assert backend.read_optional("order_events").empty
+
+
+# --- SQLite 的状态点查 ---
+
+@pytest.mark.parametrize("log_mode", [False, True])
+@pytest.mark.parametrize("partitioned", [False, True])
+def test_status_point_read_matches_month_read(tmp_path, log_mode, partitioned):
+    core.configure({"STORAGE_BACKEND": "sqlite", "SQLITE_PATH": str(tmp_path / "meal.db"), "ORDER_LOG_MODE": log_mode})
+    for get in bench.RESOURCES:
+        get.clear()
+    backend = core.SQLiteBackend(str(tmp_path / "meal.db"), log_mode=log_mode)
+    core.get_backend.set(backend)
+    rng = np.random.default_rng(0)
+    actions = ["BOOKED", "CANCELED", "DELETE", "LATE_12:30"]
+    clicks = [{"date": f"2026-09-{rng.integers(1, 4):02d}", "phone": f"08{rng.integers(0, 5):08d}", "name": "x",
+               "meal_type": core.MEAL_TYPES[rng.integers(0, 2)], "action": actions[rng.integers(0, 4)], "time": "08:00:00"}
+              for _ in range(80)]
+    backend.apply_orders(clicks[:40])
+    if log_mode: backend.compact_order_log()
+    if partitioned: backend.partition_orders()
+    backend.apply_orders(clicks[40:])
+    core.on_data_changed("orders")
+
+    reads = []
+    backend.read = lambda table, read=backend.read: reads.append(table) or read(table)
+    point = {(c["date"], c["meal_type"], c["phone"]): core.get_status(core.DataSnapshot(), c["phone"], c["meal_type"], c["date"])
+             for c in clicks}
+    assert reads == []
+    month = core.get_backend().load(core.order_partition("2026-09-01") if partitioned else "orders")
+    for (date, meal_type, phone), action in point.items():
+        res = month[(month["date"] == date) & (month["meal_type"] == meal_type) & (month["phone"] == phone)]
+        assert action == (res.iloc[-1]["action"] if not res.empty else None)
+    core.get_backend.clear()